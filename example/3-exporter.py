@@ -20,6 +20,7 @@ from multiprocessing import freeze_support
 
 from exporter.config import FileType
 from exporter import HtmlExporter, TxtExporter, AiTxtExporter, DocxExporter, MarkdownExporter, ExcelExporter
+from exporter.orchestrator import ExportOrchestrator
 from wxManager import DatabaseConnection, MessageType
 
 
@@ -54,6 +55,7 @@ def export():
 def batch_export():
     """
     批量导出HTML
+    所有联系人共用一个进程池/线程池和媒体仓库，中断后再次运行会跳过已经导出完成的联系人
     :return:
     """
     st = time.time()
@@ -66,18 +68,20 @@ def batch_export():
     database = conn.get_interface()  # 获取数据库接口
 
     contacts = database.get_contacts()  # 查找某个联系人
-    for contact in contacts:
-        exporter = HtmlExporter(
-            database,
-            contact,
-            output_dir=output_dir,
-            type_=FileType.HTML,
-            message_types={MessageType.Text, MessageType.Image, MessageType.LinkMessage},  # 要导出的消息类型，默认全导出
-            time_range=['2020-01-01 00:00:00', '2035-03-12 00:00:00'],  # 要导出的日期范围，默认全导出
-            group_members=None  # 指定导出群聊里某个或者几个群成员的聊天记录
-        )
-
-        exporter.start()
+    orchestrator = ExportOrchestrator(
+        database,
+        output_dir,
+        HtmlExporter,
+        FileType.HTML,
+        exporter_kwargs={
+            'message_types': {MessageType.Text, MessageType.Image, MessageType.LinkMessage},  # 要导出的消息类型，默认全导出
+            'time_range': ['2020-01-01 00:00:00', '2035-03-12 00:00:00'],  # 要导出的日期范围，默认全导出
+            'group_members': None,  # 指定导出群聊里某个或者几个群成员的聊天记录
+        },
+        cpu_workers=8,  # 图片解密的进程数
+        io_workers=16  # 复制文件、语音转换的线程数
+    )
+    orchestrator.start(contacts)
     et = time.time()
     print(f'耗时：{et - st:.2f}s')
 
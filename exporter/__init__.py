@@ -1,7 +1,8 @@
 from exporter.exporter_txt import TxtExporter
 from exporter.exporter_ai_txt import AiTxtExporter
-from exporter.exporter_csv import CSVExporter
+from exporter.exporter_csv import CSVExporter, CsvAllExporter
 from exporter.exporter_html import HtmlExporter
 from exporter.exporter_docx import DocxExporter
 from exporter.exporter_markdown import MarkdownExporter
 from exporter.exporter_xlsx import ExcelExporter
+from exporter.exporter_parquet import ParquetExporter
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@File        : wxManager-avatar_cache.py
+@Description : 导出全局共享的头像缓存，批量查询头像，每个头像只写一次
+"""
+import hashlib
+import os
+import threading
+import traceback
+from typing import Dict, Iterable
+
+from wxManager.log import logger
+
+DEFAULT_AVATAR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources', 'default_avatar.png')
+
+
+class AvatarCache:
+    """
+    头像缓存
+    头像保存在 <output_dir>/聊天记录/.avatar/<wxid>_<md5>.png，所有聊天都引用这个文件夹里的文件，
+    头像换了md5也会变，不会用到旧头像；没有头像的联系人共用一个默认头像
+    批量导出时由调度器创建一个实例，在所有导出任务之间共享
+    """
+
+    def __init__(self, output_dir):
+        self.root = os.path.join(output_dir, '聊天记录', '.avatar')
+        self.default_path = os.path.join(self.root, 'default.png')
+        self.paths = {}  # wxid -> 头像文件路径
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def _write(self, path, avatar_buffer):
+        if os.path.exists(path):
+            return path
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(avatar_buffer)
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.error(traceback.format_exc())
+            return ''
+        return path
+
+    def _default_avatar(self):
+        if not os.path.exists(self.default_path):
+            with open(DEFAULT_AVATAR, 'rb') as f:
+                self._write(self.default_path, f.read())
+        return self.default_path
+
+    def get_avatar_paths(self, database, usernames: Iterable[str]) -> Dict[str, str]:
+        """
+        获取一批联系人的头像文件，缓存里没有的联系人用一次查询取出头像数据
+        @param database: 数据库
+        @param usernames: wxid列表
+        @return: {wxid: 头像文件的绝对路径}
+        """
+        usernames = list(dict.fromkeys(username for username in usernames if username))
+        with self._lock:
+            missing = [username for username in usernames if username not in self.paths]
+        if missing:
+            try:
+                buffers = database.get_avatar_buffers(missing)
+            except:
+                logger.error(traceback.format_exc())
+                buffers = {}
+            paths = {}
+            for username in missing:
+                avatar_buffer = buffers.get(username)
+                if avatar_buffer:
+                    md5 = hashlib.md5(avatar_buffer).hexdigest()
+                    paths[username] = self._write(os.path.join(self.root, f'{username}_{md5}.png'), avatar_buffer)
+                if not paths.get(username):
+                    paths[username] = self._default_avatar()
+            with self._lock:
+                self.paths.update(paths)
+        with self._lock:
+            return {username: self.paths[username] for username in usernames}
+
+    def get_avatar_path(self, database, username) -> str:
+        return self.get_avatar_paths(database, [username]).get(username) or self._default_avatar()
+
+
+if __name__ == '__main__':
+    pass
@@ -28,6 +28,8 @@ class FileType(Enum):
     PUBLIC_TO_DOCX = 21
     PUBLIC_TO_MD = 22
     MARKDOWN = 23
+    PARQUET = 24
+    ARROW = 25
 
 
 
@@ -1,25 +1,33 @@
+import contextlib
 import csv
 import html
 import io
+import json
 import os
-import re
 import shutil
 import subprocess
 import sys
 import time
 import traceback
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List, Tuple
 
 import pysilk
 
 from wxManager import MessageType, DataBaseInterface
+from wxManager.decrypt.decrypt_dat import batch_decode_image_multiprocessing
+from wxManager.parser.util.common import remove_privacy_info
 from wxManager.model import Contact, Me, Message
 
 from wxManager.log import logger
+from exporter.avatar_cache import AvatarCache
 from exporter.config import FileType
 
 
+WATERMARK_FILE = '.watermark.json'  # 增量导出的水位线文件，保存在联系人文件夹下
+
+
 def makedirs(path):
     if not os.path.exists(path):
         os.makedirs(path, exist_ok=True)
@@ -56,6 +64,34 @@ def escape_js_and_html(input_str):
     return js_escaped
 
 
+class CountingWriter:
+    """
+    带字节计数的缓冲文本写入，流式导出时用写入的字节数汇报进度
+    """
+
+    def __init__(self, filename, buffering=1024 * 1024, encoding='utf-8', mode='wb'):
+        """
+        @param mode: 'wb' 新建，'ab' 追加（增量导出）
+        """
+        self.file = open(filename, mode, buffering=buffering)
+        self.encoding = encoding
+        self.bytes_written = 0
+
+    def write(self, text: str):
+        data = text.encode(self.encoding)
+        self.file.write(data)
+        self.bytes_written += len(data)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 class ExporterBaseBase:
     exporter_id = 0
 
@@ -80,6 +116,16 @@ class ExporterBaseBase:
 
 
 class ExporterBase(ExporterBaseBase):
+    supports_incremental = False  # 能否把新消息追加到上次导出的文件里（增量导出）
+
+    @classmethod
+    def can_export_incrementally(cls, **kwargs) -> bool:
+        """
+        @param kwargs: 导出类的构造参数，有的格式只在部分模式下支持增量导出（例如分页HTML）
+        @return: 用这些参数构造的导出对象是否支持增量导出
+        """
+        return cls.supports_incremental
+
     i = 1
 
     def __init__(
@@ -92,7 +138,9 @@ class ExporterBase(ExporterBaseBase):
             time_range=None,  # 导出的日期范围
             group_members: set[str] = None,  # 群聊中只导出这些人的聊天记录
             progress_callback=None,  # 进度回调函数，func(progress:float)
-            finish_callback=None  # 导出完成回调函数
+            finish_callback=None,  # 导出完成回调函数
+            media_store=None,  # 批量导出时共享的媒体仓库，exporter.media_store.MediaStore
+            incremental=False  # 增量导出，只导出上次导出之后的新消息并追加到上次的文件里
     ):
         """
         @param database:
@@ -103,8 +151,12 @@ class ExporterBase(ExporterBaseBase):
         @param time_range: 导出的日期范围
         @param group_members: 群聊中筛选的群成员
         @param progress_callback: 导出进度回调函数
+        @param media_store: 媒体仓库，不为空时相同的图片、视频、文件、语音只解码/复制一次，其余位置使用硬链接
+        @param incremental: 增量导出，只有支持追加写入的格式（TXT、CSV、JSONL、分页HTML）可以使用，其他格式抛出ValueError
         """
         super().__init__()
+        if incremental and not self.supports_incremental:
+            raise ValueError(f'{type(self).__name__} 不支持增量导出')
         if progress_callback:
             self.update_progress_callback = progress_callback
         else:
@@ -128,6 +180,15 @@ class ExporterBase(ExporterBaseBase):
         self.group_contacts = {}  # 群聊里的所有联系人
         self.group_members = group_members  # 要导出的群聊成员（用于群消息筛选）
         self.group_members_set = group_members
+        self.media_store = media_store
+        self.cpu_executor = None  # 共享的进程池（图片解密），为空时每批任务临时创建
+        self.io_executor = None  # 共享的线程池（复制文件、语音转换），为空时每批任务临时创建
+        self.output_dir = output_dir
+        self.avatar_cache = None  # 共享的头像缓存，为空时第一次用到头像时创建
+        self.incremental = incremental
+        self.watermark = {}  # 上次导出的水位线
+        self._watermark_sort_seq = None  # 本次导出到的最后一条消息的sort_seq
+        self._watermark_server_ids = set()  # sort_seq等于水位线的消息，sort_seq可能重复，用server_id去重
         self.origin_path = os.path.join(output_dir, '聊天记录', f'{self.contact.remark}({self.contact.wxid})')
         makedirs(self.origin_path)
 
@@ -135,6 +196,16 @@ class ExporterBase(ExporterBaseBase):
         logger.info(f'导出进度：{progress * 100:.2f}%')
         # print()
 
+    def print_write_progress(self, msg_num, bytes_written, start_time):
+        """
+        流式导出时事先不知道消息总数，按已写入的字节数汇报进度
+        """
+        cost = max(time.time() - start_time, 1e-6)
+        logger.info(
+            f'导出进度：{msg_num}条消息，已写入{bytes_written / 1024 / 1024:.2f}MB，'
+            f'{bytes_written / 1024 / 1024 / cost:.2f}MB/s'
+        )
+
     def finish(self, success):
         if success:
             logger.info(f'导出完成\n{"-" * 20}')
@@ -144,6 +215,27 @@ class ExporterBase(ExporterBaseBase):
     def set_update_callback(self, callback):
         self.update_progress_callback = callback
 
+    def set_executors(self, cpu_executor=None, io_executor=None):
+        """
+        使用外部共享的进程池/线程池处理媒体文件，多个导出任务共用同一份并发预算
+        @param cpu_executor: ProcessPoolExecutor，用于图片解密
+        @param io_executor: ThreadPoolExecutor，用于复制文件、语音转换
+        @return:
+        """
+        self.cpu_executor = cpu_executor
+        self.io_executor = io_executor
+
+    def set_avatar_cache(self, avatar_cache: AvatarCache):
+        """
+        使用外部共享的头像缓存，多个导出任务之间同一个头像只查询、写入一次
+        """
+        self.avatar_cache = avatar_cache
+
+    def get_avatar_cache(self) -> AvatarCache:
+        if self.avatar_cache is None:
+            self.avatar_cache = AvatarCache(self.output_dir)
+        return self.avatar_cache
+
     def _is_select_by_type(self, message):
         # 筛选特定的消息类型
         if not self.message_types:
@@ -175,12 +267,185 @@ class ExporterBase(ExporterBaseBase):
     def start(self):
         self.run()
 
+    @property
+    def watermark_path(self):
+        return os.path.join(self.origin_path, WATERMARK_FILE)
+
+    def watermark_key(self):
+        # 同一个联系人文件夹下不同导出格式各自记录
+        return type(self).__name__
+
+    def load_watermark(self) -> dict:
+        try:
+            with open(self.watermark_path, 'r', encoding='utf-8') as f:
+                return json.load(f).get(self.watermark_key(), {})
+        except (OSError, ValueError):
+            return {}
+
+    def save_watermark(self, files: dict, **info):
+        """
+        导出完成后记录水位线，下次增量导出从这里开始
+        @param files: 本次导出的文件，{名称: 文件路径}
+        @param info: 各导出格式续写时需要的其他信息
+        @return:
+        """
+        if not self._is_running or self._watermark_sort_seq is None:
+            # 导出被中断或者没有任何消息，保留上次的水位线
+            return
+        try:
+            with open(self.watermark_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        data[self.watermark_key()] = {
+            'sort_seq': self._watermark_sort_seq,
+            'server_ids': [str(server_id) for server_id in self._watermark_server_ids],
+            'files': {name: os.path.relpath(path, self.origin_path) for name, path in files.items()},
+            'time': int(time.time()),
+            **info
+        }
+        tmp_path = self.watermark_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.watermark_path)
+
+    def resolve_output_files(self, **default_files):
+        """
+        确定输出文件：增量导出并且上次的文件都还在时续写上次的文件，否则新建文件并从头导出
+        @param default_files: {名称: 新建时的文件路径}
+        @return: ({名称: 文件路径}, 是否追加写入)
+        """
+        self.watermark = self.load_watermark() if self.incremental else {}
+        self._watermark_sort_seq = self.watermark.get('sort_seq')
+        self._watermark_server_ids = set(self.watermark.get('server_ids', []))
+        old_files = {
+            name: os.path.join(self.origin_path, path) for name, path in self.watermark.get('files', {}).items()
+        }
+        if self.watermark and old_files.keys() == default_files.keys() and all(
+                os.path.isfile(path) for path in old_files.values()):
+            return old_files, True
+        self.reset_watermark()
+        return {name: get_new_filename(path) for name, path in default_files.items()}, False
+
+    def reset_watermark(self):
+        """
+        放弃上次的水位线，从头导出
+        """
+        self.watermark = {}
+        self._watermark_sort_seq = None
+        self._watermark_server_ids = set()
+
+    def count_export_messages(self, start_sort_seq=None) -> int:
+        """
+        查询要导出的消息数量，只查行数不解析消息，流式导出用它计算进度
+        @param start_sort_seq: 增量导出的起点
+        @return: 查询失败时返回0
+        """
+        try:
+            return self.database.get_messages_number(
+                self.contact.wxid, time_range=self.time_range, start_sort_seq=start_sort_seq
+            )
+        except:
+            logger.error(traceback.format_exc())
+            return 0
+
+    def track_progress(self, messages, total_num):
+        """
+        边读取消息边汇报进度，每读取1%（至少1000条）的消息调用一次update_progress_callback
+        导出完成后仍由导出器自己汇报1
+        @param messages: Message的迭代器
+        @param total_num: 消息总数，为0时不汇报
+        @return: Message的迭代器
+        """
+        self.total_num = max(total_num, 1)
+        step = max(total_num // 100, 1000)
+        for index, message in enumerate(messages, 1):
+            self.num = index
+            if total_num and index % step == 0:
+                self.update_progress_callback(min(index / total_num, 1))
+            yield message
+
+    def advance_watermark(self, message):
+        """
+        把本次导出的水位线推进到message
+        """
+        sort_seq = message.sort_seq
+        server_id = str(message.server_id)
+        if self._watermark_sort_seq is None or sort_seq > self._watermark_sort_seq:
+            self._watermark_sort_seq = sort_seq
+            self._watermark_server_ids = {server_id}
+        elif sort_seq == self._watermark_sort_seq:
+            self._watermark_server_ids.add(server_id)
+
+    def iter_export_messages(self, type_: MessageType = None, advance_watermark=True):
+        """
+        流式读取要导出的消息，增量导出时只返回水位线之后的消息，同时记录本次导出的水位线，
+        边读取边汇报进度
+        需要先调用resolve_output_files
+        @param type_: 只读取这种类型的消息（只能查到所有消息的数量，进度会偏小）
+        @param advance_watermark: 为False时读到的消息不推进水位线，由调用者对真正写出的消息调用advance_watermark
+        @return: Message的迭代器
+        """
+        start_sort_seq = self.watermark.get('sort_seq')
+        seen = set(self._watermark_server_ids)
+        total_num = self.count_export_messages(start_sort_seq)
+        if type_ is None:
+            messages = self.database.iter_messages(
+                self.contact.wxid, time_range=self.time_range, start_sort_seq=start_sort_seq
+            )
+        else:
+            messages = self.database.iter_messages_by_type(
+                self.contact.wxid, type_, time_range=self.time_range, start_sort_seq=start_sort_seq
+            )
+        for message in self.track_progress(messages, total_num):
+            sort_seq = message.sort_seq
+            server_id = str(message.server_id)
+            if sort_seq == start_sort_seq and server_id in seen:
+                # 上次已经导出过
+                continue
+            if advance_watermark:
+                self.advance_watermark(message)
+            yield message
+
     def is_5_min(self, timestamp) -> bool:
         if abs(timestamp - self.last_timestamp) > 300:
             self.last_timestamp = timestamp
             return True
         return False
 
+    def copy_media_files(self, file_tasks: List[Tuple[str, str, str]]):
+        """
+        复制视频、文件
+        @param file_tasks: List[(原始文件路径, 输出文件夹, 输出文件名)]
+        @return:
+        """
+        if self.media_store:
+            self.media_store.copy_files(file_tasks, executor=self.io_executor)
+        else:
+            copy_files(file_tasks, executor=self.io_executor)
+
+    def decode_media_images(self, image_tasks: List[Tuple[str, str, str]]):
+        """
+        解密图片
+        @param image_tasks: List[(dat文件路径, 输出文件夹, 输出文件名)]
+        @return:
+        """
+        if self.media_store:
+            self.media_store.decode_images(Me().xor_key, image_tasks, executor=self.cpu_executor)
+        else:
+            batch_decode_image_multiprocessing(Me().xor_key, image_tasks, executor=self.cpu_executor)
+
+    def decode_media_audios(self, audio_tasks: List[Tuple[bytes, str, str]]):
+        """
+        语音转换成mp3
+        @param audio_tasks: List[(silk语音数据, 输出文件夹, 输出文件名)]
+        @return:
+        """
+        if self.media_store:
+            self.media_store.decode_audios(audio_tasks, executor=self.io_executor)
+        else:
+            decode_audios(audio_tasks, executor=self.io_executor)
+
     def save_avatars(self):
         if self.contact.is_chatroom():
             self.group_contacts = self.database.get_chatroom_members(self.contact.wxid)
@@ -190,26 +455,17 @@ class ExporterBase(ExporterBaseBase):
                 Me().wxid: Me(),
                 self.contact.wxid: self.contact
             }
+        # 一次查询所有成员的头像，头像文件在共享的头像文件夹里，已经写过的不再写
+        avatar_paths = self.get_avatar_cache().get_avatar_paths(self.database, self.group_contacts.keys())
         for wxid, contact in self.group_contacts.items():
-            self.save_avatar(contact)
+            contact.avatar_path = avatar_paths.get(wxid, '')
+            self.avatar_paths_dict[wxid] = contact.avatar_path
 
     def save_avatar(self, contact):
-        avatar_buffer = self.database.get_avatar_buffer(contact.wxid)
-        avatar_path = os.path.join(self.origin_path, 'avatar', f'{contact.wxid}.png')
+        avatar_path = self.get_avatar_cache().get_avatar_path(self.database, contact.wxid)
         contact.avatar_path = avatar_path
-        if not avatar_buffer:
-            current_dir = os.path.dirname(os.path.abspath(__file__))
-            # 构建要读取的文件路径
-            file_path = os.path.join(current_dir, 'resources', 'default_avatar.png')
-            with open(file_path, 'rb') as f:
-                avatar_buffer = f.read()
-        try:
-            with open(avatar_path, 'wb') as f:
-                f.write(avatar_buffer)
-        except:
-            logger.error(traceback.format_exc())
-        finally:
-            return avatar_path
+        self.avatar_paths_dict[contact.wxid] = avatar_path
+        return avatar_path
 
     def get_avatar_path(self, message: Message, is_absolute_path=False) -> str | int:
         """
@@ -221,13 +477,11 @@ class ExporterBase(ExporterBaseBase):
         is_send = message.is_sender
         if is_absolute_path:
             # 返回头像的本地绝对路径
-            if message.sender_id in self.group_contacts:
-                avatar = self.group_contacts[message.sender_id].avatar_path
-            else:
-                # 针对那些退群的人，就保存为默认头像
-                contact = self.database.get_contact_by_username(message.sender_id)
-                avatar = self.save_avatar(contact)
-                self.group_contacts[contact.wxid] = contact
+            avatar = self.avatar_paths_dict.get(message.sender_id)
+            if avatar is None:
+                # 针对那些退群的人，不在群成员列表里，从头像缓存里取（没有头像时是默认头像）
+                avatar = self.get_avatar_cache().get_avatar_path(self.database, message.sender_id)
+                self.avatar_paths_dict[message.sender_id] = avatar
         else:
             if self.contact.is_chatroom():
                 avatar = self.avatar_urls_dict[message.sender_id]
@@ -456,47 +710,70 @@ class GroupContactExporter(ExporterBaseBase):
             print('另一个程序正在使用此文件，无法访问。')
 
 
-class CsvAllExporter(ExporterBaseBase):
-    def run(self):
-        filename = QFileDialog.getSaveFileName(None, "save file", os.path.join(os.getcwd(), 'messages.csv'),
-                                               "csv files (*.csv);;all files(*.*)")
-        if not filename[0]:
-            return
-        self.startSignal.emit(1)
-        filename = filename[0]
-        # columns = ["用户名", "消息内容", "发送时间", "发送状态", "消息类型", "isSend", "msgId"]
-        columns = ['localId', 'TalkerId', 'Type', 'SubType',
-                   'IsSender', 'CreateTime', 'Status', 'StrContent',
-                   'StrTime', 'Remark', 'NickName', 'Sender']
-
-        packagemsg = PackageMsg()
-        messages = packagemsg.get_package_message_all()
+def _kernel_copy(source_file, destination_file) -> int:
+    """
+    在内核态完成复制，数据不经过Python进程的用户态缓冲区
+    Linux下优先使用copy_file_range（同一文件系统上还能利用reflink），
+    其余平台交给shutil.copyfile（Linux/macOS会使用sendfile/fcopyfile）
+    @return: 复制的字节数
+    """
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    if copy_file_range is None:
+        shutil.copyfile(source_file, destination_file)
+        return os.path.getsize(destination_file)
+    total = 0
+    with open(source_file, 'rb') as fsrc, open(destination_file, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
         try:
-            # 写入CSV文件
-            with open(filename, mode='w', newline='', encoding='utf-8-sig') as file:
-                writer = csv.writer(file)
-                writer.writerow(columns)
-                # 写入数据
-                writer.writerows(messages)
-        except PermissionError:
-            globalSignals.information.emit('另一个程序正在使用此文件，无法访问。')
-        self.okSignal.emit(self.id)
+            while True:
+                sent = copy_file_range(fsrc.fileno(), fdst.fileno(), max(size - total, 1024 * 1024))
+                if sent == 0:
+                    break
+                total += sent
+        except OSError:
+            if total:
+                raise
+            total = -1
+    if total < 0:
+        # 部分文件系统不支持copy_file_range，回退到普通复制
+        shutil.copyfile(source_file, destination_file)
+        total = os.path.getsize(destination_file)
+    return total
+
+
+def _fast_copy(source_file, destination_file) -> int:
+    """
+    先复制到临时文件，完整复制后再改名成目标文件
+    复制失败或者被中断时删掉临时文件，不会留下不完整的目标文件（copy_file会跳过已经存在的文件）
+    @return: 复制的字节数
+    """
+    tmp_file = destination_file + '.tmp'
+    try:
+        total = _kernel_copy(source_file, tmp_file)
+        shutil.copymode(source_file, tmp_file)
+        os.replace(tmp_file, destination_file)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_file)
+        raise
+    return total
 
 
-def copy_file(source_file, destination_file):
-    if os.path.isfile(source_file) and not os.path.exists(destination_file):
-        try:
-            # logger.info(f'开始复制:{destination_file}')
-            shutil.copy(source_file, destination_file)
-        except:
-            pass
-            # logger.error(traceback.format_exc())
-        finally:
-            print(f'复制:{destination_file}')
-            # logger.info(f'复制:{destination_file}')
+def copy_file(source_file, destination_file) -> int:
+    """
+    复制单个文件
+    @return: 复制的字节数，失败或者跳过返回-1
+    """
+    if not os.path.isfile(source_file) or os.path.exists(destination_file):
+        return -1
+    try:
+        return _fast_copy(source_file, destination_file)
+    except OSError:
+        logger.error(f'复制失败:{destination_file}\n{traceback.format_exc()}')
+        return -1
 
 
-def copy_files(file_tasks: List[Tuple[str, str, str]]):
+def copy_files(file_tasks: List[Tuple[str, str, str]], max_workers=10, executor=None):
     """
 
     :param file_tasks: List[
@@ -504,27 +781,56 @@ def copy_files(file_tasks: List[Tuple[str, str, str]]):
             输出文件夹,
             输出文件名
             )]
-    :return:
+    :param max_workers: 复制线程数
+    :param executor: 共享的线程池，为空时临时创建一个
+    :return: 复制的文件数
     """
     if len(file_tasks) < 1:
-        return
-    futures = []
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        for source_file, output_dir, dst_name in file_tasks:
-            if dst_name:
-                ext = os.path.basename(source_file).split('.')[-1]
-                destination_file = os.path.join(output_dir, f'{dst_name}.{ext}')
-            else:
-                destination_file = os.path.join(output_dir, os.path.basename(source_file))
-            if os.path.exists(destination_file):
-                continue
-            if not os.path.exists(os.path.dirname(destination_file)):
-                os.makedirs(os.path.dirname(destination_file), exist_ok=True)
-            futures.append(executor.submit(copy_file, source_file, destination_file))
+        return 0
+    st = time.time()
+    copy_tasks = []
+    output_dirs = set()
+    for source_file, output_dir, dst_name in file_tasks:
+        if dst_name:
+            ext = os.path.basename(source_file).split('.')[-1]
+            destination_file = os.path.join(output_dir, f'{dst_name}.{ext}')
+        else:
+            destination_file = os.path.join(output_dir, os.path.basename(source_file))
+        copy_tasks.append((source_file, destination_file))
+        output_dirs.add(output_dir)
+    # 每个输出文件夹只创建一次
+    for output_dir in output_dirs:
+        os.makedirs(output_dir, exist_ok=True)
 
-            # 等待所有任务完成
-            for future in futures:
-                future.result()
+    # 限制同时排队的任务数，避免几十万个future同时驻留内存
+    if executor is not None:
+        max_workers = getattr(executor, '_max_workers', max_workers)
+    max_pending = max_workers * 4
+    pending = deque()
+    num_files = 0
+    num_bytes = 0
+    with contextlib.ExitStack() as stack:
+        if executor is None:
+            executor = stack.enter_context(ThreadPoolExecutor(max_workers=max_workers))
+        for source_file, destination_file in copy_tasks:
+            if len(pending) >= max_pending:
+                copied = pending.popleft().result()
+                if copied >= 0:
+                    num_files += 1
+                    num_bytes += copied
+            pending.append(executor.submit(copy_file, source_file, destination_file))
+        # 等待剩余任务完成
+        while pending:
+            copied = pending.popleft().result()
+            if copied >= 0:
+                num_files += 1
+                num_bytes += copied
+    cost = max(time.time() - st, 1e-6)
+    logger.info(
+        f'复制完成：{num_files}/{len(copy_tasks)}个文件，{num_bytes / 1024 / 1024:.2f}MB，'
+        f'耗时{cost:.2f}s，{num_bytes / 1024 / 1024 / cost:.2f}MB/s'
+    )
+    return num_files
 
 
 def get_ffmpeg_path():
@@ -589,7 +895,7 @@ def decode_audio_to_mp3(media_buffer, output_dir, filename):
         return mp3_path
 
 
-def decode_audios(file_tasks: List[Tuple[str, str, str]]):
+def decode_audios(file_tasks: List[Tuple[str, str, str]], executor=None):
     """
 
     :param database:
@@ -598,11 +904,14 @@ def decode_audios(file_tasks: List[Tuple[str, str, str]]):
             输出文件夹,
             输出文件名
             )]
+    :param executor: 共享的线程池，为空时临时创建一个
     :return:
     """
     if len(file_tasks) < 1:
         return
-    with ThreadPoolExecutor(max_workers=10) as executor:
+    with contextlib.ExitStack() as stack:
+        if executor is None:
+            executor = stack.enter_context(ThreadPoolExecutor(max_workers=10))
         futures = []
         for media_buffer, output_dir, dst_name in file_tasks:
             futures.append(executor.submit(decode_audio_to_mp3, media_buffer, output_dir, dst_name))
@@ -612,22 +921,6 @@ def decode_audios(file_tasks: List[Tuple[str, str, str]]):
             future.result()
 
 
-def remove_privacy_info(text):
-    # 正则表达式模式
-    patterns = {
-        'phone': r'\b(\+?86[-\s]?)?1[3-9]\d{9}\b',  # 手机号
-        'email': r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b',  # 邮箱
-        'id_card': r'\b\d{15}|\d{18}|\d{17}X\b',  # 身份证号
-        'password': r'\b(?:password|pwd|pass|psw)[\s=:]*\S+\b',  # 密码
-        'account': r'\b(?:account|username|user|acct)[\s=:]*\S+\b'  # 账号
-    }
-
-    for key, pattern in patterns.items():
-        text = re.sub(pattern, f'[{key} xxx]', text)
-
-    return text
-
-
 def get_new_filename(filename):
     """
     检查给定的文件是否存在，如果存在就加个括号标个号，返回新的文件名
@@ -1,14 +1,41 @@
 import os
-import re
-from collections import defaultdict
+import time
 
 from wxManager import Message
-from exporter.exporter import ExporterBase, get_new_filename, remove_privacy_info
+from wxManager.parser.util.common import Redactor, get_default_redactor
+from exporter.exporter import ExporterBase, CountingWriter, get_new_filename
 
 
 class AiTxtExporter(ExporterBase):
+    """
+    导出给AI阅读的纯文本，按天分段，隐私信息脱敏
+    消息按sort_seq顺序流式读取，日期变化时写入日期标题，每batch_size条消息批量脱敏后写出，
+    内存占用与聊天记录的长度无关
+    """
     last_sender = 'wxid_00112233'
 
+    def __init__(
+            self,
+            database,
+            contact,
+            output_dir,
+            type_,  # 导出文件类型
+            message_types=None,  # 导出的消息类型
+            time_range=None,  # 导出的日期范围
+            group_members: set[str] = None,  # 群聊中只导出这些人的聊天记录
+            progress_callback=None,  # 进度回调函数，func(progress:float)
+            finish_callback=None,  # 导出完成回调函数
+            media_store=None,  # 批量导出时共享的媒体仓库
+            batch_size=1000,  # 每批脱敏、写入的消息数量
+            max_file_size=0,  # 单个txt文件的最大字节数，超过后写入下一个分片文件，0表示不分片
+            redactor: Redactor = None  # 脱敏规则，默认使用内置的隐私信息规则
+    ):
+        super().__init__(database, contact, output_dir, type_, message_types, time_range, group_members,
+                         progress_callback, finish_callback, media_store)  # 调用父类的构造函数
+        self.batch_size = max(batch_size, 1)
+        self.max_file_size = max_file_size
+        self.redactor = redactor or get_default_redactor()
+
     def title(self, message: Message):
         sender = message.sender_id
         display_name = ''
@@ -17,6 +44,17 @@ class AiTxtExporter(ExporterBase):
         self.last_sender = sender
         return display_name
 
+    def shard_filename(self, filename, shard_index):
+        """
+        @param filename: 第一个文件的路径
+        @param shard_index: 分片序号，从0开始
+        @return: 分片文件的路径，第一个分片就是filename本身
+        """
+        if shard_index == 0:
+            return filename
+        name, ext = os.path.splitext(filename)
+        return get_new_filename(f'{name}_{shard_index + 1}{ext}')
+
     def export(self):
         # 实现导出为txt的逻辑
         print(f"【开始导出 TXT {self.contact.remark}】")
@@ -24,28 +62,57 @@ class AiTxtExporter(ExporterBase):
         os.makedirs(origin_path, exist_ok=True)
         filename = os.path.join(origin_path, self.contact.remark + '_chat.txt')
         filename = get_new_filename(filename)
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
-        total_steps = len(messages)
-        # 创建一个默认字典，用于按日期分组
-        grouped_messages = defaultdict(list)
-        # 遍历消息，将其按日期分组
-        for index, message in enumerate(messages):
-            if index and index % 1000 == 0:
-                self.update_progress_callback(index / total_steps)
-            if not self.is_selected(message):
-                continue
-            date_key = message.str_time[:10]  # 以日期作为键
-            # 将消息添加到对应日期的列表中
-            grouped_messages[date_key].append(f'{self.title(message)}{remove_privacy_info(message.to_text())}')
-
-        with open(filename, mode='w', newline='', encoding='utf-8') as f:
-            # 如果需要，可以将结果转换为普通字典
-            grouped_messages = dict(grouped_messages)
-            # 按日期排序并遍历结果
-            for date in sorted(grouped_messages.keys()):
-                msgs = grouped_messages[date]
-                f.write(f"\n\n{'*' * 20}{date}{'*' * 20}\n")
-                f.write('\n'.join(msgs))
+        filenames = [filename]
+        messages = self.track_progress(
+            self.database.iter_messages(self.contact.wxid, time_range=self.time_range),
+            self.count_export_messages()
+        )
+        st = time.time()
+        num = 0
+        f = CountingWriter(filename)
+        current_date = None  # 当前文件中最后写入的日期
+        batch = []  # [(日期, 标题, 发送人, 未脱敏的文本)]
+
+        def flush():
+            nonlocal f, current_date
+            texts = self.redactor.redact_batch([text for _, _, _, text in batch])
+            for (date, title, display_name, _), text in zip(batch, texts):
+                if self.max_file_size and f.bytes_written >= self.max_file_size and date != current_date:
+                    # 只在日期变化时切换分片，同一天的聊天不拆到两个文件里
+                    f.close()
+                    shard_filename = self.shard_filename(filename, len(filenames))
+                    filenames.append(shard_filename)
+                    f = CountingWriter(shard_filename)
+                    current_date = None
+                    # 每个分片单独阅读，第一条消息总是带上发送人
+                    title = title or f'\n{display_name}:'
+                if date != current_date:
+                    f.write(f"\n\n{'*' * 20}{date}{'*' * 20}\n")
+                    current_date = date
+                else:
+                    f.write('\n')
+                f.write(f'{title}{text}')
+            batch.clear()
+
+        try:
+            for index, message in enumerate(messages):
+                if not self._is_running:
+                    break
+                if index and index % 10000 == 0:
+                    self.print_write_progress(index, f.bytes_written, st)
+                if not self.is_selected(message):
+                    continue
+                date = message.str_time[:10]  # 以日期作为分段标题
+                batch.append((date, self.title(message), message.display_name, message.to_text()))
+                num += 1
+                if len(batch) >= self.batch_size:
+                    flush()
+            flush()
+            self.print_write_progress(num, f.bytes_written, st)
+        finally:
+            f.close()
+        if len(filenames) > 1:
+            print(f'共{len(filenames)}个文件：{", ".join(os.path.basename(name) for name in filenames)}')
         self.update_progress_callback(1)
         print(f"【完成导出 TXT {self.contact.remark}】")
         self.finish_callback(self.exporter_id)
@@ -1,12 +1,22 @@
 import csv
+import gzip
+import io
 import os
+import time
+import traceback
 
 from wxManager import Message
+from wxManager.log import logger
 from wxManager.model import Me
-from exporter.exporter import ExporterBase, get_new_filename
+from exporter.config import FileType
+from exporter.exporter import ExporterBase, ExporterBaseBase, CountingWriter, get_new_filename
+
+CSV_BUFFER_SIZE = 4 * 1024 * 1024  # CSV文件的写缓冲区大小
 
 
 class CSVExporter(ExporterBase):
+    supports_incremental = True
+
     def message_to_list(self, message: Message):
         remark = message.display_name
         nickname = message.display_name
@@ -26,24 +36,176 @@ class CSVExporter(ExporterBase):
     def export(self):
         print(f"【开始导出 CSV {self.contact.remark}】")
         os.makedirs(self.origin_path, exist_ok=True)
-        filename = os.path.join(self.origin_path,f"{self.contact.remark}.csv")
-        filename = get_new_filename(filename)
+        files, append = self.resolve_output_files(csv=os.path.join(self.origin_path, f"{self.contact.remark}.csv"))
+        filename = files['csv']
         columns = ['消息ID', '类型', '发送人', '时间', '内容', '备注', '昵称', '更多信息']
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
-        total_steps = len(messages)
-        # 写入CSV文件
-        with open(filename, mode='w', newline='', encoding='utf-8-sig') as file:
+        if self.contact.is_chatroom():
+            self.group_contacts = self.database.get_chatroom_members(self.contact.wxid)
+        st = time.time()
+        # 边读边写，不把整个聊天的消息都加载进内存；增量导出时只追加新消息
+        messages = self.iter_export_messages()
+        num = 0
+        with CountingWriter(filename, buffering=CSV_BUFFER_SIZE, mode='ab' if append else 'wb') as file:
             writer = csv.writer(file)
-            writer.writerow(columns)
-            # 写入数据
-            csv_res = []
+            if not append:
+                file.write('\ufeff')  # utf-8-sig，Excel打开时不乱码
+                writer.writerow(columns)
             for index, message in enumerate(messages):
-                if index and index % 1000 == 0:
-                    self.update_progress_callback(index / total_steps)
+                if not self._is_running:
+                    break
+                if index and index % 10000 == 0:
+                    self.print_write_progress(index, file.bytes_written, st)
                 if not self.is_selected(message):
                     continue
-                csv_res.append(self.message_to_list(message))
-            writer.writerows(csv_res)
+                writer.writerow(self.message_to_list(message))
+                num += 1
+            self.print_write_progress(num, file.bytes_written, st)
+        self.save_watermark(files)
         self.update_progress_callback(1)
         self.finish_callback(self.exporter_id)
         print(f"【完成导出 CSV {self.contact.remark}】")
+
+
+class CsvStream:
+    """
+    CSV输出文件，可选边写边压缩
+    @param filename: 文件路径
+    @param compression: None、'gzip' 或者 'zstd'（需要安装zstandard）
+    """
+
+    def __init__(self, filename, compression=None, encoding='utf-8', buffering=CSV_BUFFER_SIZE):
+        self.raw = open(filename, 'wb', buffering=buffering)
+        self.compressor = None
+        try:
+            if compression == 'gzip':
+                self.compressor = gzip.GzipFile(filename=os.path.basename(filename), fileobj=self.raw, mode='wb',
+                                                compresslevel=6)
+            elif compression == 'zstd':
+                try:
+                    import zstandard
+                except ImportError:
+                    raise ImportError('zstd压缩需要先安装zstandard：pip install zstandard')
+                self.compressor = zstandard.ZstdCompressor(level=3).stream_writer(self.raw, closefd=False)
+            elif compression:
+                raise ValueError(f'不支持的压缩格式：{compression}')
+        except Exception:
+            self.raw.close()
+            raise
+        self.text = io.TextIOWrapper(self.compressor or self.raw, encoding=encoding, newline='')
+
+    @property
+    def bytes_written(self):
+        # 已经落盘的（压缩后的）字节数
+        return self.raw.tell()
+
+    def close(self):
+        self.text.flush()
+        self.text.detach()
+        if self.compressor:
+            # 先关闭压缩流写入文件尾，再关闭文件
+            self.compressor.close()
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class CsvAllExporter(ExporterBaseBase):
+    """
+    把所有会话的聊天记录导出到同一个CSV文件，方便导入数据仓库
+    逐个会话流式读取消息，每条消息只保留数据库里的基本字段，内存占用与消息总数无关
+    """
+    exporter_id = 0
+    columns = ['talker', 'talker_remark', 'local_id', 'server_id', 'sort_seq', 'type', 'type_name', 'is_sender',
+               'sender_id', 'display_name', 'timestamp', 'str_time', 'content']
+
+    def __init__(
+            self,
+            database,
+            output_dir,
+            type_=FileType.CSV_ALL,
+            message_types=None,  # 导出的消息类型
+            time_range=None,  # 导出的日期范围
+            compression=None,  # None、'gzip' 或者 'zstd'
+            progress_callback=None,  # 进度回调函数，func(progress:float)
+            finish_callback=None  # 导出完成回调函数
+    ):
+        super().__init__()
+        self.database = database
+        self.output_dir = os.path.join(output_dir, '聊天记录')
+        self.output_type = type_
+        self.message_types = message_types
+        self.time_range = time_range
+        self.compression = compression
+        self.update_progress_callback = progress_callback or self.print_progress
+        self.finish_callback = finish_callback or self.finish
+
+    def print_progress(self, progress):
+        logger.info(f'导出进度：{progress * 100:.2f}%')
+
+    def finish(self, success):
+        logger.info(f'导出完成\n{"-" * 20}')
+
+    def message_to_row(self, talker, talker_remark, message: Message):
+        try:
+            content = message.to_text()
+        except:
+            content = ''
+        return [
+            talker, talker_remark, message.local_id, message.server_id, message.sort_seq, message.type,
+            message.type_name(), int(message.is_sender), message.sender_id, message.display_name, message.timestamp,
+            message.str_time, content
+        ]
+
+    def get_filename(self):
+        ext = {'gzip': '.gz', 'zstd': '.zst'}.get(self.compression, '')
+        filename = os.path.join(self.output_dir, f'messages.csv{ext}')
+        return get_new_filename(filename)
+
+    def run(self):
+        self.export()
+
+    def start(self):
+        self.run()
+
+    def export(self):
+        print("【开始导出 全部聊天记录 CSV】")
+        os.makedirs(self.output_dir, exist_ok=True)
+        filename = self.get_filename()
+        sessions = self.database.get_session() or []
+        usernames = list(dict.fromkeys(session[0] for session in sessions if session[0]))
+        total_steps = len(usernames)
+        st = time.time()
+        num = 0
+        with CsvStream(filename, self.compression) as stream:
+            writer = csv.writer(stream.text)
+            writer.writerow(self.columns)
+            for session_index, username in enumerate(usernames):
+                if not self._is_running:
+                    break
+                contact = self.database.get_contact_by_username(username)
+                talker_remark = contact.remark if contact else username
+                try:
+                    messages = self.database.iter_messages(username, time_range=self.time_range)
+                    for message in messages:
+                        if self.message_types and message.type not in self.message_types:
+                            continue
+                        writer.writerow(self.message_to_row(username, talker_remark, message))
+                        num += 1
+                        if num % 100000 == 0:
+                            cost = max(time.time() - st, 1e-6)
+                            logger.info(
+                                f'已导出{num}条消息，{num / cost:.0f}条/s，'
+                                f'已写入{stream.bytes_written / 1024 / 1024:.2f}MB'
+                            )
+                except:
+                    logger.error(f'{username} 导出失败\n{traceback.format_exc()}')
+                self.update_progress_callback((session_index + 1) / max(total_steps, 1))
+        cost = max(time.time() - st, 1e-6)
+        logger.info(f'共导出{num}条消息，耗时{cost:.2f}s，{num / cost:.0f}条/s，文件：{filename}')
+        self.update_progress_callback(1)
+        print("【完成导出 全部聊天记录 CSV】")
+        self.finish_callback(self.exporter_id)
@@ -1,6 +1,12 @@
+import contextlib
+import hashlib
 import os
+import shutil
+import tempfile
 import time
 import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from re import findall
 
 import docx
@@ -17,7 +23,6 @@ from wxManager import Me, MessageType
 from exporter.exporter import ExporterBase, get_new_filename
 from wxManager.decrypt.decrypt_dat import decode_dat
 from wxManager.log import logger
-from wxManager.model import QuoteMessage, LinkMessage
 
 # 要删除的编码字符
 encoded_chars = b'\x00\x01\x02\x03\x04\x05\x06\x07\x08\x0b\x0c\x0e\x0f\x10\x11\x12\x13\x14\x15\x16\x17\x18\x19\x1a\x1b\x1c\x1d\x1e\x1f'
@@ -39,23 +44,105 @@ def filter_control_characters(input_string):
     return filtered_string
 
 
-class DocxExporter(ExporterBase):
-    def __init__(
-            self,
-            database,
-            contact,
-            output_dir,
-            type_,  # 导出文件类型
-            message_types: set[MessageType] = None,  # 导出的消息类型
-            time_range=None,  # 导出的日期范围
-            group_members: set[str] = None,  # 群聊中只导出这些人的聊天记录
-            progress_callback=None,  # 进度回调函数，func(progress:float)
-            finish_callback=None,  # 导出完成回调函数
-            msg_num_per_docx=500  # 每个docx文档的消息数量
-    ):
-        super().__init__(database, contact, output_dir, type_, message_types, time_range, group_members,
-                         progress_callback, finish_callback)  # 调用父类的构造函数
-        self.msg_num_per_docx = msg_num_per_docx
+def clean_system_text(str_content):
+    """
+    去掉系统消息里的xml标签
+    """
+    str_content = str_content.replace('<![CDATA[', "").replace(
+        ' <a href="weixin://revoke_edit_click">重新编辑</a>]]>', "")
+    res = findall('(</{0,1}(img|revo|_wc_cus|a).*?>)', str_content)
+    for xmlstr, b in res:
+        str_content = str_content.replace(xmlstr, "")
+    return str_content
+
+
+def resolve_image_path(image_path):
+    """
+    解密后的图片后缀由图片内容决定，按常见后缀查找实际的文件
+    @param image_path: 图片路径，可以不带后缀
+    @return: 存在的图片路径，找不到返回空字符串
+    """
+    if not image_path:
+        return ''
+    if os.path.isfile(image_path):
+        return image_path
+    for ext in ('.jpg', '.png', '.gif', '.jpeg', '.bmp', '.webp'):
+        if os.path.isfile(image_path + ext):
+            return image_path + ext
+    return ''
+
+
+def shrink_image(image_path, output_dir, max_height=400):
+    """
+    图片在文档里只显示2英寸高，提前缩小后再插入，减小文档体积和保存耗时
+    @param image_path: 原图路径
+    @param output_dir: 缩略图文件夹
+    @param max_height: 缩略图最大高度（像素）
+    @return: 缩略图路径，不需要缩小或者处理失败时返回原图路径
+    """
+    try:
+        from PIL import Image as PILImage
+    except ImportError:
+        return image_path
+    try:
+        with PILImage.open(image_path) as img:
+            width, height = img.size
+            if height <= max_height:
+                return image_path
+            img.thumbnail((max(int(width * max_height / height), 1), max_height))
+            thumb_path = os.path.join(output_dir, hashlib.md5(image_path.encode('utf-8')).hexdigest() + '.jpg')
+            # 多个子进程可能同时缩小同一张图片，先写到各自的临时文件再替换，不会读到写了一半的缩略图
+            fd, tmp_path = tempfile.mkstemp(suffix='.jpg', dir=output_dir)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    img.convert('RGB').save(f, 'JPEG', quality=85)
+                os.replace(tmp_path, thumb_path)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.remove(tmp_path)
+                raise
+        return thumb_path
+    except Exception:
+        logger.error(traceback.format_exc())
+        return image_path
+
+
+class DocxRenderer:
+    """
+    把渲染条目写入docx文档，不访问数据库，可以在子进程中使用
+    渲染条目是只包含基本类型的元组，可以直接在进程间传递：
+        ('time', 时间)
+        ('system', 内容)
+        ('text', 头像路径, 是否是自己发送, 内容, 群昵称)
+        ('image', 头像路径, 是否是自己发送, 群昵称, 图片路径)
+        ('quote', 头像路径, 是否是自己发送, 内容, 引用内容)
+        ('link', 头像路径, 是否是自己发送, 标题, 链接, 描述, 应用名)
+    """
+    thumb_dir = ''  # 不为空时图片先缩小到这个文件夹再插入
+
+    def new_document(self):
+        doc = docx.Document()
+        doc.styles["Normal"].font.name = "Cambria"
+        doc.styles["Normal"]._element.rPr.rFonts.set(qn("w:eastAsia"), "宋体")
+        core_properties = doc.core_properties
+        core_properties.author = 'MemoTrace'  # 作者
+        core_properties.comments = 'generated by MemoTrace'  # 注释
+        return doc
+
+    def render(self, doc, item):
+        kind = item[0]
+        if kind == 'time':
+            self.add_system_text(doc, item[1])
+        elif kind == 'system':
+            self.add_system_text(doc, item[1])
+        elif kind == 'text':
+            self.add_text_message(doc, *item[1:])
+        elif kind == 'image':
+            self.add_image_message(doc, *item[1:])
+        elif kind == 'quote':
+            self.add_quote_message(doc, *item[1:])
+        elif kind == 'link':
+            self.add_link_message(doc, *item[1:])
 
     def add_text_in(self, paragraph, content):
         try:
@@ -77,26 +164,14 @@ class DocxExporter(ExporterBase):
             p = content_cell.paragraphs[0]
         doc.add_paragraph()
 
-    def text(self, doc, message):
-        avatar = self.get_avatar_path(message, True)
-        self.add_text_message(doc, avatar, message.is_sender, message.content,
-                              message.display_name if self.contact.is_chatroom() else '')
-
-    def image(self, doc, message):
-        is_send = message.is_sender
-        avatar = self.get_avatar_path(message, True)
-        content = self.create_table(doc, is_send, avatar)
-        if self.contact.is_chatroom():
-            content.paragraphs[0].add_run(message.display_name + '\n')
-        message.set_file_name()
-        image_dir = os.path.join(self.origin_path, 'image')
-        image_path = decode_dat(
-            Me().xor_key,
-            os.path.join(Me().wx_dir, message.path),
-            os.path.join(image_dir, message.str_time[:7]),
-            message.file_name
-        )
-        if image_path and os.path.exists(image_path):
+    def add_image_message(self, doc, avatar_path, is_send, display_name, image_path):
+        content = self.create_table(doc, is_send, avatar_path)
+        if display_name:
+            content.paragraphs[0].add_run(display_name + '\n')
+        image_path = resolve_image_path(image_path)
+        if image_path and self.thumb_dir:
+            image_path = shrink_image(image_path, self.thumb_dir)
+        if image_path:
             try:
                 run = content.paragraphs[0].add_run()
                 run.add_picture(image_path, height=shared.Inches(2))
@@ -114,21 +189,18 @@ class DocxExporter(ExporterBase):
         else:
             content.paragraphs[0].add_run('【图片丢失】')
 
-    def refermsg(self, doc, message: QuoteMessage):
+    def add_quote_message(self, doc, avatar_path, is_send, content, refer_msg):
         """
         处理回复消息
         @param doc:
-        @param message:
+        @param avatar_path: 头像
+        @param is_send: 是否是自己发送的
+        @param content: 回复内容
+        @param refer_msg: 被引用的消息
         @return:
         """
-        is_send = message.is_sender
-        if message.quote_message.type == MessageType.Quote:
-            refer_msg = f'{message.quote_message.display_name}:{message.quote_message.content}'
-        else:
-            refer_msg = f'{message.quote_message.display_name}:{message.quote_message.to_text()}'
-        avatar = self.get_avatar_path(message, True)
-        content_cell = self.create_table(doc, is_send, avatar)
-        self.add_text_in(content_cell.paragraphs[0], message.content)
+        content_cell = self.create_table(doc, is_send, avatar_path)
+        self.add_text_in(content_cell.paragraphs[0], content)
         content_cell.paragraphs[0].font_size = shared.Inches(0.5)
         reply_p = content_cell.add_paragraph()
         self.add_text_in(reply_p, refer_msg)
@@ -150,17 +222,13 @@ class DocxExporter(ExporterBase):
             for cell in table.columns[x].cells:
                 cell.width = Inches(width)
 
-    def link(self, doc, message: LinkMessage):
+    def add_link_message(self, doc, avatar_path, is_send, title, href, description, app_name):
         """
-        处理回复消息
+        处理卡片链接消息
         @param doc:
-        @param message:
         @return:
         """
-        is_send = message.is_sender
-
-        avatar = self.get_avatar_path(message, True)
-        content_cell = self.create_table(doc, is_send, avatar)
+        content_cell = self.create_table(doc, is_send, avatar_path)
         # 创建一个包含两行两列的表格
         # 第一行用于放置标题、内容以及缩略图
         # 第二行合并两列，用于显示应用名
@@ -171,11 +239,11 @@ class DocxExporter(ExporterBase):
         cell_header.merge(table.cell(0, 1))
         # 添加标题
         p_title = cell_header.paragraphs[0]
-        self.add_text_in(p_title, message.title)
+        self.add_text_in(p_title, title)
         run = p_title.runs[0]
         run.font.size = Pt(12)  # 设置字体大小
-        if message.href:
-            r_id = p_title.part.relate_to(message.href, RELATIONSHIP_TYPE.HYPERLINK, is_external=True)  # 关联超链接
+        if href:
+            r_id = p_title.part.relate_to(href, RELATIONSHIP_TYPE.HYPERLINK, is_external=True)  # 关联超链接
 
             hyperlink = OxmlElement('w:hyperlink')
             hyperlink.set(qn('r:id'), r_id)
@@ -187,7 +255,7 @@ class DocxExporter(ExporterBase):
 
         # 添加内容
         cell_content = table.cell(1, 0)
-        self.add_text_in(cell_content.paragraphs[0], message.description)
+        self.add_text_in(cell_content.paragraphs[0], description)
 
         # 第一行右侧单元格：添加缩略图
         cell_right = table.cell(1, 1)
@@ -202,7 +270,7 @@ class DocxExporter(ExporterBase):
         # 第二行：合并两个单元格显示应用名
         cell_app = table.cell(2, 0)
         cell_app.merge(table.cell(2, 1))
-        self.add_text_in(cell_app.paragraphs[0], message.app_name)
+        self.add_text_in(cell_app.paragraphs[0], app_name)
         cell_app.paragraphs[0].paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER  # 应用名居中
         self.delete_paragraph(content_cell.paragraphs[0])
         doc.add_paragraph()
@@ -217,15 +285,6 @@ class DocxExporter(ExporterBase):
         run.font.size = Pt(9)
         # run.font.highlight_color = WD_COLOR_INDEX.GRAY_25
 
-    def system_msg(self, doc, message):
-        str_content = message.content
-        str_content = str_content.replace('<![CDATA[', "").replace(
-            ' <a href="weixin://revoke_edit_click">重新编辑</a>]]>', "")
-        res = findall('(</{0,1}(img|revo|_wc_cus|a).*?>)', str_content)
-        for xmlstr, b in res:
-            str_content = str_content.replace(xmlstr, "")
-        self.add_system_text(doc, str_content)
-
     def delete_paragraph(self, paragraph):
         """删除某一段落"""
         p = paragraph._element
@@ -271,7 +330,105 @@ class DocxExporter(ExporterBase):
         content_cell.vertical_alignment = WD_ALIGN_VERTICAL.CENTER
         return content_cell
 
+
+def render_docx_chunk(items, filename, thumb_dir=''):
+    """
+    在子进程中渲染并保存一个docx文档
+    @param items: 渲染条目列表，见 DocxRenderer
+    @param filename: 文档路径
+    @param thumb_dir: 缩略图文件夹
+    @return: 实际保存的文档路径
+    """
+    renderer = DocxRenderer()
+    renderer.thumb_dir = thumb_dir
+    doc = renderer.new_document()
+    for item in items:
+        try:
+            renderer.render(doc, item)
+        except:
+            logger.error(traceback.format_exc())
+    try:
+        doc.save(filename)
+    except PermissionError:
+        filename = filename[:-len('.docx')] + f'_{str(time.time())}.docx'
+        doc.save(filename)
+    return filename
+
+
+class DocxExporter(ExporterBase, DocxRenderer):
+    def __init__(
+            self,
+            database,
+            contact,
+            output_dir,
+            type_,  # 导出文件类型
+            message_types: set[MessageType] = None,  # 导出的消息类型
+            time_range=None,  # 导出的日期范围
+            group_members: set[str] = None,  # 群聊中只导出这些人的聊天记录
+            progress_callback=None,  # 进度回调函数，func(progress:float)
+            finish_callback=None,  # 导出完成回调函数
+            msg_num_per_docx=500,  # 每个docx文档的消息数量
+            media_store=None,  # 批量导出时共享的媒体仓库
+            processes=1  # 大于1时每个docx文档在单独的进程中渲染、保存
+    ):
+        super().__init__(database, contact, output_dir, type_, message_types, time_range, group_members,
+                         progress_callback, finish_callback, media_store)  # 调用父类的构造函数
+        self.msg_num_per_docx = msg_num_per_docx
+        self.processes = processes
+
+    def message_to_items(self, message, image_tasks=None) -> list:
+        """
+        把一条消息转换成渲染条目
+        @param message:
+        @param image_tasks: 为None时直接解密图片；否则只把解密任务加入列表，由调用者批量解密
+        @return: 渲染条目列表
+        """
+        items = []
+        type_ = message.type
+        if self.is_5_min(message.timestamp):
+            items.append(('time', message.str_time))
+        display_name = message.display_name if self.contact.is_chatroom() else ''
+        if type_ == MessageType.System:
+            items.append(('system', clean_system_text(message.content)))
+        elif type_ == MessageType.Quote:
+            if message.quote_message.type == MessageType.Quote:
+                refer_msg = f'{message.quote_message.display_name}:{message.quote_message.content}'
+            else:
+                refer_msg = f'{message.quote_message.display_name}:{message.quote_message.to_text()}'
+            avatar = self.get_avatar_path(message, True)
+            items.append(('quote', avatar, message.is_sender, message.content, refer_msg))
+        elif type_ == MessageType.Image:
+            avatar = self.get_avatar_path(message, True)
+            message.set_file_name()
+            output_dir = os.path.join(self.origin_path, 'image', message.str_time[:7])
+            if image_tasks is None:
+                image_path = decode_dat(
+                    Me().xor_key,
+                    os.path.join(Me().wx_dir, message.path),
+                    output_dir,
+                    message.file_name
+                )
+            else:
+                image_tasks.append((os.path.join(Me().wx_dir, message.path), output_dir, message.file_name))
+                # 解密后才知道后缀，渲染时再查找
+                image_path = os.path.join(output_dir, message.file_name)
+            items.append(('image', avatar, message.is_sender, display_name, image_path))
+        elif type_ in {MessageType.LinkMessage, MessageType.Applet, MessageType.Music}:
+            avatar = self.get_avatar_path(message, True)
+            items.append(
+                ('link', avatar, message.is_sender, message.title, message.href, message.description, message.app_name)
+            )
+        else:
+            try:
+                avatar = self.get_avatar_path(message, True)
+                items.append(('text', avatar, message.is_sender, message.to_text(), display_name))
+            except:
+                pass
+        return items
+
     def export(self):
+        if self.processes > 1:
+            return self.export_parallel()
         print(f"【开始导出 DOCX {self.contact.remark}】")
         origin_path = self.origin_path
         messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
@@ -280,14 +437,20 @@ class DocxExporter(ExporterBase):
 
         def newdoc():
             nonlocal docx_num, doc
-            doc = docx.Document()
-            doc.styles["Normal"].font.name = "Cambria"
-            doc.styles["Normal"]._element.rPr.rFonts.set(qn("w:eastAsia"), "宋体")
-            core_properties = doc.core_properties
-            core_properties.author = 'MemoTrace'  # 作者
-            core_properties.comments = 'generated by MemoTrace'  # 注释
+            doc = self.new_document()
             docx_num += 1
 
+        def savedoc():
+            filename = os.path.join(origin_path, f"{self.contact.remark}_{docx_num}.docx")
+            filename = get_new_filename(filename)
+            try:
+                doc.save(filename)
+            except PermissionError:
+                filename = os.path.join(origin_path, f"{self.contact.remark}_{docx_num}_{str(time.time())}.docx")
+                doc.save(filename)
+            except:
+                pass
+
         doc = None
         docx_num = 0
         newdoc()
@@ -301,37 +464,79 @@ class DocxExporter(ExporterBase):
             if not self._is_running:
                 break
             selected_msg_cnt += 1
-            type_ = message.type
-            timestamp = message.timestamp
-            if self.is_5_min(timestamp):
-                str_time = message.str_time
-                self.add_system_text(doc, str_time)
-            if type_ == MessageType.System:
-                self.system_msg(doc, message)
-            elif type_ == MessageType.Quote:
-                self.refermsg(doc, message)
-            elif type_ == MessageType.Image:
-                self.image(doc, message)
-            elif type_ in {MessageType.LinkMessage, MessageType.Applet, MessageType.Music}:
-                self.link(doc, message)
-            else:
-                try:
-                    avatar = self.get_avatar_path(message, True)
-                    self.add_text_message(doc, avatar, message.is_sender, message.to_text(),
-                                          message.display_name if self.contact.is_chatroom() else '')
-                except:
-                    pass
-            if selected_msg_cnt % self.msg_num_per_docx == 0 or index == total_steps - 1:
-                filename = os.path.join(origin_path, f"{self.contact.remark}_{docx_num}.docx")
-                filename = get_new_filename(filename)
-                try:
-                    doc.save(filename)
-                except PermissionError:
-                    filename = os.path.join(origin_path, f"{self.contact.remark}_{docx_num}_{str(time.time())}.docx")
-                    doc.save(filename)
-                except:
-                    pass
+            for item in self.message_to_items(message):
+                self.render(doc, item)
+            if selected_msg_cnt % self.msg_num_per_docx == 0:
+                savedoc()
                 newdoc()
+        # 最后一个文档不满msg_num_per_docx条时在这里保存（最后一条消息没有被选中时循环里不会保存）
+        if selected_msg_cnt % self.msg_num_per_docx:
+            savedoc()
         self.update_progress_callback(1)
         print(f"【完成导出 DOCX {self.contact.remark}】")
         self.finish_callback(self.exporter_id)
+
+    def export_parallel(self):
+        """
+        多进程导出：消息流按msg_num_per_docx条切分成互不依赖的文档，
+        主进程只负责把消息转换成渲染条目并批量解密图片，
+        每个文档在进程池里独立渲染、缩小图片并保存；
+        批量导出时使用调度器共享的进程池，没有共享进程池时才创建processes个进程
+        @return:
+        """
+        print(f"【开始导出 DOCX {self.contact.remark}】")
+        messages = self.database.iter_messages(self.contact.wxid, time_range=self.time_range)
+        self.save_avatars()
+        thumb_dir = tempfile.mkdtemp(prefix='wxexport_docx_')
+        items = []
+        image_tasks = []
+        pending = deque()
+        docx_num = 0
+        selected_msg_cnt = 0
+
+        def wait_one():
+            try:
+                pending.popleft().result()
+            except:
+                logger.error(traceback.format_exc())
+
+        def submit_chunk():
+            nonlocal docx_num
+            self.decode_media_images(image_tasks)
+            image_tasks.clear()
+            docx_num += 1
+            filename = os.path.join(self.origin_path, f"{self.contact.remark}_{docx_num}.docx")
+            filename = get_new_filename(filename)
+            # 限制排队中的文档数量，避免渲染条目堆积在内存里
+            while len(pending) >= self.processes * 2:
+                wait_one()
+            pending.append(executor.submit(render_docx_chunk, list(items), filename, thumb_dir))
+            items.clear()
+
+        if self.cpu_executor is not None:
+            # 共享的进程池由调度器负责关闭
+            pool = contextlib.nullcontext(self.cpu_executor)
+        else:
+            pool = ProcessPoolExecutor(max_workers=self.processes)
+        try:
+            with pool as executor:
+                for index, message in enumerate(messages):
+                    if not self._is_running:
+                        break
+                    if index and index % 10000 == 0:
+                        logger.info(f'导出进度：{index}条消息，{docx_num}个文档')
+                    if not self.is_selected(message):
+                        continue
+                    selected_msg_cnt += 1
+                    items.extend(self.message_to_items(message, image_tasks))
+                    if selected_msg_cnt % self.msg_num_per_docx == 0:
+                        submit_chunk()
+                if items:
+                    submit_chunk()
+                while pending:
+                    wait_one()
+        finally:
+            shutil.rmtree(thumb_dir, ignore_errors=True)
+        self.update_progress_callback(1)
+        print(f"【完成导出 DOCX {self.contact.remark}】{docx_num}个文档")
+        self.finish_callback(self.exporter_id)
@@ -1,14 +1,14 @@
-import copy
 import html
 import json
 import math
 import os
 import shutil
+import tempfile
 import time
-from wxManager.decrypt.decrypt_dat import batch_decode_image_multiprocessing
 from wxManager.log import logger
 from wxManager.model import MessageType, Me
-from exporter.exporter import ExporterBase, copy_files, decode_audios, get_new_filename
+from exporter.config import FileType
+from exporter.exporter import ExporterBase, get_new_filename
 
 icon_files = {
     'DOCX': ['doc', 'docx'],
@@ -21,13 +21,197 @@ icon_files = {
 }
 
 
+def dict_to_js(dic: dict):
+    """
+    原地转义消息字典里的字符串，防止JS出现语法错误
+    @param dic: message.to_json()
+    @return:
+    """
+    for key, value in dic.items():
+        if isinstance(value, str):
+            if not value.startswith('http'):
+                dic[key] = html.escape(value)
+        elif isinstance(value, dict):
+            dict_to_js(value)
+    return dic
+
+
+def add_timeline(timeline_data: dict, page_timeline: dict, count, year, month, server_id, items_per_page=100):
+    """
+    把一条消息加入时间轴
+    @param timeline_data: {年: {月: [页码, 该月第一条消息的server_id]}}
+    @param page_timeline: {页码: {'year': 年, 'month': 月}}
+    @param count: 这条消息是第几条（从1开始）
+    @return:
+    """
+    curpage = math.ceil(count / items_per_page)
+    if year not in timeline_data:
+        timeline_data[year] = {}
+    if month not in timeline_data[year]:
+        timeline_data[year][month] = [curpage, str(server_id)]
+    if curpage not in page_timeline:
+        page_timeline[curpage] = {'year': year, 'month': month}
+
+
+PAGED_STATE_FILE = 'state.json'  # 分页模式续写需要的状态，保存在分页文件夹里
+MEDIA_BATCH_SIZE = 5000  # 图片、视频、文件任务攒够这么多就先导出，不在内存里保留整个聊天的媒体任务
+AUDIO_BATCH_SIZE = 500  # 语音数据在内存里，攒够这么多就先转换
+CATEGORIES = ['Image', 'File', 'Link', 'Music', 'Transfer', 'MiniProgram', 'VideoNumber']  # 网页里按分类查看的消息
+
+
+def timeline_from_json(timeline: dict) -> dict:
+    # json的key都是字符串，月份还原成数字
+    return {year: {int(month): value for month, value in months.items()} for year, months in timeline.items()}
+
+
+def page_timeline_from_json(page_timeline: dict) -> dict:
+    return {int(page): value for page, value in page_timeline.items()}
+
+
+def save_paged_state(chunk_dir, state: dict):
+    tmp_path = os.path.join(chunk_dir, PAGED_STATE_FILE + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(chunk_dir, PAGED_STATE_FILE))
+
+
+def load_paged_state(chunk_dir):
+    try:
+        with open(os.path.join(chunk_dir, PAGED_STATE_FILE), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def read_chunk(chunk_dir, chunk_id) -> list:
+    """
+    读取分页文件里的消息，每条消息是单独一行的JSON
+    @return: 每条消息的JSON字符串
+    """
+    with open(os.path.join(chunk_dir, f'chunk_{chunk_id}.js'), 'r', encoding='utf-8') as f:
+        content = f.read()
+    body = content[content.index('[\n') + 2:content.rindex('\n]);')]
+    return body.split(',\n') if body else []
+
+
+class JsonSpill:
+    """
+    边导出边把JSON数组（或对象）的成员写入文件，最后再拼进网页，随消息数量增长的表不在内存里保留
+    成员的格式与json.dumps相同，文件里不含外层的括号
+    """
+
+    def __init__(self, brackets='[]', path=None, state=None):
+        """
+        @param brackets: '[]'表示数组，'{}'表示对象
+        @param path: 保存成员的文件，为None时使用临时文件；分页模式下放在分页文件夹里，续写时接着用
+        @param state: 续写时上次导出完成时的state，为None时从头写
+        """
+        self.brackets = brackets
+        if path is None:
+            self.file = tempfile.TemporaryFile('w+b')
+        elif state:
+            self.file = open(path, 'r+b')
+            # 去掉上次导出完成之后（例如导出被中断时）写入的内容
+            self.file.truncate(state[1])
+            self.file.seek(0, os.SEEK_END)
+        else:
+            self.file = open(path, 'w+b')
+        self.size = state[0] if state else 0  # 成员数量
+
+    @property
+    def state(self):
+        """
+        @return: [成员数量, 字节数]，续写时传给构造函数
+        """
+        self.file.flush()
+        return [self.size, self.file.tell()]
+
+    def _write(self, member: str):
+        if self.size:
+            self.file.write(b', ')
+        self.file.write(member.encode('utf-8'))
+        self.size += 1
+
+    def append(self, value):
+        self._write(json.dumps(value))
+
+    def set(self, key, value):
+        self._write(f'{json.dumps(key)}: {json.dumps(value)}')
+
+    def write_to(self, f):
+        """
+        @param f: 文本模式打开的输出文件
+        """
+        f.write(self.brackets[0])
+        self.file.seek(0)
+        # json.dumps会转义非ASCII字符，按块解码不会截断多字节字符
+        for block in iter(lambda: self.file.read(1024 * 1024), b''):
+            f.write(block.decode('utf-8'))
+        f.write(self.brackets[1])
+        self.file.seek(0, os.SEEK_END)
+
+    def close(self):
+        self.file.close()
+
+
+def write_template(f, template: str, spilled: dict):
+    """
+    写入模板，模板里的占位符用JsonSpill里的内容替换，不用把大对象整个拼成字符串
+    @param f: 输出文件
+    @param template: 模板
+    @param spilled: {占位符: JsonSpill}
+    @return:
+    """
+    while True:
+        positions = [(template.find(key), key) for key in spilled if key in template]
+        if not positions:
+            break
+        position, key = min(positions)
+        f.write(template[:position])
+        spilled[key].write_to(f)
+        template = template[position + len(key):]
+    f.write(template)
+
+
 class HtmlExporter(ExporterBase):
+    supports_incremental = True
+
+    @classmethod
+    def can_export_incrementally(cls, **kwargs) -> bool:
+        return bool(kwargs.get('paged'))
+
+    def __init__(
+            self,
+            database,
+            contact,
+            output_dir,
+            type_=FileType.HTML,  # 导出文件类型
+            message_types: set[MessageType] = None,  # 导出的消息类型
+            time_range=None,  # 导出的日期范围
+            group_members: set[str] = None,  # 群聊中只导出这些人的聊天记录
+            progress_callback=None,  # 进度回调函数，func(progress:float)
+            finish_callback=None,  # 导出完成回调函数
+            media_store=None,  # 批量导出时共享的媒体仓库
+            paged=False,  # 分页模式，消息按页写入单独的js文件，由网页按需加载
+            incremental=False  # 增量导出，只有分页模式支持
+    ):
+        if incremental and not paged:
+            raise ValueError('只有分页模式的HTML支持增量导出')
+        super().__init__(database, contact, output_dir, type_, message_types, time_range, group_members,
+                         progress_callback, finish_callback, media_store, incremental)  # 调用父类的构造函数
+        self.paged = paged
 
     def export(self):
         print(f"【开始导出 HTML {self.contact.remark}】")
         f_name = '.html'
         filename = os.path.join(self.origin_path, f'{self.contact.remark}{f_name}')
-        filename = get_new_filename(filename)
+        if self.paged:
+            # 分页模式的网页里不含消息，消息都在分页文件里，可以续写
+            files, append = self.resolve_output_files(html=filename)
+            filename = files['html']
+        else:
+            files, append = {}, False
+            filename = get_new_filename(filename)
         # 获取当前脚本的目录
         current_dir = os.path.dirname(os.path.abspath(__file__))
         # 构建要读取的文件路径
@@ -36,7 +220,41 @@ class HtmlExporter(ExporterBase):
         with open(file_path, "r", encoding="utf-8") as f:
             content = f.read()
             html_head, html_end = content.split('/*注意看这是分割线*/')
-        f = open(filename, 'w', encoding='utf-8')
+        # 分页模式下每页消息单独保存为 <html文件名>_files/chunk_<页码-1>.js
+        chunk_dir_name = os.path.splitext(os.path.basename(filename))[0] + '_files'
+        chunk_dir = os.path.join(self.origin_path, chunk_dir_name)
+        chunk_data = []
+        state = load_paged_state(chunk_dir) if append else None
+        if append and (state is None or 'spills' not in state or not os.path.isfile(filename + '.json') or not all(
+                os.path.isfile(os.path.join(chunk_dir, f'{name}.part')) for name in state['spills'])):
+            # 续写需要的状态丢失了，重新导出
+            self.reset_watermark()
+            state = None
+            append = False
+            filename = get_new_filename(filename)
+            files = {'html': filename}
+            chunk_dir_name = os.path.splitext(os.path.basename(filename))[0] + '_files'
+            chunk_dir = os.path.join(self.origin_path, chunk_dir_name)
+        if self.paged:
+            os.makedirs(chunk_dir, exist_ok=True)
+        # 一边解析一边写入，消息的JSON不在内存里保留
+        f = open(filename, 'w', encoding='utf-8', buffering=1024 * 1024)
+        if append:
+            # 回到上次导出完成时的位置并去掉结尾的 "\n]"，接着写新消息
+            with open(filename + '.json', 'rb+') as old_json_f:
+                old_json_f.truncate(state['json_size'] - 2)
+            json_f = open(filename + '.json', 'a', encoding='utf-8', buffering=1024 * 1024)
+        else:
+            json_f = open(filename + '.json', 'w', encoding='utf-8', buffering=1024 * 1024)
+
+        def write_chunk():
+            chunk_id = (msg_index - 1) // itemsPerPage
+            with open(os.path.join(chunk_dir, f'chunk_{chunk_id}.js'), 'w', encoding='utf-8') as chunk_f:
+                chunk_f.write(f'loadChatChunk({chunk_id}, [\n')
+                chunk_f.write(',\n'.join(chunk_data))
+                chunk_f.write('\n]);')
+            chunk_data.clear()
+
         html_head = html_head.replace("<title>出错了</title>", f"<title>{self.contact.remark}</title>")
         html_head = html_head.replace("<p id=\"title\">出错了</p>", f"<p id=\"title\">{self.contact.remark}</p>")
         # avatar_urls, avatar_paths = self.get_avatar_urls()
@@ -46,29 +264,40 @@ class HtmlExporter(ExporterBase):
         html_head = html_head.replace("{{avatarUrls}}", json.dumps(avatar_urls)).replace('{{wxid}}',
                                                                                          f'"{self.contact.wxid}"')
         f.write(html_head)
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
+        if not self.paged:
+            f.write('[\n')
+        if not append:
+            json_f.write('[\n')
+        # 两种模式都是流式读取，内存占用与聊天记录的长度无关
+        messages = self.iter_export_messages()
+        st = time.time()
 
         # QMe().save_avatar(self.origin_path + '/avatar/' + Me().wxid + '.png')
         # self.contact.save_avatar(self.origin_path + '/avatar/' + self.contact.wxid + '.png')
         date_id_map = {}
         timelineData = {}
         PageTimeline = {}
-        server_id_Page = {}
-        server_id_Idx = {}
-
-        AllIndex = []
-        ImageIndex = []
-        FileIndex = []
-        LinkIndex = []
-        MusicIndex = []
-        TransferIndex = []
-        MiniProgramIndex = []
-        VideoNumberIndex = []
         dateDataMap = {}
-        i = 0
+        spill_states = state['spills'] if state else {}
+
+        def new_spill(name, brackets):
+            if not self.paged:
+                return JsonSpill(brackets)
+            # 分页模式下续写时还要用到，保存在分页文件夹里
+            return JsonSpill(brackets, os.path.join(chunk_dir, f'{name}.part'), spill_states.get(name))
+
+        # 这些表随消息数量增长，边导出边写到文件里，最后拼进网页（分页模式下server_id_Idx写进server_id.js）
+        category_indexes = {name: new_spill(f'{name}Index', '[]') for name in CATEGORIES}
+        server_id_Idx = new_spill('server_id_Idx', '{}')
+        spilled = {f'{{{{{name}Index}}}}': category_index for name, category_index in category_indexes.items()}
+        if not self.paged:
+            spilled['{{server_id_Page}}'] = JsonSpill('{}')
+            spilled['{{server_id_Idx}}'] = server_id_Idx
+        # 分页模式下网页拿不到全部消息，各个分类的时间轴需要提前算好
+        category_timelines = {name: [{}, {}] for name in CATEGORIES}
+        first_timestamp = 0
+        last_timestamp = 0
         itemsPerPage = 100
-        num = 1
-        html_json = []
         image_tasks = []
         video_tasks = []
         file_tasks = []
@@ -77,9 +306,31 @@ class HtmlExporter(ExporterBase):
         video_dir = os.path.join(self.origin_path, 'video')
         audio_dir = os.path.join(self.origin_path, 'voice')
         file_dir = os.path.join(self.origin_path, 'file')
-        total_steps = len(messages)
         select_msg_cnt = 0  # 要导出的消息数量
         msg_index = 0
+        if state:
+            # 接着上次导出的状态继续
+            msg_index = select_msg_cnt = state['msg_index']
+            category_timelines = {
+                name: [timeline_from_json(timeline), page_timeline_from_json(page_timeline)]
+                for name, (timeline, page_timeline) in state['category_timelines'].items()
+            }
+            timelineData = timeline_from_json(state['timelineData'])
+            PageTimeline = page_timeline_from_json(state['PageTimeline'])
+            dateDataMap = state['dateDataMap']
+            first_timestamp = state['first_timestamp']
+            last_timestamp = state['last_timestamp']
+            if msg_index % itemsPerPage:
+                # 最后一页没写满，读回来接着写
+                chunk_data.extend(read_chunk(chunk_dir, (msg_index - 1) // itemsPerPage)[:msg_index % itemsPerPage])
+
+        def export_media():
+            # 媒体任务攒够一批就导出，不在内存里保留整个聊天的媒体任务
+            self.decode_media_images(image_tasks)
+            self.copy_media_files(video_tasks + file_tasks)
+            self.decode_media_audios(audio_tasks)
+            for task_list in (image_tasks, video_tasks, file_tasks, audio_tasks):
+                task_list.clear()
 
         def parser_merged(merged_message):
             for msg in merged_message.messages:
@@ -129,14 +380,15 @@ class HtmlExporter(ExporterBase):
         for index, message in enumerate(messages):
             if not self._is_running:
                 break
-            if index and index % 1000 == 0:
-                self.update_progress_callback(index / total_steps)
+            if index and index % 10000 == 0:
+                self.print_write_progress(index, f.tell() + json_f.tell(), st)
             type_ = message.type
             if not self.is_selected(message):
                 continue
             server_id = message.server_id
+            category = None
             if type_ == MessageType.Image:
-                ImageIndex.append(msg_index)
+                category = 'Image'
                 message.set_file_name()
                 image_tasks.append(
                     (
@@ -155,7 +407,7 @@ class HtmlExporter(ExporterBase):
                 message.path = f"./image/{message.str_time[:7]}/{message.file_name}"
                 message.thumb_path = f"./image/{message.str_time[:7]}/{message.file_name + '_t'}"
             elif type_ == MessageType.File:
-                FileIndex.append(msg_index)
+                category = 'File'
                 origin_file_path = os.path.join(Me().wx_dir, message.path)
                 file_tasks.append(
                     (
@@ -167,7 +419,7 @@ class HtmlExporter(ExporterBase):
                 if os.path.isfile(origin_file_path):
                     message.path = f'./file/{message.str_time[:7]}/{os.path.basename(origin_file_path)}'
             elif type_ == MessageType.Video:
-                ImageIndex.append(msg_index)
+                category = 'Image'
                 message.set_file_name()
                 video_tasks.append(
                     (
@@ -189,20 +441,43 @@ class HtmlExporter(ExporterBase):
                 )
                 message.path = f'./voice/{message.str_time[:7]}/{message.file_name + ".mp3"}'
             elif type_ == MessageType.LinkMessage or type_ == MessageType.LinkMessage2 or type_ == MessageType.LinkMessage4 or type_ == MessageType.LinkMessage5 or type_ == MessageType.LinkMessage6:
-                LinkIndex.append(msg_index)
+                category = 'Link'
             elif type_ == MessageType.Music:
-                MusicIndex.append(msg_index)
+                category = 'Music'
             elif type_ == MessageType.Transfer:
-                TransferIndex.append(msg_index)
+                category = 'Transfer'
             elif type_ == MessageType.Applet or type_ == MessageType.Applet2:
-                MiniProgramIndex.append(msg_index)
+                category = 'MiniProgram'
             elif type_ == MessageType.WeChatVideo:
-                VideoNumberIndex.append(msg_index)
+                category = 'VideoNumber'
             elif type_ == MessageType.MergedMessages:
                 parser_merged(message)
+            if category:
+                category_indexes[category].append(msg_index)
+            if len(image_tasks) + len(video_tasks) + len(file_tasks) >= MEDIA_BATCH_SIZE or \
+                    len(audio_tasks) >= AUDIO_BATCH_SIZE:
+                export_media()
+            msg_json = message.to_json()
+            if msg_index:
+                json_f.write(',\n')
+            # 先写原始数据，再转义后写入HTML
+            json_f.write(json.dumps(msg_json, ensure_ascii=False))
+            if self.paged:
+                chunk_data.append(json.dumps(dict_to_js(msg_json), ensure_ascii=False))
+            else:
+                if msg_index:
+                    f.write(',\n')
+                f.write(json.dumps(dict_to_js(msg_json), ensure_ascii=False))
+            if self.paged and category:
+                add_timeline(*category_timelines[category], category_indexes[category].size,
+                             message.str_time[:4], int(message.str_time[5:7]), server_id, itemsPerPage)
+            if not first_timestamp:
+                first_timestamp = message.timestamp
+            last_timestamp = message.timestamp
             msg_index += 1
+            if self.paged and len(chunk_data) >= itemsPerPage:
+                write_chunk()
             is_select = True
-            html_json.append(message.to_json())
             if is_select:
                 select_msg_cnt += 1
                 # 把时间戳转换为格式化时间
@@ -228,70 +503,79 @@ class HtmlExporter(ExporterBase):
                     PageTimeline[curpage]['year'] = year
                     PageTimeline[curpage]['month'] = month
 
-                server_id_Page[str(server_id)] = curpage
-                server_id_Idx[str(server_id)] = select_msg_cnt - 1
-
-        # print(image_tasks)
-        # print(file_tasks)
-        # print(video_tasks)
-        # print(audio_tasks)
-        logger.info('解析图片')
-        # 使用多进程，导出所有图片
-        batch_decode_image_multiprocessing(Me().xor_key, image_tasks)
-        print('开始复制文件')
-        logger.info(f'开始复制{len(video_tasks + file_tasks)}')
-        # 使用多线程，复制文件、视频到导出文件夹
-        copy_files(video_tasks + file_tasks)
-        print('开始导出语音')
-        logger.info('开始导出语音')
-        decode_audios(audio_tasks)
-
-        AllIndex = list(range(len(html_json)))
+                server_id_Idx.set(str(server_id), select_msg_cnt - 1)
+                if not self.paged:
+                    spilled['{{server_id_Page}}'].set(str(server_id), curpage)
+
+        if self.paged:
+            if chunk_data:
+                write_chunk()
+            with open(os.path.join(chunk_dir, 'server_id.js'), 'w', encoding='utf-8') as server_id_f:
+                server_id_f.write('loadServerIdMap(')
+                server_id_Idx.write_to(server_id_f)
+                server_id_f.write(');')
+            # 网页里只放一个空数组，消息按需加载
+            f.write(f'new Array({msg_index})')
+        else:
+            f.write('\n]')
+        json_f.write('\n]')
+        json_f.close()
+        if self.paged:
+            # 在加入总时间轴之前记下续写需要的状态
+            paged_state = {
+                'msg_index': msg_index,
+                'json_size': os.path.getsize(filename + '.json'),
+                'spills': {
+                    **{f'{name}Index': category_index.state for name, category_index in category_indexes.items()},
+                    'server_id_Idx': server_id_Idx.state,
+                },
+                'category_timelines': dict(category_timelines),
+                'timelineData': timelineData,
+                'PageTimeline': PageTimeline,
+                'dateDataMap': dateDataMap,
+                'first_timestamp': first_timestamp,
+                'last_timestamp': last_timestamp,
+            }
+
+        logger.info('导出剩余的图片、视频、文件和语音')
+        export_media()
+
+        if self.paged:
+            category_timelines['All'] = [timelineData, PageTimeline]
+            paged_config = {
+                'dir': f'./{chunk_dir_name}',
+                'chunkSize': itemsPerPage,
+                'startTimestamp': first_timestamp,
+                'endTimestamp': last_timestamp,
+                'timelines': category_timelines
+            }
+        else:
+            paged_config = None
+        # AllIndex 就是0到消息数量-1，交给网页自己生成
+        html_end = html_end.replace("{{AllIndex}}", f'Array.from({{length: {msg_index}}}, (_, i) => i)')
 
         replace_map = {
             "{{timelineData}}": timelineData,
             "{{PageTimeline}}": PageTimeline,
-            "{{server_id_Page}}": server_id_Page,
-            "{{server_id_Idx}}": server_id_Idx,
+            # 分页模式下这两个表放在 server_id.js 里异步加载
+            "{{server_id_Page}}": {},
+            "{{server_id_Idx}}": {},
             "{{dateDataMap}}": dateDataMap,
-            "{{AllIndex}}": AllIndex,
-            "{{ImageIndex}}": ImageIndex,
-            "{{FileIndex}}": FileIndex,
-            "{{LinkIndex}}": LinkIndex,
-            "{{MusicIndex}}": MusicIndex,
-            "{{TransferIndex}}": TransferIndex,
-            "{{MiniProgramIndex}}": MiniProgramIndex,
-            "{{VideoNumberIndex}}": VideoNumberIndex
+            "{{pagedConfig}}": paged_config
         }
 
-        def dict_to_js(dic: dict):
-            for key, value in dic.items():
-                if isinstance(value, str):
-                    if value.startswith('http'):
-                        dic[key] = value
-                    else:
-                        dic[key] = html.escape(value)
-                elif isinstance(value, dict):
-                    dic[key] = dict_to_js(value)
-            return dic
-
-        print('开始字符串转义')
-        logger.info('开始字符串转义')
-        # 字符串转义，防止JS出现语法错误
-        html_data = []
-        for item in copy.deepcopy(html_json):
-            html_data.append(dict_to_js(item))
-
-        f.write(json.dumps(html_data, ensure_ascii=False, indent=4))
         for key, value in replace_map.items():
-            html_end = html_end.replace(key, json.dumps(value))
+            if key not in spilled:
+                html_end = html_end.replace(key, json.dumps(value))
 
-        f.write(html_end)
+        write_template(f, html_end, spilled)
+        for spill in [*spilled.values(), server_id_Idx]:
+            spill.close()
         f.close()
-
-        with open(filename + '.json', 'w', encoding='utf-8') as f:
-            json.dump(html_json, f, ensure_ascii=False, indent=4)
+        if self.paged and self._is_running:
+            save_paged_state(chunk_dir, paged_state)
+            self.save_watermark(files)
 
         self.update_progress_callback(1)
-        print(f"【完成导出 HTML {self.contact.remark}】{len(messages)}")
+        print(f"【完成导出 HTML {self.contact.remark}】{msg_index}")
         self.finish_callback(self.exporter_id)
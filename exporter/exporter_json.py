@@ -1,9 +1,12 @@
+import itertools
 import json
 import random
 import os
+import time
+from collections import deque
 
 from wxManager import Me, MessageType
-from exporter.exporter import ExporterBase, remove_privacy_info, get_new_filename
+from exporter.exporter import ExporterBase, CountingWriter, remove_privacy_info
 
 
 class JsonStrategy:
@@ -20,6 +23,7 @@ class AssistantUser:
 class JsonConfig:
     prompt: str = ''
     shuffle: bool = True  # 是否随机打乱数据
+    shuffle_buffer_size: int = 10000  # 打乱数据时缓存的样本数量，越大越接近完全随机
     train_ratio: int = 80  # 训练集占比（百分比）
     model: str = 'Alpaca'  # 可选：GLM4，ChatGLM3
     model_keys = {
@@ -77,6 +81,53 @@ def merge_content(conversions_list) -> list:
     return merged_data
 
 
+class PeekableIterator:
+    """
+    可以查看下一个元素的迭代器，用于在消息流上向前看一条消息
+    """
+    _end = object()
+
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self._next = next(self._iterator, self._end)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._next is self._end:
+            raise StopIteration
+        value = self._next
+        self._next = next(self._iterator, self._end)
+        return value
+
+    def peek(self):
+        """
+        @return: 下一个元素，没有时返回None
+        """
+        return None if self._next is self._end else self._next
+
+
+def shuffle_buffered(iterable, buffer_size=10000):
+    """
+    用固定大小的缓冲区打乱数据流：缓冲区满了之后每来一条数据，就随机换出缓冲区中的一条
+    内存占用只与buffer_size有关，buffer_size不小于数据总量时等价于完全打乱
+    @param iterable:
+    @param buffer_size:
+    @return:
+    """
+    buffer = []
+    for item in iterable:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        i = random.randrange(buffer_size)
+        yield buffer[i]
+        buffer[i] = item
+    random.shuffle(buffer)
+    yield from buffer
+
+
 def is_first_msg(conversions):
     if not conversions:
         return True
@@ -98,6 +149,8 @@ def conversion_to_history(conversations):
 
 
 class JsonExporter(ExporterBase):
+    supports_incremental = True
+
     def __init__(
             self,
             database,
@@ -109,10 +162,12 @@ class JsonExporter(ExporterBase):
             group_members: set[str] = None,  # 群聊中只导出这些人的聊天记录
             progress_callback=None,  # 进度回调函数，func(progress:float)
             finish_callback=None,  # 导出完成回调函数
-            json_config: JsonConfig = None
+            json_config: JsonConfig = None,
+            media_store=None,  # 批量导出时共享的媒体仓库
+            incremental=False  # 增量导出，新的训练数据追加到上次的jsonl文件
     ):
         super().__init__(database, contact, output_dir, type_, message_types, time_range, group_members,
-                         progress_callback, finish_callback)  # 调用父类的构造函数
+                         progress_callback, finish_callback, media_store, incremental)  # 调用父类的构造函数
         if json_config:
             self.json_config: JsonConfig = json_config
         else:
@@ -164,110 +219,119 @@ class JsonExporter(ExporterBase):
             return []
         return merge_content(conversions)
 
+    def iter_text_messages(self):
+        # 末尾不够一组的消息会被丢掉，下次增量导出时还要和新消息组成一组，水位线只推进到分好组的消息（emitted_groups）
+        return self.iter_export_messages(MessageType.Text, advance_watermark=False)
+
+    def emitted_groups(self, groups):
+        """
+        把水位线推进到每个分组的消息
+        """
+        for group in groups:
+            for message in group:
+                self.advance_watermark(message)
+            yield group
+
     def split_by_time(self, length=300):
         """
         通过第一条消息和最后一条消息的时间间隔分割数据集
         @param length:
-        @return:
+        @return: 消息分组的生成器
         """
-        messages = self.database.get_messages_by_type(self.contact.wxid, type_=MessageType.Text,
-                                                      time_range=self.time_range)
+        messages = PeekableIterator(self.iter_text_messages())
         start_time = 0
-        res = []
-        i = 0
-        while i < len(messages):
-            message = messages[i]
-            timestamp = message.timestamp
-            is_send = message.is_sender
+        while messages.peek():
             group = []
-            while i < len(messages) and timestamp - start_time < length:
-                group.append(message)
-                i += 1
-                if i >= len(messages):
-                    break
-                message = messages[i]
-                timestamp = message.timestamp
-                is_send = message.is_sender
-            while not self.is_user(is_send):
-                group.append(message)
-                i += 1
-                if i >= len(messages):
-                    break
-                message = messages[i]
-                timestamp = message.timestamp
-                is_send = message.is_sender
-            start_time = timestamp
+            while messages.peek() and messages.peek().timestamp - start_time < length:
+                group.append(next(messages))
+            while messages.peek() and not self.is_user(messages.peek().is_sender):
+                group.append(next(messages))
+            if messages.peek():
+                start_time = messages.peek().timestamp
             if len(group) > 4:
-                res.append(group)
-        return res
+                yield group
 
     def split_by_intervals(self, max_diff_seconds=300):
         """
         通过相邻两条消息的时间间隔分割数据集
         @param max_diff_seconds:
-        @return:
+        @return: 消息分组的生成器
         """
-        messages = self.database.get_messages_by_type(self.contact.wxid, type_=MessageType.Text,
-                                                      time_range=self.time_range)
-        res = []
-        i = 0
-        current_group = []
-        while i < len(messages):
-            message = messages[i]
-            timestamp = message.timestamp
-            is_send = message.is_sender
-            while not self.is_user(is_send) and i + 1 < len(messages):
-                i += 1
-                message = messages[i]
-                is_send = message.is_sender
-            current_group = [messages[i]]
-            i += 1
-            while i < len(messages) and messages[i].timestamp - current_group[-1].timestamp <= max_diff_seconds:
-                current_group.append(messages[i])
-                i += 1
-            while i < len(messages) and not self.is_user(messages[i].is_sender):
-                current_group.append(messages[i])
-                i += 1
+        messages = PeekableIterator(self.iter_text_messages())
+        while messages.peek():
+            message = next(messages)
+            # 跳过开头assistant发送的消息，最后一条消息除外
+            while not self.is_user(message.is_sender) and messages.peek():
+                message = next(messages)
+            current_group = [message]
+            while messages.peek() and messages.peek().timestamp - current_group[-1].timestamp <= max_diff_seconds:
+                current_group.append(next(messages))
+            while messages.peek() and not self.is_user(messages.peek().is_sender):
+                current_group.append(next(messages))
             if len(current_group) > 4:
-                res.append(current_group)
-        return res
+                yield current_group
 
     def split_by_window(self, window_size=10, step=3):
         """
-        滑动窗口切分数据集
+        滑动窗口切分数据集，只缓存当前窗口内的消息
         @param window_size:
         @param step:
-        @return:
+        @return: 消息分组的生成器
         """
-        messages = self.database.get_messages_by_type(self.contact.wxid, type_=MessageType.Text,
-                                                      time_range=self.time_range)
-        res = []
-        i = 0
-        while i < len(messages):
-            message = messages[i]
-            timestamp = message.timestamp
-            is_send = message.is_sender
-            current_group = []
-            j = i
-            while not self.is_user(is_send) and j + 1 < len(messages) and j - i < window_size:
-                j += 1
-                message = messages[j]
-                is_send = message.is_sender
-            current_group = [messages[j]]
-            j += 1
-            while j < len(messages) and j - i < window_size:
-                current_group.append(messages[j])
+        messages = self.iter_text_messages()
+        window = deque()
+
+        def fill():
+            # 多缓存一条，窗口内没有user消息时分组从窗口后的第一条消息开始
+            for message in itertools.islice(messages, window_size + 1 - len(window)):
+                window.append(message)
+
+        fill()
+        while window:
+            j = 0
+            while not self.is_user(window[j].is_sender) and j + 1 < len(window) and j < window_size:
                 j += 1
-            res.append(current_group)
-            i += step
-        return res
+            yield [window[j], *itertools.islice(window, j + 1, window_size)]
+            skip = step
+            while skip and window:
+                window.popleft()
+                skip -= 1
+            if skip:
+                # 步长大于窗口时，窗口之间的消息直接跳过
+                deque(itertools.islice(messages, skip), maxlen=0)
+            fill()
+
+    def group_to_sample(self, group):
+        """
+        把一组消息转换成一条训练数据
+        @param group:
+        @return: 训练数据，没有有效对话时返回None
+        """
+        conversations = self.message_to_conversion(group)
+        if not conversations:
+            return None
+        if self.json_config.model == 'Alpaca':
+            has_system_prompt = conversations[0].get('role') == 'system'
+            return {
+                'system': conversations[0].get('content') if has_system_prompt else '',
+                'instruction': conversations[-2].get('content'),
+                'input': '',
+                'output': conversations[-1].get('content'),
+                'history': conversion_to_history(conversations),
+            }
+        return {
+            self.json_config.get_model_keys(): conversations
+        }
 
     def export(self):
         print(f"【开始导出 json {self.contact.remark}】")
         origin_path = self.origin_path
-        filename = os.path.join(origin_path, f"{self.contact.remark}.json")
-        filename = get_new_filename(filename)
-        messages_groups = []
+        files, append = self.resolve_output_files(
+            train=os.path.join(origin_path, f"{self.contact.remark}_train.jsonl"),
+            dev=os.path.join(origin_path, f"{self.contact.remark}_dev.jsonl")
+        )
+        mode = 'ab' if append else 'wb'
+        messages_groups = iter(())
         match self.json_config.strategy:
             case JsonStrategy.SPLIT_BY_INTERVALS:
                 messages_groups = self.split_by_intervals(self.json_config.intervals)
@@ -275,31 +339,25 @@ class JsonExporter(ExporterBase):
                 messages_groups = self.split_by_time(self.json_config.span)
             case JsonStrategy.SLIDING_WINDOW:
                 messages_groups = self.split_by_window(self.json_config.window_size, self.json_config.step)
-        dataset = []
-        self.update_progress_callback(0.5)
-        for group in messages_groups:
-            conversations = self.message_to_conversion(group)
-            if conversations:
-                if self.json_config.model == 'Alpaca':
-                    has_system_prompt = conversations[0].get('role') == 'system'
-                    dataset.append(
-                        {
-                            'system': conversations[0].get('content') if has_system_prompt else '',
-                            'instruction': conversations[-2].get('content'),
-                            'input': '',
-                            'output': conversations[-1].get('content'),
-                            'history': conversion_to_history(conversations),
-                        }
-                    )
-                else:
-                    dataset.append({
-                        self.json_config.get_model_keys(): conversations
-                    })
+        messages_groups = self.emitted_groups(messages_groups)
+        samples = (sample for sample in map(self.group_to_sample, messages_groups) if sample)
         if self.json_config.shuffle:
-            # 打乱列表顺序
-            random.shuffle(dataset)
-        with open(filename, "w", encoding="utf-8") as f:
-            json.dump(dataset, f, ensure_ascii=False, indent=4)
+            samples = shuffle_buffered(samples, self.json_config.shuffle_buffer_size)
+        st = time.time()
+        num = 0
+        with CountingWriter(files['train'], mode=mode) as train_file, CountingWriter(files['dev'], mode=mode) as dev_file:
+            for sample in samples:
+                if not self._is_running:
+                    break
+                # 逐条按比例划分训练集和验证集
+                f = train_file if random.random() * 100 < self.json_config.train_ratio else dev_file
+                f.write(json.dumps(sample, ensure_ascii=False))
+                f.write('\n')
+                num += 1
+                if num % 10000 == 0:
+                    self.print_write_progress(num, train_file.bytes_written + dev_file.bytes_written, st)
+            self.print_write_progress(num, train_file.bytes_written + dev_file.bytes_written, st)
+        self.save_watermark(files)
         print(f"【完成导出 json {self.contact.remark}】")
         self.update_progress_callback(1)
         self.finish_callback(self.exporter_id)
@@ -1,7 +1,8 @@
 import os
 import re
+import time
 
-from exporter.exporter import ExporterBase
+from exporter.exporter import ExporterBase, CountingWriter
 from wxManager import MessageType, Message
 from wxManager.model import QuoteMessage, LinkMessage
 
@@ -141,20 +142,25 @@ class MarkdownExporter(ExporterBase):
         origin_path = self.origin_path
         os.makedirs(origin_path, exist_ok=True)
         filename = os.path.join(origin_path, self.contact.remark + '.md')
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
-        total_steps = len(messages)
-        num = 1
+        st = time.time()
+        # 边读边写，内存占用与聊天记录的长度无关
+        messages = self.track_progress(
+            self.database.iter_messages(self.contact.wxid, time_range=self.time_range),
+            self.count_export_messages()
+        )
+        num = 0
         years = set()
         months = set()
         days = set()
-        with open(filename, mode='w', newline='', encoding='utf-8') as f:
+        with CountingWriter(filename) as f:
             for index, message in enumerate(messages):
                 if not self._is_running:
                     break
-                if index and index % 1000 == 0:
-                    self.update_progress_callback(index / total_steps)
+                if index and index % 10000 == 0:
+                    self.print_write_progress(index, f.bytes_written, st)
                 if not self.is_selected(message):
                     continue
+                num += 1
                 type_ = message.type
                 year, month, day = parser_date(message.str_time)
                 if year not in years:
@@ -205,6 +211,7 @@ class MarkdownExporter(ExporterBase):
                     self.personal_business_card(f, message)
                 elif type_ == MessageType.Position:
                     self.position(f, message)
+            self.print_write_progress(num, f.bytes_written, st)
         self.update_progress_callback(1)
         print(f"【完成导出 Markdown {self.contact.remark}】")
         self.finish_callback(self.exporter_id)
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@File        : wxManager-exporter_parquet.py
+@Description : 把聊天记录导出成列式存储的Parquet/Arrow IPC文件，方便用DuckDB、Polars等工具分析
+"""
+import os
+import time
+import traceback
+
+from wxManager import Message
+from wxManager.log import logger
+from exporter.config import FileType
+from exporter.exporter import ExporterBaseBase, get_new_filename
+
+BATCH_SIZE = 50000  # 每个record batch（Parquet的row group）的消息数量
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('导出Parquet/Arrow需要先安装pyarrow：pip install pyarrow')
+    return pyarrow
+
+
+class DictionaryColumn:
+    """
+    跨batch共用同一个字典的字符串列
+    新值只会追加到字典末尾，每个batch的字典都是上一个batch的扩展，
+    Arrow IPC文件里只需要写入字典增量，Parquet里则按字典编码存储
+    """
+
+    def __init__(self):
+        self.index = {}
+        self.values = []
+
+    def encode(self, strings):
+        pa = import_pyarrow()
+        indices = []
+        for value in strings:
+            i = self.index.get(value)
+            if i is None:
+                i = len(self.values)
+                self.index[value] = i
+                self.values.append(value)
+            indices.append(i)
+        return pa.DictionaryArray.from_arrays(pa.array(indices, pa.int32()), pa.array(self.values, pa.string()))
+
+
+def message_to_record(message: Message) -> tuple:
+    """
+    提取消息的通用字段和各类型消息的结构化字段
+    @return: (text, url, md5, duration, file_name, file_size)
+    """
+    try:
+        text = message.to_text()
+    except:
+        text = ''
+    url = getattr(message, 'href', '') or getattr(message, 'url', '')
+    md5 = getattr(message, 'md5', '')
+    duration = getattr(message, 'duration', None)
+    file_name = getattr(message, 'file_name', '')
+    file_size = getattr(message, 'file_size', None)
+    return (
+        text,
+        url if isinstance(url, str) else '',
+        md5 if isinstance(md5, str) else '',
+        duration if isinstance(duration, int) else None,
+        file_name if isinstance(file_name, str) else '',
+        file_size if isinstance(file_size, int) else None
+    )
+
+
+class ParquetExporter(ExporterBaseBase):
+    """
+    把所有会话（或者指定的会话）的消息导出到一个Parquet或Arrow IPC文件
+    逐个会话流式读取消息，每BATCH_SIZE条写出一个batch，内存占用与消息总数无关
+    talker、sender等重复度高的列使用字典编码
+    """
+    exporter_id = 0
+    dictionary_columns = ('talker', 'talker_remark', 'sender', 'display_name', 'type_name')
+
+    def __init__(
+            self,
+            database,
+            output_dir,
+            type_=FileType.PARQUET,  # FileType.PARQUET 或者 FileType.ARROW
+            wxids=None,  # 要导出的会话，默认导出所有会话
+            message_types=None,  # 导出的消息类型
+            time_range=None,  # 导出的日期范围
+            compression='zstd',  # Parquet的压缩算法
+            batch_size=BATCH_SIZE,
+            progress_callback=None,  # 进度回调函数，func(progress:float)
+            finish_callback=None  # 导出完成回调函数
+    ):
+        super().__init__()
+        self.database = database
+        self.output_dir = os.path.join(output_dir, '聊天记录')
+        self.output_type = type_
+        self.wxids = wxids
+        self.message_types = message_types
+        self.time_range = time_range
+        self.compression = compression
+        self.batch_size = batch_size
+        self.update_progress_callback = progress_callback or self.print_progress
+        self.finish_callback = finish_callback or self.finish
+        self.dictionaries = {name: DictionaryColumn() for name in self.dictionary_columns}
+
+    def print_progress(self, progress):
+        logger.info(f'导出进度：{progress * 100:.2f}%')
+
+    def finish(self, success):
+        logger.info(f'导出完成\n{"-" * 20}')
+
+    def schema(self):
+        pa = import_pyarrow()
+        dict_string = pa.dictionary(pa.int32(), pa.string())
+        return pa.schema([
+            ('talker', dict_string),
+            ('talker_remark', dict_string),
+            ('local_id', pa.int64()),
+            ('server_id', pa.int64()),
+            ('sort_seq', pa.int64()),
+            ('timestamp', pa.timestamp('s')),
+            ('type', pa.int64()),  # MessageType里有很多超出int32的值，例如文件消息
+            ('type_name', dict_string),
+            ('is_sender', pa.bool_()),
+            ('sender', dict_string),
+            ('display_name', dict_string),
+            ('text', pa.string()),
+            ('url', pa.string()),
+            ('md5', pa.string()),
+            ('duration', pa.int32()),
+            ('file_name', pa.string()),
+            ('file_size', pa.int64()),
+        ])
+
+    def get_usernames(self):
+        if self.wxids:
+            return list(dict.fromkeys(self.wxids))
+        sessions = self.database.get_session() or []
+        return list(dict.fromkeys(session[0] for session in sessions if session[0]))
+
+    def get_filename(self):
+        ext = 'arrow' if self.output_type == FileType.ARROW else 'parquet'
+        return get_new_filename(os.path.join(self.output_dir, f'messages.{ext}'))
+
+    def open_writer(self, filename, schema):
+        pa = import_pyarrow()
+        if self.output_type == FileType.ARROW:
+            # 字典只追加不替换，IPC文件里写字典增量
+            options = pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+            return pa.ipc.new_file(filename, schema, options=options)
+        import pyarrow.parquet as pq
+        return pq.ParquetWriter(filename, schema, compression=self.compression, use_dictionary=True)
+
+    def make_batch(self, schema, rows):
+        """
+        把一批行转换成record batch
+        @param schema:
+        @param rows: List[tuple]，字段顺序与schema相同
+        @return:
+        """
+        pa = import_pyarrow()
+        columns = list(zip(*rows))
+        arrays = []
+        for i, field in enumerate(schema):
+            if field.name in self.dictionaries:
+                arrays.append(self.dictionaries[field.name].encode(columns[i]))
+            else:
+                arrays.append(pa.array(columns[i], field.type))
+        return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+    def write_rows(self, writer, schema, rows) -> int:
+        """
+        把rows写成一个batch并清空rows
+        写入失败时丢弃这一批，不会让后面的会话一直带着写不进去的行
+        @return: 写出的消息数
+        """
+        try:
+            writer.write_batch(self.make_batch(schema, rows))
+            return len(rows)
+        except:
+            logger.error(f'{len(rows)}条消息写入失败，已丢弃\n{traceback.format_exc()}')
+            return 0
+        finally:
+            rows.clear()
+
+    def run(self):
+        self.export()
+
+    def start(self):
+        self.run()
+
+    def export(self):
+        print("【开始导出 Parquet】")
+        os.makedirs(self.output_dir, exist_ok=True)
+        filename = self.get_filename()
+        usernames = self.get_usernames()
+        total_steps = len(usernames)
+        schema = self.schema()
+        st = time.time()
+        num = 0
+        rows = []
+        writer = self.open_writer(filename, schema)
+        try:
+            for session_index, username in enumerate(usernames):
+                if not self._is_running:
+                    break
+                contact = self.database.get_contact_by_username(username)
+                talker_remark = contact.remark if contact else username
+                try:
+                    for message in self.database.iter_messages(username, time_range=self.time_range):
+                        if self.message_types and message.type not in self.message_types:
+                            continue
+                        rows.append(
+                            (
+                                username, talker_remark, message.local_id, message.server_id, message.sort_seq,
+                                message.timestamp, message.type, message.type_name(), bool(message.is_sender),
+                                message.sender_id, message.display_name, *message_to_record(message)
+                            )
+                        )
+                        if len(rows) >= self.batch_size:
+                            num += self.write_rows(writer, schema, rows)
+                            cost = max(time.time() - st, 1e-6)
+                            logger.info(f'已导出{num}条消息，{num / cost:.0f}条/s')
+                except:
+                    logger.error(f'{username} 导出失败\n{traceback.format_exc()}')
+                self.update_progress_callback((session_index + 1) / max(total_steps, 1))
+            if rows:
+                num += self.write_rows(writer, schema, rows)
+        finally:
+            writer.close()
+        cost = max(time.time() - st, 1e-6)
+        logger.info(f'共导出{num}条消息，耗时{cost:.2f}s，{num / cost:.0f}条/s，文件：{filename}')
+        self.update_progress_callback(1)
+        print("【完成导出 Parquet】")
+        self.finish_callback(self.exporter_id)
+
+
+def check_roundtrip():
+    """
+    自检：type超出int32的消息（例如文件消息）写入Parquet/Arrow文件后能原样读回
+    python -m exporter.exporter_parquet
+    """
+    import tempfile
+    import pyarrow.parquet as pq
+    from wxManager import MessageType
+    from wxManager.model.message import FileMessage, TextMessage
+
+    pa = import_pyarrow()
+    base = dict(
+        local_id=1, server_id=7000000000000000001, sort_seq=1700000000000, timestamp=1700000000,
+        str_time='2023-11-15 06:13:20', talker_id='wxid_test', is_sender=True, sender_id='wxid_me',
+        display_name='我', avatar_src='', status=3, xml_content=''
+    )
+    messages = [
+        TextMessage(type=MessageType.Text, content='你好', **base),
+        FileMessage(
+            type=MessageType.File, path='', md5='d41d8cd98f00b204e9800998ecf8427e', file_size=1024,
+            file_name='报告.pdf', file_type='pdf', **base
+        ),
+    ]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for type_ in (FileType.PARQUET, FileType.ARROW):
+            exporter = ParquetExporter(None, tmp_dir, type_)
+            schema = exporter.schema()
+            rows = [
+                (
+                    'wxid_test', '测试', message.local_id, message.server_id, message.sort_seq, message.timestamp,
+                    message.type, message.type_name(), bool(message.is_sender), message.sender_id,
+                    message.display_name, *message_to_record(message)
+                )
+                for message in messages
+            ]
+            filename = os.path.join(tmp_dir, f'messages.{"arrow" if type_ == FileType.ARROW else "parquet"}')
+            writer = exporter.open_writer(filename, schema)
+            try:
+                assert exporter.write_rows(writer, schema, rows) == len(messages)
+            finally:
+                writer.close()
+            if type_ == FileType.ARROW:
+                with pa.memory_map(filename) as source:
+                    table = pa.ipc.open_file(source).read_all()
+            else:
+                table = pq.read_table(filename)
+            assert table.column('type').to_pylist() == [message.type for message in messages], type_
+            assert table.column('file_size').to_pylist() == [None, 1024], type_
+    print('Parquet/Arrow导出自检通过')
+
+
+if __name__ == '__main__':
+    check_roundtrip()
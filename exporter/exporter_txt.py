@@ -1,12 +1,15 @@
 import os
+import time
 import traceback
 
 from wxManager import MessageType
 from wxManager.model import Message
-from exporter.exporter import ExporterBase, get_new_filename
+from exporter.exporter import ExporterBase, CountingWriter
 
 
 class TxtExporter(ExporterBase):
+    supports_incremental = True
+
     def title(self, message: Message):
         str_time = message.str_time
         if message.type == MessageType.System:
@@ -19,19 +22,26 @@ class TxtExporter(ExporterBase):
         print(f"【开始导出 TXT {self.contact.remark}】")
         origin_path = self.origin_path
         os.makedirs(origin_path, exist_ok=True)
-        filename = os.path.join(origin_path, self.contact.remark + '.txt')
-        filename = get_new_filename(filename)
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
-        total_steps = len(messages)
-        txt_res = []
-        for index, message in enumerate(messages):
-            if index and index % 1000 == 0:
-                self.update_progress_callback(index / total_steps)
-            if not self.is_selected(message):
-                continue
-            txt_res.append(f'{self.title(message)}\n{message.to_text()}')
-        with open(filename, mode='w', newline='', encoding='utf-8') as f:
-            f.write('\n\n'.join(txt_res))
+        files, append = self.resolve_output_files(txt=os.path.join(origin_path, self.contact.remark + '.txt'))
+        filename = files['txt']
+        st = time.time()
+        # 边读边写，内存占用与聊天记录的长度无关；增量导出时只读取新消息并追加到上次的文件
+        messages = self.iter_export_messages()
+        num = 0
+        with CountingWriter(filename, mode='ab' if append else 'wb') as f:
+            for index, message in enumerate(messages):
+                if not self._is_running:
+                    break
+                if index and index % 10000 == 0:
+                    self.print_write_progress(index, f.bytes_written, st)
+                if not self.is_selected(message):
+                    continue
+                if num or append:
+                    f.write('\n\n')
+                f.write(f'{self.title(message)}\n{message.to_text()}')
+                num += 1
+            self.print_write_progress(num, f.bytes_written, st)
+        self.save_watermark(files)
         self.update_progress_callback(1)
         print(f"【完成导出 TXT {self.contact.remark}】")
         self.finish_callback(self.exporter_id)
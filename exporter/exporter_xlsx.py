@@ -1,12 +1,14 @@
 import os
+import shutil
+import tempfile
 import time
 import traceback
 
 from wxManager import Me, MessageType
-from wxManager.decrypt.decrypt_dat import batch_decode_image_multiprocessing
 from wxManager.log import logger
 from wxManager.model import Message
-from exporter.exporter import ExporterBase, copy_files, decode_audios, get_new_filename
+from exporter.config import FileType
+from exporter.exporter import ExporterBase, get_new_filename
 
 from PIL import JpegImagePlugin
 from PIL import ImageFile
@@ -18,6 +20,8 @@ from wxManager.parser.link_parser import wx_sport, wx_collection_data, wx_pay_da
 JpegImagePlugin._getmp = lambda x: None
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
+EXCEL_MAX_ROWS = 1048576  # Excel单个工作表的最大行数
+
 
 def add_hyperlink(doc, row, column, hyperlink):
     from openpyxl.styles import Font
@@ -48,9 +52,50 @@ def find_image_with_known_extensions(img_path):
     return None
 
 
+def make_thumbnail(img_path, output_dir, name, max_height=500):
+    """
+    生成插入表格的缩略图，图片比显示尺寸大时只保存缩小后的副本，避免把原图全部塞进xlsx
+    @param img_path: 图片路径
+    @param output_dir: 缩略图文件夹
+    @param name: 缩略图文件名（不带后缀）
+    @param max_height: 显示的最大高度
+    @return: (图片路径, 宽, 高)
+    """
+    with PILImage.open(img_path) as img:
+        width, height = img.size
+        scale = min(1.0, max_height / height)
+        size = (max(int(width * scale), 1), max(int(height * scale), 1))
+        if scale == 1.0 and img.format in ('JPEG', 'PNG', 'GIF'):
+            return img_path, width, height
+        img.thumbnail(size)
+        thumb_path = os.path.join(output_dir, f'{name}.jpg')
+        img.convert('RGB').save(thumb_path, 'JPEG', quality=85)
+    return thumb_path, size[0], size[1]
+
+
 class ExcelExporter(ExporterBase):
     row = 2
 
+    def __init__(
+            self,
+            database,
+            contact,
+            output_dir,
+            type_=FileType.XLSX,  # 导出文件类型
+            message_types: set[MessageType] = None,  # 导出的消息类型
+            time_range=None,  # 导出的日期范围
+            group_members: set[str] = None,  # 群聊中只导出这些人的聊天记录
+            progress_callback=None,  # 进度回调函数，func(progress:float)
+            finish_callback=None,  # 导出完成回调函数
+            media_store=None,  # 批量导出时共享的媒体仓库
+            write_only=False,  # 流式导出，适合消息量很大的聊天
+            window_size=1000  # 流式导出时每批处理的消息数量
+    ):
+        super().__init__(database, contact, output_dir, type_, message_types, time_range, group_members,
+                         progress_callback, finish_callback, media_store)  # 调用父类的构造函数
+        self.write_only = write_only
+        self.window_size = window_size
+
     def add_member_info(self, sheet):
         if self.contact.is_chatroom():
             columns = ['wxid', '微信号', '类型', '群昵称', '昵称', '头像地址',
@@ -100,6 +145,79 @@ class ExcelExporter(ExporterBase):
                remark, nickname, 'more']
         return res
 
+    def collect_media_tasks(self, message, image_tasks, video_tasks, file_tasks, audio_tasks, merged=False) -> str:
+        """
+        收集消息里需要导出的图片、视频、文件、语音，并把消息里的路径改成导出后的相对路径
+        @param message:
+        @param merged: 是否是合并转发里的消息
+        @return: 需要在表格里添加的超链接，没有的话返回空字符串
+        """
+        image_dir = os.path.join(self.origin_path, 'image')
+        video_dir = os.path.join(self.origin_path, 'video')
+        audio_dir = os.path.join(self.origin_path, 'voice')
+        file_dir = os.path.join(self.origin_path, 'file')
+        type_ = message.type
+        if type_ == MessageType.Image:
+            message.set_file_name()
+            image_tasks.append(
+                (
+                    os.path.join(Me().wx_dir, message.path),
+                    os.path.join(image_dir, message.str_time[:7]),
+                    message.file_name
+                )
+            )
+            image_tasks.append(
+                (
+                    os.path.join(Me().wx_dir, message.thumb_path),
+                    os.path.join(image_dir, message.str_time[:7]),
+                    message.file_name + '_t'
+                )
+            )
+            message.path = f"./image/{message.str_time[:7]}/{message.file_name}"
+            message.thumb_path = f"./image/{message.str_time[:7]}/{message.file_name + '_t'}"
+        elif type_ == MessageType.File:
+            origin_file_path = os.path.join(Me().wx_dir, message.path)
+            file_tasks.append(
+                (
+                    origin_file_path,
+                    os.path.join(file_dir, message.str_time[:7]),
+                    ''
+                )
+            )
+            if merged:
+                message.path = f'./file/{message.str_time[:7]}/{os.path.basename(origin_file_path)}'
+            elif os.path.isfile(origin_file_path):
+                message.path = f'./file/{message.str_time[:7]}/{os.path.basename(origin_file_path)}'
+                return message.path
+        elif type_ == MessageType.Video:
+            message.set_file_name()
+            video_tasks.append(
+                (
+                    os.path.join(Me().wx_dir, message.path),
+                    os.path.join(video_dir, message.str_time[:7]),
+                    message.file_name
+                )
+            )
+            ext = os.path.basename(message.path).split('.')[-1]
+            message.path = f'./video/{message.str_time[:7]}/{message.file_name}.{ext}'
+            if not merged:
+                return message.path
+        elif type_ == MessageType.Audio and not merged:
+            message.set_file_name()
+            audio_tasks.append(
+                (
+                    self.database.get_media_buffer(message.server_id),
+                    os.path.join(audio_dir, message.str_time[:7]),
+                    message.file_name
+                )
+            )
+            message.path = f'./voice/{message.str_time[:7]}/{message.file_name + ".mp3"}'
+            return message.path
+        elif type_ == MessageType.MergedMessages:
+            for msg in message.messages:
+                self.collect_media_tasks(msg, image_tasks, video_tasks, file_tasks, audio_tasks, merged=True)
+        return ''
+
     def to_excel(self):
         from openpyxl.styles import Font
         import openpyxl
@@ -123,57 +241,8 @@ class ExcelExporter(ExporterBase):
         video_tasks = []
         file_tasks = []
         audio_tasks = []
-        image_dir = os.path.join(self.origin_path, 'image')
-        video_dir = os.path.join(self.origin_path, 'video')
-        audio_dir = os.path.join(self.origin_path, 'voice')
-        file_dir = os.path.join(self.origin_path, 'file')
         image_index = {}
 
-        def parser_merged(merged_message):
-            for msg in merged_message.messages:
-                type_ = msg.type
-                if type_ == MessageType.Image:
-                    msg.set_file_name()
-                    image_tasks.append(
-                        (
-                            os.path.join(Me().wx_dir, msg.path),
-                            os.path.join(image_dir, msg.str_time[:7]),
-                            msg.file_name
-                        )
-                    )
-                    image_tasks.append(
-                        (
-                            os.path.join(Me().wx_dir, msg.thumb_path),
-                            os.path.join(image_dir, msg.str_time[:7]),
-                            msg.file_name + '_t'
-                        )
-                    )
-                    msg.path = f"./image/{msg.str_time[:7]}/{msg.file_name}"
-                    msg.thumb_path = f"./image/{msg.str_time[:7]}/{msg.file_name + '_t'}"
-                elif type_ == MessageType.File:
-                    origin_file_path = os.path.join(Me().wx_dir, msg.path)
-                    file_tasks.append(
-                        (
-                            origin_file_path,
-                            os.path.join(file_dir, msg.str_time[:7]),
-                            ''
-                        )
-                    )
-                    msg.path = f'./file/{msg.str_time[:7]}/{os.path.basename(origin_file_path)}'
-                elif type_ == MessageType.Video:
-                    msg.set_file_name()
-                    video_tasks.append(
-                        (
-                            os.path.join(Me().wx_dir, msg.path),
-                            os.path.join(video_dir, msg.str_time[:7]),
-                            msg.file_name
-                        )
-                    )
-                    ext = os.path.basename(msg.path).split('.')[-1]
-                    msg.path = f'./video/{msg.str_time[:7]}/{msg.file_name}.{ext}'
-                elif type_ == MessageType.MergedMessages:
-                    parser_merged(msg)
-
         for index, message in enumerate(messages):
             if not self._is_running:
                 break
@@ -187,70 +256,18 @@ class ExcelExporter(ExporterBase):
             except:
                 logger.error(traceback.format_exc())
                 continue
-            type_ = message.type
-            if type_ == MessageType.Image:
-                message.set_file_name()
+            if message.type == MessageType.Image:
                 image_index[message.server_id] = self.row
-                image_tasks.append(
-                    (
-                        os.path.join(Me().wx_dir, message.path),
-                        os.path.join(image_dir, message.str_time[:7]),
-                        message.file_name
-                    )
-                )
-                image_tasks.append(
-                    (
-                        os.path.join(Me().wx_dir, message.thumb_path),
-                        os.path.join(image_dir, message.str_time[:7]),
-                        message.file_name + '_t'
-                    )
-                )
-                message.path = f"./image/{message.str_time[:7]}/{message.file_name}"
-                message.thumb_path = f"./image/{message.str_time[:7]}/{message.file_name + '_t'}"
-            elif type_ == MessageType.File:
-                origin_file_path = os.path.join(Me().wx_dir, message.path)
-                file_tasks.append(
-                    (
-                        origin_file_path,
-                        os.path.join(file_dir, message.str_time[:7]),
-                        ''
-                    )
-                )
-                if os.path.isfile(origin_file_path):
-                    message.path = f'./file/{message.str_time[:7]}/{os.path.basename(origin_file_path)}'
-                    add_hyperlink(new_sheet, self.row, 5, message.path)
-            elif type_ == MessageType.Video:
-                message.set_file_name()
-                video_tasks.append(
-                    (
-                        os.path.join(Me().wx_dir, message.path),
-                        os.path.join(video_dir, message.str_time[:7]),
-                        message.file_name
-                    )
-                )
-                ext = os.path.basename(message.path).split('.')[-1]
-                message.path = f'./video/{message.str_time[:7]}/{message.file_name}.{ext}'
-                add_hyperlink(new_sheet, self.row, 5, message.path)
-            elif type_ == MessageType.Audio:
-                message.set_file_name()
-                audio_tasks.append(
-                    (
-                        self.database.get_media_buffer(message.server_id),
-                        os.path.join(audio_dir, message.str_time[:7]),
-                        message.file_name
-                    )
-                )
-                message.path = f'./voice/{message.str_time[:7]}/{message.file_name + ".mp3"}'
-                add_hyperlink(new_sheet, self.row, 5, message.path)
-            elif type_ == MessageType.MergedMessages:
-                parser_merged(message)
+            link_path = self.collect_media_tasks(message, image_tasks, video_tasks, file_tasks, audio_tasks)
+            if link_path:
+                add_hyperlink(new_sheet, self.row, 5, link_path)
         # 使用多进程，导出所有图片
-        batch_decode_image_multiprocessing(Me().xor_key, image_tasks)
+        self.decode_media_images(image_tasks)
 
         # 使用多线程，复制文件、视频到导出文件夹
-        copy_files(video_tasks + file_tasks)
+        self.copy_media_files(video_tasks + file_tasks)
 
-        decode_audios(audio_tasks)
+        self.decode_media_audios(audio_tasks)
         if MessageType.Image in self.message_types:
             for index, message in enumerate(messages):
                 if message.type == MessageType.Image:
@@ -304,6 +321,121 @@ class ExcelExporter(ExporterBase):
         self.finish_callback(self.exporter_id)
         print(f"【完成导出 XLSX {self.contact.remark}】")
 
+    def to_excel_write_only(self):
+        """
+        流式导出XLSX，使用openpyxl的write_only模式，消息边读边写
+        每window_size条消息为一批：先导出这一批的图片、文件、语音，再把行和缩略图写入表格，
+        内存占用只跟批大小有关；超过Excel单表行数上限时自动新建工作表
+        @return:
+        """
+        import openpyxl
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.drawing.image import Image
+        from openpyxl.styles import Font
+        Image.MAX_IMAGE_PIXELS = None
+        print(f"【开始导出 XLSX {self.contact.remark}】")
+        os.makedirs(self.origin_path, exist_ok=True)
+        filename = os.path.join(self.origin_path, f"{self.contact.remark}.xlsx")
+        filename = get_new_filename(filename)
+        columns = ['消息ID', '类型', '发送人', '时间', '内容', '备注', '昵称', '更多信息']
+        try:
+            # 只查行数，不解析消息，用来汇报进度
+            total_num = self.database.get_messages_number(self.contact.wxid, time_range=self.time_range)
+        except:
+            logger.error(traceback.format_exc())
+            total_num = 0
+        messages = self.database.iter_messages(self.contact.wxid, time_range=self.time_range)
+        new_workbook = openpyxl.Workbook(write_only=True)
+        sheets = [new_workbook.create_sheet("聊天记录")]
+        member_sheet = new_workbook.create_sheet("成员信息")
+        self.add_member_info(member_sheet)
+        sheets[-1].append(columns)
+        sheet_rows = 1  # 当前工作表已经写入的行数
+        link_font = Font(color="0000FF", underline="single")
+        insert_image = not self.message_types or MessageType.Image in self.message_types
+        thumb_dir = tempfile.mkdtemp(prefix='wxexport_xlsx_')
+        num = 0
+        read_num = 0  # 已经读取的消息数量，包括没有选中的
+        window = []  # [(message, 行数据, 超链接)]
+        image_tasks = []
+        video_tasks = []
+        file_tasks = []
+        audio_tasks = []
+
+        def flush():
+            nonlocal sheet_rows
+            # 这一批的媒体文件导出完成后才能插入缩略图
+            self.decode_media_images(image_tasks)
+            self.copy_media_files(video_tasks + file_tasks)
+            self.decode_media_audios(audio_tasks)
+            for task_list in (image_tasks, video_tasks, file_tasks, audio_tasks):
+                task_list.clear()
+            for message, row_data, link_path in window:
+                if sheet_rows >= EXCEL_MAX_ROWS:
+                    # 新的工作表放在成员信息前面
+                    sheets.append(new_workbook.create_sheet(f"聊天记录{len(sheets) + 1}", len(sheets)))
+                    sheets[-1].append(columns)
+                    sheet_rows = 1
+                sheet = sheets[-1]
+                row = sheet_rows + 1
+                if link_path:
+                    cell = WriteOnlyCell(sheet, value=row_data[4])
+                    cell.hyperlink = link_path
+                    cell.font = link_font
+                    row_data[4] = cell
+                if insert_image and message.type == MessageType.Image:
+                    img_path = find_image_with_known_extensions(os.path.join(self.origin_path, message.path))
+                    if not img_path:
+                        img_path = find_image_with_known_extensions(os.path.join(self.origin_path, message.thumb_path))
+                    if img_path:
+                        try:
+                            thumb_path, width, height = make_thumbnail(img_path, thumb_dir, str(message.server_id))
+                            img = Image(thumb_path)
+                            img.width = width
+                            img.height = height
+                            img.anchor = f'E{row}'
+                            sheet.add_image(img)
+                            # 行高必须在写入这一行之前设置
+                            sheet.row_dimensions[row].height = height * 0.75  # 0.75 是像素到 Excel 单位的转换因子
+                        except:
+                            logger.error(traceback.format_exc())
+                sheet.append(row_data)
+                sheet_rows += 1
+            window.clear()
+            if total_num:
+                self.update_progress_callback(min(read_num / total_num, 1))
+
+        try:
+            for index, message in enumerate(messages):
+                if not self._is_running:
+                    break
+                read_num = index + 1
+                if not total_num and index and index % 10000 == 0:
+                    logger.info(f'导出进度：{index}条消息')
+                if not self.is_selected(message):
+                    continue
+                try:
+                    row_data = self.message_to_list(message)
+                except:
+                    logger.error(traceback.format_exc())
+                    continue
+                link_path = self.collect_media_tasks(message, image_tasks, video_tasks, file_tasks, audio_tasks)
+                window.append((message, row_data, link_path))
+                num += 1
+                if len(window) >= self.window_size:
+                    flush()
+            flush()
+            try:
+                new_workbook.save(filename)
+            except PermissionError:
+                filename = '.'.join(filename.split('.')[:-1]) + str(int(time.time())) + '.xlsx'
+                new_workbook.save(filename)
+        finally:
+            shutil.rmtree(thumb_dir, ignore_errors=True)
+        self.update_progress_callback(1)
+        self.finish_callback(self.exporter_id)
+        print(f"【完成导出 XLSX {self.contact.remark}】{num}")
+
     def public_to_excel(self):
         from openpyxl.styles import Font
         import openpyxl
@@ -522,5 +654,7 @@ class ExcelExporter(ExporterBase):
                 self.wx_sport()
             else:
                 self.public_to_excel()
+        elif self.write_only:
+            self.to_excel_write_only()
         else:
             self.to_excel()
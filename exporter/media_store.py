@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@File        : wxManager-media_store.py
+@Description : 导出全局共享的媒体仓库，按源文件内容去重，每个资源只解码/复制一次
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+from wxManager.decrypt.decrypt_dat import batch_decode_image_multiprocessing
+from wxManager.log import logger
+
+
+def link_file(source_file, destination_file):
+    """
+    优先创建硬链接，跨分区或者文件系统不支持时退化为复制
+    @param source_file: 仓库中的文件
+    @param destination_file: 聊天文件夹中的文件
+    @return:
+    """
+    if os.path.exists(destination_file):
+        return destination_file
+    try:
+        os.link(source_file, destination_file)
+    except OSError:
+        try:
+            shutil.copyfile(source_file, destination_file)
+        except OSError:
+            logger.error(traceback.format_exc())
+            return ''
+    return destination_file
+
+
+class MediaStore:
+    """
+    内容寻址的媒体仓库，key为源文件内容的md5
+    仓库文件保存在 <output_dir>/聊天记录/.media/<md5[:2]>/<md5>.<ext>，
+    各联系人文件夹下的 image、video、file、voice 只保存指向仓库文件的硬链接，
+    HTML等导出格式里的相对路径保持不变
+    """
+
+    def __init__(self, output_dir):
+        self.root = os.path.join(output_dir, '聊天记录', '.media')
+        self.index_path = os.path.join(self.root, 'index.json')
+        self.index = {}  # md5 -> 仓库中的相对路径
+        self._hash_cache = {}  # (源文件路径, 大小, 修改时间) -> md5
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            logger.error(f'媒体仓库索引损坏，重新建立索引\n{traceback.format_exc()}')
+            return
+        # 仓库文件被手动删除的话就当作没有导出过
+        self.index = {
+            key: path for key, path in index.items() if os.path.isfile(os.path.join(self.root, path))
+        }
+
+    def save(self):
+        with self._lock:
+            data = dict(self.index)
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+
+    def file_md5(self, file_path) -> str:
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return ''
+        cache_key = (file_path, stat.st_size, stat.st_mtime_ns)
+        if cache_key in self._hash_cache:
+            return self._hash_cache[cache_key]
+        md5 = hashlib.md5()
+        try:
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    md5.update(chunk)
+        except OSError:
+            return ''
+        digest = md5.hexdigest()
+        self._hash_cache[cache_key] = digest
+        return digest
+
+    def _hash_files(self, file_paths) -> List[str]:
+        # hashlib在处理大块数据时会释放GIL，多线程计算md5
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            return list(executor.map(self.file_md5, file_paths))
+
+    def _store_dir(self, key):
+        return os.path.join(self.root, key[:2])
+
+    def _get(self, key):
+        with self._lock:
+            path = self.index.get(key)
+        return os.path.join(self.root, path) if path else ''
+
+    def _put(self, key, stored_file):
+        if not stored_file or not os.path.isfile(stored_file):
+            return
+        with self._lock:
+            self.index[key] = os.path.relpath(stored_file, self.root)
+
+    def _link_all(self, link_tasks: List[Tuple[str, str, str]], append_ext=True):
+        """
+        @param link_tasks: List[(md5, 输出文件夹, 输出文件名)]
+        @param append_ext: 输出文件名是否需要补上仓库文件的后缀（解密图片的后缀解密后才知道）
+        """
+        created_dirs = set()
+        for key, output_dir, dst_name in link_tasks:
+            stored_file = self._get(key)
+            if not stored_file:
+                continue
+            if output_dir not in created_dirs:
+                os.makedirs(output_dir, exist_ok=True)
+                created_dirs.add(output_dir)
+            if append_ext:
+                dst_name += os.path.splitext(stored_file)[1]
+            link_file(stored_file, os.path.join(output_dir, dst_name))
+
+    def copy_files(self, file_tasks: List[Tuple[str, str, str]], executor=None):
+        """
+        去重复制文件、视频，参数同 exporter.copy_files
+        @param file_tasks: List[(原始文件路径, 输出文件夹, 输出文件名)]
+        @param executor: 共享的线程池
+        @return:
+        """
+        from exporter.exporter import copy_files
+
+        sources = [source_file for source_file, _, _ in file_tasks if os.path.isfile(source_file)]
+        if not sources:
+            return
+        keys = dict(zip(sources, self._hash_files(sources)))
+        ingest_tasks = []
+        pending = set()
+        link_tasks = []
+        for source_file, output_dir, dst_name in file_tasks:
+            key = keys.get(source_file)
+            if not key:
+                continue
+            # 输出文件名的规则跟 copy_files 保持一致
+            ext = os.path.basename(source_file).split('.')[-1]
+            if dst_name:
+                link_tasks.append((key, output_dir, f'{dst_name}.{ext}'))
+            else:
+                link_tasks.append((key, output_dir, os.path.basename(source_file)))
+            if not self._get(key) and key not in pending:
+                pending.add(key)
+                ingest_tasks.append((source_file, self._store_dir(key), key))
+        copy_files(ingest_tasks, executor=executor)
+        for source_file, store_dir, key in ingest_tasks:
+            ext = os.path.basename(source_file).split('.')[-1]
+            self._put(key, os.path.join(store_dir, f'{key}.{ext}'))
+        self._link_all(link_tasks, append_ext=False)
+        self.save()
+
+    def decode_images(self, xor_key, image_tasks: List[Tuple[str, str, str]], executor=None):
+        """
+        去重解密图片，参数同 batch_decode_image_multiprocessing
+        @param xor_key: 异或加密密钥
+        @param image_tasks: List[(dat文件路径, 输出文件夹, 输出文件名)]
+        @param executor: 共享的进程池
+        @return:
+        """
+        sources = [file_path for file_path, _, _ in image_tasks if os.path.isfile(file_path)]
+        if not sources:
+            return
+        keys = dict(zip(sources, self._hash_files(sources)))
+        decode_tasks = []
+        pending = set()
+        link_tasks = []
+        for file_path, output_dir, dst_name in image_tasks:
+            key = keys.get(file_path)
+            if not key:
+                continue
+            link_tasks.append((key, output_dir, dst_name))
+            if not self._get(key) and key not in pending:
+                pending.add(key)
+                decode_tasks.append((file_path, self._store_dir(key), key))
+        results = batch_decode_image_multiprocessing(xor_key, decode_tasks, executor=executor) or []
+        for (_, _, key), stored_file in zip(decode_tasks, results):
+            self._put(key, stored_file)
+        self._link_all(link_tasks)
+        self.save()
+
+    def decode_audios(self, audio_tasks: List[Tuple[bytes, str, str]], executor=None):
+        """
+        去重转换语音，参数同 exporter.decode_audios
+        @param audio_tasks: List[(silk语音数据, 输出文件夹, 输出文件名)]
+        @param executor: 共享的线程池
+        @return:
+        """
+        from exporter.exporter import decode_audios
+
+        decode_tasks = []
+        pending = set()
+        link_tasks = []
+        for media_buffer, output_dir, dst_name in audio_tasks:
+            if not media_buffer:
+                continue
+            key = hashlib.md5(media_buffer).hexdigest()
+            link_tasks.append((key, output_dir, dst_name))
+            if not self._get(key) and key not in pending:
+                pending.add(key)
+                decode_tasks.append((media_buffer, self._store_dir(key), key))
+        decode_audios(decode_tasks, executor=executor)
+        for _, store_dir, key in decode_tasks:
+            self._put(key, os.path.join(store_dir, f'{key}.mp3'))
+        self._link_all(link_tasks)
+        self.save()
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@File        : wxManager-orchestrator.py
+@Description : 批量导出调度：所有联系人的导出任务共用一份并发预算，导出进度写入清单文件，中断后可以继续导出
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List
+
+from wxManager.log import logger
+from exporter.avatar_cache import AvatarCache
+from exporter.media_store import MediaStore
+
+
+class ExportManifest:
+    """
+    导出清单，记录已经完成的导出任务
+    保存在 <output_dir>/聊天记录/.export_manifest.json，每完成一个任务原子地重写一次
+    """
+
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, '聊天记录', '.export_manifest.json')
+        self.jobs = {}  # 任务key -> 任务信息
+        self.media = {}  # 媒体仓库的统计信息
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            logger.error(f'导出清单损坏，重新开始导出\n{traceback.format_exc()}')
+            return
+        self.jobs = data.get('jobs', {})
+        self.media = data.get('media', {})
+
+    def save(self):
+        with self._lock:
+            data = {'version': 1, 'jobs': dict(self.jobs), 'media': dict(self.media)}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def is_done(self, key, signature) -> bool:
+        job = self.jobs.get(key)
+        return bool(job) and job.get('status') == 'done' and job.get('signature') == signature
+
+    def mark(self, key, signature, status, **info):
+        with self._lock:
+            self.jobs[key] = {'status': status, 'signature': signature, 'time': int(time.time()), **info}
+        self.save()
+
+
+class ExportOrchestrator:
+    """
+    批量导出调度器
+    每个导出任务（一个联系人一种格式）仍然由对应的Exporter完成，
+    但图片解密、文件复制、语音转换都提交到调度器持有的同一个进程池/线程池，
+    不会因为每个任务各自创建线程池、进程池而超额占用CPU和磁盘
+    """
+
+    def __init__(
+            self,
+            database,
+            output_dir,
+            exporter_class,  # 导出类，例如 HtmlExporter
+            type_,  # 导出文件类型
+            exporter_kwargs: dict = None,  # 传给导出类的其他参数，例如message_types、time_range
+            cpu_workers=None,  # 图片解密的进程数，默认CPU核数
+            io_workers=16,  # 复制文件、语音转换的线程数
+            max_concurrent_jobs=1,  # 同时运行的导出任务数
+            use_media_store=True,  # 是否所有联系人共享一个媒体仓库
+            progress_callback=None,  # 总进度回调函数，func(progress:float)
+            finish_callback=None  # 全部导出完成回调函数
+    ):
+        """
+        @param max_concurrent_jobs: 数据库对象里有共享的游标，同时运行多个任务前请确认用到的查询都使用独立的游标
+        """
+        self.database = database
+        self.output_dir = output_dir
+        self.exporter_class = exporter_class
+        self.type_ = type_
+        self.exporter_kwargs = exporter_kwargs or {}
+        if self.exporter_kwargs.get('incremental'):
+            # 不支持追加写入的格式增量导出时每次都会覆盖上次的文件，直接拒绝
+            can_export_incrementally = getattr(exporter_class, 'can_export_incrementally', None)
+            if not can_export_incrementally or not can_export_incrementally(**self.exporter_kwargs):
+                raise ValueError(f'{exporter_class.__name__} 不支持增量导出')
+        self.cpu_workers = cpu_workers or os.cpu_count() or 4
+        self.io_workers = io_workers
+        self.max_concurrent_jobs = max(max_concurrent_jobs, 1)
+        self.media_store = MediaStore(output_dir) if use_media_store else None
+        self.avatar_cache = AvatarCache(output_dir)
+        self.manifest = ExportManifest(output_dir)
+        self.update_progress_callback = progress_callback or self.print_progress
+        self.finish_callback = finish_callback or self.finish
+        self._lock = threading.Lock()
+        self._running_exporters = {}
+        self._job_progress = {}  # 任务key -> 当前任务的进度
+        self._total_jobs = 0
+        self._finished_jobs = 0
+        self._is_running = True
+
+    def print_progress(self, progress):
+        logger.info(f'总进度：{progress * 100:.2f}%')
+
+    def finish(self, success):
+        logger.info(f'批量导出完成\n{"-" * 20}')
+
+    def job_key(self, contact) -> str:
+        return f'{self.exporter_class.__name__}:{contact.wxid}'
+
+    def job_signature(self) -> str:
+        """
+        导出参数的指纹，参数变了（比如换了日期范围）之前完成的任务就不算完成
+        """
+        kwargs = {
+            key: sorted(map(str, value)) if isinstance(value, (set, frozenset)) else value
+            for key, value in self.exporter_kwargs.items()
+        }
+        data = json.dumps([str(self.type_), kwargs], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+    def report_progress(self):
+        with self._lock:
+            running = sum(self._job_progress.values())
+            progress = (self._finished_jobs + running) / max(self._total_jobs, 1)
+        self.update_progress_callback(min(progress, 1))
+
+    def stop(self):
+        """
+        停止导出，正在导出的任务不会记为完成，下次从这些任务重新开始
+        """
+        self._is_running = False
+        with self._lock:
+            exporters = list(self._running_exporters.values())
+        for exporter in exporters:
+            exporter.stop()
+
+    def run_job(self, contact, signature, cpu_executor, io_executor):
+        key = self.job_key(contact)
+        if not self._is_running:
+            return False
+
+        def on_progress(progress):
+            with self._lock:
+                self._job_progress[key] = progress
+            self.report_progress()
+
+        st = time.time()
+        try:
+            exporter = self.exporter_class(
+                self.database,
+                contact,
+                output_dir=self.output_dir,
+                type_=self.type_,
+                progress_callback=on_progress,
+                finish_callback=lambda *args: None,
+                media_store=self.media_store,
+                **self.exporter_kwargs
+            )
+            exporter.set_executors(cpu_executor, io_executor)
+            exporter.set_avatar_cache(self.avatar_cache)
+            with self._lock:
+                self._running_exporters[key] = exporter
+            self.manifest.mark(key, signature, 'running')
+            exporter.start()
+            success = exporter._is_running
+        except:
+            logger.error(f'{contact.remark} 导出失败\n{traceback.format_exc()}')
+            success = False
+        finally:
+            with self._lock:
+                self._running_exporters.pop(key, None)
+                self._job_progress.pop(key, None)
+                self._finished_jobs += 1
+        if success:
+            self.manifest.mark(key, signature, 'done', remark=contact.remark, cost=round(time.time() - st, 2))
+        else:
+            self.manifest.mark(key, signature, 'failed', remark=contact.remark)
+        if self.media_store:
+            self.manifest.media = {'store': self.media_store.root, 'files': len(self.media_store.index)}
+            self.manifest.save()
+        self.report_progress()
+        return success
+
+    def start(self, contacts: List = None):
+        """
+        @param contacts: 要导出的联系人，默认导出所有联系人
+        @return: (成功的任务数, 跳过的任务数, 失败的任务数)
+        """
+        if contacts is None:
+            contacts = self.database.get_contacts()
+        signature = self.job_signature()
+        if self.exporter_kwargs.get('incremental'):
+            # 增量导出（构造时已经确认导出类支持追加写入）靠各联系人的水位线续传，每次都要检查所有联系人有没有新消息
+            todo = list(contacts)
+        else:
+            todo = [contact for contact in contacts if not self.manifest.is_done(self.job_key(contact), signature)]
+        skipped = len(contacts) - len(todo)
+        if skipped:
+            logger.info(f'跳过{skipped}个已经导出完成的联系人')
+        self._total_jobs = len(todo)
+        self._finished_jobs = 0
+        st = time.time()
+        results = []
+        with ProcessPoolExecutor(max_workers=self.cpu_workers) as cpu_executor, \
+                ThreadPoolExecutor(max_workers=self.io_workers) as io_executor:
+            if self.max_concurrent_jobs == 1:
+                for contact in todo:
+                    results.append(self.run_job(contact, signature, cpu_executor, io_executor))
+            else:
+                with ThreadPoolExecutor(max_workers=self.max_concurrent_jobs) as job_executor:
+                    futures = [
+                        job_executor.submit(self.run_job, contact, signature, cpu_executor, io_executor)
+                        for contact in todo
+                    ]
+                    results = [future.result() for future in futures]
+        success = sum(results)
+        failed = len(results) - success
+        logger.info(
+            f'批量导出结束：成功{success}个，跳过{skipped}个，失败或中断{failed}个，耗时{time.time() - st:.2f}s'
+        )
+        self.update_progress_callback(1)
+        self.finish_callback(not failed)
+        return success, skipped, failed
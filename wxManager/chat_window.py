@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@File        : wxManager-chat_window.py
+@Description : 聊天界面的键集分页：向前、向后翻页，跳转到某个时间或者某条消息
+"""
+import threading
+from collections import OrderedDict
+from typing import List, Tuple, FrozenSet
+
+from wxManager.model.message import Message
+
+# 游标：(边界消息的sort_seq, 这一页里sort_seq等于它的消息)
+# 同一个sort_seq可能有多条消息（v3的sort_seq是秒级的CreateTime），翻页时按游标取等于边界的消息，再跳过已经显示过的
+Cursor = Tuple[int, FrozenSet[Tuple[int, int]]]
+
+
+def message_key(message: Message):
+    return message.server_id, message.local_id
+
+
+def make_cursor(messages: List[Message], sort_seq) -> Cursor:
+    return sort_seq, frozenset(message_key(message) for message in messages if message.sort_seq == sort_seq)
+
+
+class ChatPage:
+    """
+    一页消息，messages按时间升序排列
+    """
+
+    def __init__(self, messages: List[Message], has_before=True, has_after=True, anchor=0):
+        self.messages = messages
+        self.has_before = has_before  # 前面可能还有更早的消息
+        self.has_after = has_after  # 后面可能还有更晚的消息
+        self.anchor = anchor  # 跳转时目标消息在messages中的下标
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    @property
+    def before_cursor(self) -> Cursor | None:
+        if not self.messages:
+            return None
+        return make_cursor(self.messages, self.messages[0].sort_seq)
+
+    @property
+    def after_cursor(self) -> Cursor | None:
+        if not self.messages:
+            return None
+        return make_cursor(self.messages, self.messages[-1].sort_seq)
+
+
+class ChatWindow:
+    """
+    某个聊天的分页窗口
+    每次翻页只从数据库取一页消息（每个分库最多预取一页，归并后只解析这一页），
+    解析好的页面按LRU缓存，来回滚动时不重复查询和解析
+    数据库合并了新数据之后调用clear()
+    """
+
+    def __init__(self, database, username, page_size=50, cache_size=16):
+        """
+        @param database: DataBaseInterface
+        @param username: 聊天对象的wxid
+        @param page_size: 每页的消息数
+        @param cache_size: 缓存的页数
+        """
+        self.database = database
+        self.username = username
+        self.page_size = page_size
+        self.cache_size = cache_size
+        self._pages = OrderedDict()  # (方向, 游标, 条数) -> ChatPage
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+    def _cached(self, key, load) -> ChatPage:
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+                return page
+        page = load()
+        with self._lock:
+            self._pages[key] = page
+            self._pages.move_to_end(key)
+            while len(self._pages) > self.cache_size:
+                self._pages.popitem(last=False)
+        return page
+
+    def _fetch(self, direction, cursor: Cursor | None, limit, inclusive=True) -> List[Message]:
+        """
+        @return: 游标之前（或之后）的limit条消息，按direction的顺序排列
+        """
+        sort_seq, seen = cursor if cursor else (None, frozenset())
+        messages = self.database.get_messages_page(
+            self.username, sort_seq, direction, limit + len(seen), inclusive and sort_seq is not None
+        )
+        if seen:
+            messages = [
+                message for message in messages
+                if not (message.sort_seq == sort_seq and message_key(message) in seen)
+            ]
+        return messages[:limit]
+
+    def _page(self, direction, cursor, limit) -> ChatPage:
+        messages = self._fetch(direction, cursor, limit)
+        if direction == 'before':
+            messages.reverse()
+            return ChatPage(messages, has_before=len(messages) == limit, has_after=cursor is not None)
+        return ChatPage(messages, has_before=cursor is not None, has_after=len(messages) == limit)
+
+    def latest(self, limit=None) -> ChatPage:
+        """
+        最新的一页消息，打开聊天时调用
+        """
+        limit = limit or self.page_size
+        return self._cached(('before', None, limit), lambda: self._page('before', None, limit))
+
+    def earliest(self, limit=None) -> ChatPage:
+        """
+        最早的一页消息
+        """
+        limit = limit or self.page_size
+        return self._cached(('after', None, limit), lambda: self._page('after', None, limit))
+
+    def before(self, cursor: ChatPage | Cursor, limit=None) -> ChatPage:
+        """
+        向上翻页
+        @param cursor: 当前显示的页面或者它的before_cursor
+        """
+        if isinstance(cursor, ChatPage):
+            cursor = cursor.before_cursor
+        if cursor is None:
+            return ChatPage([], has_before=False)
+        limit = limit or self.page_size
+        return self._cached(('before', cursor, limit), lambda: self._page('before', cursor, limit))
+
+    def after(self, cursor: ChatPage | Cursor, limit=None) -> ChatPage:
+        """
+        向下翻页
+        @param cursor: 当前显示的页面或者它的after_cursor
+        """
+        if isinstance(cursor, ChatPage):
+            cursor = cursor.after_cursor
+        if cursor is None:
+            return ChatPage([], has_after=False)
+        limit = limit or self.page_size
+        return self._cached(('after', cursor, limit), lambda: self._page('after', cursor, limit))
+
+    def around(self, sort_seq, limit=None) -> ChatPage:
+        """
+        以sort_seq为中心的一页消息，anchor是第一条sort_seq不小于它的消息的下标
+        """
+        limit = limit or self.page_size
+
+        def load():
+            half = limit // 2
+            older = self._fetch('before', (sort_seq, frozenset()), half, inclusive=False)
+            newer = self._fetch('after', (sort_seq, frozenset()), limit - half, inclusive=True)
+            older.reverse()
+            return ChatPage(
+                older + newer,
+                has_before=len(older) == half,
+                has_after=len(newer) == limit - half,
+                anchor=len(older)
+            )
+
+        return self._cached(('around', sort_seq, limit), load)
+
+    def around_time(self, timestamp, limit=None) -> ChatPage:
+        """
+        跳转到某个时间，例如在聊天日历里选择了某一天
+        @param timestamp: 时间戳（秒）
+        """
+        sort_seq = self.database.get_sort_seq_by_time(self.username, timestamp)
+        if sort_seq is None:
+            # 这个时间之后没有消息，显示最新的消息
+            return self.latest(limit)
+        return self.around(sort_seq, limit)
+
+    def around_server_id(self, server_id, limit=None) -> ChatPage | None:
+        """
+        跳转到某条消息，例如点击了引用消息
+        @return: 找不到这条消息时返回None
+        """
+        message = self.database.get_message_by_server_id(self.username, server_id)
+        if message is None:
+            return None
+        page = self.around(message.sort_seq, limit)
+        anchor = page.anchor
+        for index in range(page.anchor, len(page.messages)):
+            if message_key(page.messages[index]) == message_key(message):
+                anchor = index
+                break
+        # 缓存里的页面可能被其他跳转共用，不修改它的anchor
+        return ChatPage(page.messages, page.has_before, page.has_after, anchor)
+
+
+if __name__ == '__main__':
+    pass
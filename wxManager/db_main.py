@@ -13,7 +13,7 @@ from abc import ABC, abstractmethod
 
 import os
 from datetime import date
-from typing import List, Any, Tuple
+from typing import List, Any, Tuple, Dict
 
 from wxManager import MessageType
 from wxManager.model.contact import Contact
@@ -44,6 +44,38 @@ class DataBaseInterface(ABC):
     ):
         raise ValueError("子类必须实现该方法")
 
+    def iter_messages(
+            self,
+            username_: str,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            start_sort_seq=None,
+    ):
+        """
+        按时间顺序逐条生成消息，结果与get_messages相同，但不会把整个聊天的消息都加载进内存
+        @param username_:
+        @param time_range:
+        @param start_sort_seq: 只返回sort_seq不小于它的消息，用于增量导出
+        @return: Message的迭代器
+        """
+        raise ValueError("子类必须实现该方法")
+
+    def iter_messages_by_type(
+            self,
+            username_: str,
+            type_: MessageType,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            start_sort_seq=None,
+    ):
+        """
+        按时间顺序逐条生成指定类型的消息，结果与get_messages_by_type相同
+        @param username_:
+        @param type_:
+        @param time_range:
+        @param start_sort_seq: 只返回sort_seq不小于它的消息，用于增量导出
+        @return: Message的迭代器
+        """
+        raise ValueError("子类必须实现该方法")
+
     def get_messages_by_num(self, username, start_sort_seq, msg_num=20):
         """
         获取小于start_sort_seq的msg_num个消息
@@ -54,6 +86,35 @@ class DataBaseInterface(ABC):
         """
         raise ValueError("子类必须实现该方法")
 
+    def get_messages_page(self, username, sort_seq=None, direction='before', limit=20, inclusive=False):
+        """
+        键集分页获取消息
+        @param username:
+        @param sort_seq: 游标，None表示从最新（before）或最早（after）的消息开始
+        @param direction: before按sort_seq降序返回更早的消息，after按sort_seq升序返回更晚的消息
+        @param limit:
+        @param inclusive: 是否包含sort_seq等于游标的消息
+        @return: 消息列表
+        """
+        raise ValueError("子类必须实现该方法")
+
+    def get_sort_seq_by_time(self, username, timestamp):
+        """
+        @param timestamp: 时间戳（秒）
+        @return: 不早于timestamp的第一条消息的sort_seq，没有这样的消息时返回None
+        """
+        raise ValueError("子类必须实现该方法")
+
+    def get_chat_window(self, username, page_size=50, cache_size=16):
+        """
+        聊天界面使用的分页窗口，可以向前、向后翻页或者跳转到某个时间、某条消息
+        @param page_size: 每页的消息数
+        @param cache_size: 缓存的页数
+        @return: ChatWindow
+        """
+        from wxManager.chat_window import ChatWindow
+        return ChatWindow(self, username, page_size, cache_size)
+
     def get_message_by_server_id(self, username, server_id):
         """
         获取小于start_sort_seq的msg_num个消息
@@ -118,7 +179,15 @@ class DataBaseInterface(ABC):
             self,
             username_,
             time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            start_sort_seq=None,
     ) -> int:
+        """
+        只查询消息数量，不解析消息
+        @param username_:
+        @param time_range:
+        @param start_sort_seq: 只统计sort_seq不小于它的消息，与iter_messages相同
+        @return: 消息数量
+        """
         raise ValueError("子类必须实现该方法")
 
     def get_chatted_top_contacts(
@@ -200,6 +269,14 @@ class DataBaseInterface(ABC):
     def get_avatar_buffer(self, username) -> bytes:
         raise ValueError("子类必须实现该方法")
 
+    def get_avatar_buffers(self, usernames: List[str]) -> Dict[str, bytes]:
+        """
+        一次查询多个联系人的头像
+        @param usernames: 联系人wxid列表
+        @return: {wxid: 头像数据}，没有头像的联系人不在结果里
+        """
+        raise ValueError("子类必须实现该方法")
+
     def get_contacts(self) -> List[Contact]:
         raise ValueError("子类必须实现该方法")
 
@@ -221,11 +298,25 @@ class DataBaseInterface(ABC):
         raise ValueError("子类必须实现该方法")
 
     # 联系人结束
-    def merge(self, db_paths):
+    def merge(self, db_paths, tables: List[str] = None, dry_run=False, exact=False) -> dict:
         """
         增量将db_path中的数据合入到数据库中，若存在冲突则以db_path中的数据为准
         @param db_paths:
-        @return:
+        @param tables: 只合并这些表，支持通配符，默认合并所有表
+        @param dry_run: 只生成合并计划，不写入数据
+        @param exact: 生成计划时精确计算新增行数
+        @return: 合并计划
+        """
+        raise ValueError("子类必须实现该方法")
+
+    def plan_merge(self, db_paths, tables: List[str] = None, exact=False, output_path=None) -> dict:
+        """
+        生成合并计划：估算每张表要新增、更新的行数和写入的字节数，不修改数据库
+        @param db_paths:
+        @param tables: 只估算这些表，支持通配符
+        @param exact: 精确计算新增行数
+        @param output_path: 合并计划保存成json文件的路径
+        @return: 合并计划
         """
         raise ValueError("子类必须实现该方法")
 
@@ -1,5 +1,4 @@
 import os.path
-import shutil
 import subprocess
 import sys
 import traceback
@@ -8,7 +7,7 @@ import base64
 
 import xml.etree.ElementTree as ET
 
-from wxManager.merge import increase_data
+from wxManager.merge import copy_new_shard, increase_data
 from wxManager.log import logger
 from wxManager.model import DataBaseBase
 
@@ -166,7 +165,7 @@ class MediaMsg(DataBaseBase):
                     task_(db_path, cursor, db)
                     tasks.append([db_path, cursor, db])
                 else:
-                    shutil.copy(db_path, os.path.join(self.db_dir, 'Multi', file_name))
+                    copy_new_shard(db_path, os.path.join(self.db_dir, 'Multi', file_name))
         # print(tasks)
         # 使用线程池 (没有加快合并速度)
         # with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
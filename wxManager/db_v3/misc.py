@@ -33,6 +33,31 @@ class Misc(DataBaseBase):
         else:
             return b''
 
+    def get_avatar_buffers(self, usernames):
+        """
+        批量查询头像，每次查询最多900个wxid（SQLite参数个数限制为999）
+        @param usernames: wxid列表
+        @return: {wxid: 头像数据}
+        """
+        result = {}
+        if not self.open_flag:
+            return result
+        usernames = list(dict.fromkeys(usernames))
+        cursor = self.DB.cursor()
+        for i in range(0, len(usernames), 900):
+            chunk = usernames[i:i + 900]
+            sql = f'''
+                select usrName, smallHeadBuf
+                from ContactHeadImg1
+                where usrName in ({','.join('?' * len(chunk))})
+            '''
+            cursor.execute(sql, chunk)
+            for username, image_buffer in cursor.fetchall():
+                if image_buffer:
+                    result[username] = image_buffer
+        cursor.close()
+        return result
+
     def set_avatar_buffer(self, username, img_path):
         try:
             # 打开图片并缩放
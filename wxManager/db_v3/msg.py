@@ -1,16 +1,15 @@
 import os.path
-import shutil
 import sqlite3
 import traceback
 import concurrent
 import hashlib
-import threading
+import heapq
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date
 from typing import Tuple
 
 from wxManager import MessageType
-from wxManager.merge import increase_data, increase_update_data
+from wxManager.merge import MergeTable, copy_new_shard, database_path, merge_shards
 from wxManager.log import logger
 from wxManager.model import DataBaseBase
 
@@ -89,49 +88,61 @@ def get_local_type(type_: MessageType):
 
 
 class Msg(DataBaseBase):
+    # 合并新解密的数据库时各表的合并方式
+    merge_tables = [
+        MergeTable('Name2Id', 'UsrName'),
+        MergeTable('DBInfo', 'tableIndex', update=True),
+        MergeTable('MSG', 'MsgSvrID', exclude_column='localId'),
+    ]
 
-    def _get_messages_by_num(self, cursor, username_, start_sort_seq, msg_num):
-        sql = '''
+    def _get_messages_page(self, cursor, username_, sort_seq, direction, limit, inclusive=False):
+        condition, params, order = self.page_clause('CreateTime', sort_seq, direction, inclusive)
+        sql = f'''
             select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,CompressContent,DisplayContent
             from MSG
-            where StrTalker = ? and CreateTime < ?
-            order by CreateTime desc 
+            where StrTalker = ? {condition}
+            order by CreateTime {order}
             limit ?
         '''
-        cursor.execute(sql, [username_, start_sort_seq, msg_num])
+        cursor.execute(sql, [username_, *params, limit])
         result = cursor.fetchall()
         if result:
             return result
         else:
             return []
 
-    def get_messages_by_num(self, username, start_sort_seq, msg_num=20):
-        results = []
-        # for db in self.DB:
-        #     cursor = db.cursor()
-        #     yield self._get_messages_by_num(cursor, username, start_sort_seq, msg_num)
-        lock = threading.Lock()  # 锁，用于确保线程安全地写入 results
-
+    def get_messages_page(self, username, sort_seq=None, direction='before', limit=20, inclusive=False):
+        """
+        键集分页：获取游标之前（或之后）的limit条消息
+        每个分库最多预取limit条，多路归并后只取前limit条
+        @param username:
+        @param sort_seq: 游标（CreateTime），None表示从最新（before）或最早（after）的消息开始
+        @param direction: before按CreateTime降序返回更早的消息，after按CreateTime升序返回更晚的消息
+        @param limit:
+        @param inclusive: 是否包含CreateTime等于游标的消息
+        @return: 消息行
+        """
         def task(db):
-            """
-            每个线程执行的任务，获取某个数据库实例中的查询结果。
-            """
             cursor = db.cursor()
             try:
-                data = self._get_messages_by_num(cursor, username, start_sort_seq, msg_num)
-                with lock:  # 确保对 results 的操作是线程安全的
-                    results.append(data)
+                return self._get_messages_page(cursor, username, sort_seq, direction, limit, inclusive)
             finally:
                 cursor.close()
 
-        # 使用线程池
+        # 使用线程池，map按分库顺序返回结果
         with ThreadPoolExecutor(max_workers=len(self.DB)) as executor:
-            executor.map(task, self.DB)
-        self.commit()
-        return results
+            results = list(executor.map(task, self.DB))
+        return self.merge_sorted(results, key=lambda row: row[5], reverse=direction == 'before', limit=limit)
 
-    def _get_messages_by_username(self, cursor, username: str,
-                                  time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
+    def get_messages_by_num(self, username, start_sort_seq, msg_num=20):
+        """
+        获取CreateTime小于start_sort_seq的msg_num条消息
+        @return: 按CreateTime降序排列的消息行
+        """
+        return self.get_messages_page(username, start_sort_seq, 'before', msg_num)
+
+    def _get_messages_sql(self, time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                          start_sort_seq=None):
         if time_range:
             start_time, end_time = convert_to_timestamp(time_range)
         sql = f'''
@@ -139,8 +150,19 @@ class Msg(DataBaseBase):
             from MSG
             where StrTalker=?
             {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
+            {'AND CreateTime>=' + str(int(start_sort_seq)) if start_sort_seq is not None else ''}
             order by CreateTime
         '''
+        return sql
+
+    def get_messages_number(self, username: str,
+                            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                            start_sort_seq=None) -> int:
+        return self.count_rows(self._get_messages_sql(time_range, start_sort_seq), [username])
+
+    def _get_messages_by_username(self, cursor, username: str,
+                                  time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
+        sql = self._get_messages_sql(time_range)
         cursor.execute(sql, [username])
         result = cursor.fetchall()
         if result:
@@ -148,6 +170,22 @@ class Msg(DataBaseBase):
         else:
             return []
 
+    def iter_messages_by_username(self, username: str,
+                                  time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                                  batch_size=1000, start_sort_seq=None):
+        """
+        按CreateTime顺序逐条返回所有分库中的消息
+        每个分库用独立的游标分批读取，再多路归并，不会把整个聊天的消息一次性读进内存
+        @param username:
+        @param time_range:
+        @param batch_size: 每个分库每次读取的行数
+        @param start_sort_seq: 只返回CreateTime（v3消息的sort_seq）不小于它的消息，用于增量导出
+        @return: 消息行的迭代器
+        """
+        sql = self._get_messages_sql(time_range, start_sort_seq)
+        shards = [self.iter_rows(db, sql, [username], batch_size) for db in self.DB]
+        return heapq.merge(*shards, key=lambda row: row[5])
+
     def get_messages_by_username(self, username: str,
                                  time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
         with concurrent.futures.ThreadPoolExecutor() as executor:
@@ -157,15 +195,10 @@ class Msg(DataBaseBase):
                 for db in self.DB
             ]
 
-            # 等待所有任务完成，并获取结果
-            results = []
-            for future in concurrent.futures.as_completed(futures):
-                r1 = future.result()
-                if r1:
-                    # results.append(future.result())
-                    results.extend(r1)
+            # 按分库顺序取结果，每个分库已经按CreateTime排好序，多路归并即可
+            results = [future.result() for future in futures]
 
-        return results
+        return self.merge_sorted(results, key=lambda row: row[5])
 
     def get_message_by_server_id(self, username, server_id):
         """
@@ -212,8 +245,9 @@ class Msg(DataBaseBase):
         res.sort()
         return res
 
-    def _get_messages_by_type(self, cursor, username: str, type_: MessageType,
-                              time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
+    def _get_messages_by_type_sql(self, type_: MessageType,
+                                  time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                                  start_sort_seq=None):
         if time_range:
             start_time, end_time = convert_to_timestamp(time_range)
         local_type, sub_type = get_local_type(type_)
@@ -222,15 +256,31 @@ class Msg(DataBaseBase):
             from MSG
             where StrTalker=? and Type=? and SubType = ?
             {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
+            {'AND CreateTime>=' + str(int(start_sort_seq)) if start_sort_seq is not None else ''}
             order by CreateTime
         '''
-        cursor.execute(sql, [username, local_type, sub_type])
+        return sql, [local_type, sub_type]
+
+    def _get_messages_by_type(self, cursor, username: str, type_: MessageType,
+                              time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
+        sql, params = self._get_messages_by_type_sql(type_, time_range)
+        cursor.execute(sql, [username, *params])
         result = cursor.fetchall()
         if result:
             return result
         else:
             return None
 
+    def iter_messages_by_type(self, username: str, type_: MessageType,
+                              time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                              batch_size=1000, start_sort_seq=None):
+        """
+        按CreateTime顺序逐条返回所有分库中指定类型的消息，参数同iter_messages_by_username
+        """
+        sql, params = self._get_messages_by_type_sql(type_, time_range, start_sort_seq)
+        shards = [self.iter_rows(db, sql, [username, *params], batch_size) for db in self.DB]
+        return heapq.merge(*shards, key=lambda row: row[5])
+
     def get_messages_by_type(self, username: str, type_: MessageType,
                              time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
         with concurrent.futures.ThreadPoolExecutor() as executor:
@@ -240,15 +290,10 @@ class Msg(DataBaseBase):
                 for db in self.DB
             ]
 
-            # 等待所有任务完成，并获取结果
-            results = []
-            for future in concurrent.futures.as_completed(futures):
-                r1 = future.result()
-                if r1:
-                    # results.append(future.result())
-                    results.extend(r1)
+            # 按分库顺序取结果，每个分库已经按CreateTime排好序，多路归并即可
+            results = [future.result() for future in futures]
 
-        return results
+        return self.merge_sorted(results, key=lambda row: row[5])
 
     def update_audio_text(self, MsgSvrID_, voicetrans_text):
         voicetrans_tag = f'<voicetrans transtext="{voicetrans_text}" istransend="true" tranfailfinish="0" />'
@@ -271,15 +316,13 @@ class Msg(DataBaseBase):
             lock.release()
 
     def merge(self, db_file_name):
-        def task_(db_path, cursor, db):
-            """
-            每个线程执行的任务，获取某个数据库实例中的查询结果。
-            """
-            increase_data(db_path, cursor, db, 'Name2Id', 'UsrName')
-            increase_update_data(db_path, cursor, db, 'DBInfo', 'tableIndex')
-            increase_data(db_path, cursor, db, 'MSG', 'MsgSvrID', exclude_column='localId')
-
-        tasks = []
+        """
+        合并新解密的数据库：每个分片使用独立的连接，新数据库只ATTACH一次，所有表在一个事务里合并，
+        各分片并行合并
+        @param db_file_name: 新数据库第一个分片的路径
+        @return:
+        """
+        shards = []
         for i in range(100):
             db_path = db_file_name.replace('0', f'{i}')
             if os.path.exists(db_path):
@@ -287,15 +330,10 @@ class Msg(DataBaseBase):
                 file_name = os.path.basename(db_path)
                 if file_name in self.db_file_name:
                     index = self.db_file_name.index(file_name)
-                    db = self.DB[index]
-                    cursor = db.cursor()
-                    task_(db_path, cursor, db)
-                    tasks.append([db_path, cursor, db])
+                    shards.append((database_path(self.DB[index]), db_path))
                 else:
-                    shutil.copy(db_path, os.path.join(self.db_dir, 'Multi', file_name))
-        # print(tasks)
-        # 使用线程池 (没有加快合并速度)
-        # with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
-        #     executor.map(lambda args: task_(*args), tasks)
+                    copy_new_shard(db_path, os.path.join(self.db_dir, 'Multi', file_name))
+        # 已有连接上不能有未提交的事务，否则合并连接拿不到写锁
         self.commit()
-        print(len(tasks))
+        merge_shards(shards, self.merge_tables)
+        print(len(shards))
@@ -103,36 +103,43 @@ def get_local_type(type_: MessageType):
 
 class OpenIMMsgDB(DataBaseBase):
 
-    def _get_messages_by_num(self, cursor, username_, start_sort_seq, msg_num):
+    def _get_messages_page(self, cursor, username_, sort_seq, direction, limit, inclusive=False):
         """
 
         @param cursor:
         @param username_:
-        @param start_sort_seq:
-        @param msg_num:
+        @param sort_seq: 游标（CreateTime）
+        @param direction: before或after
+        @param limit:
+        @param inclusive: 是否包含CreateTime等于游标的消息
         @return:
         """
-        sql = '''
+        condition, params, order = self.page_clause('CreateTime', sort_seq, direction, inclusive)
+        sql = f'''
         select localId,TalkerId,Type,statusEx,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,'',Reserved1
         from ChatCRMsg
-        where StrTalker = ? and CreateTime < ?
-        order by CreateTime desc 
+        where StrTalker = ? {condition}
+        order by CreateTime {order}
         limit ?
         '''
-        cursor.execute(sql, [username_, start_sort_seq, msg_num])
+        cursor.execute(sql, [username_, *params, limit])
         result = cursor.fetchall()
         if result:
             return result
         else:
             return []
 
+    def get_messages_page(self, username, sort_seq=None, direction='before', limit=20, inclusive=False):
+        """
+        键集分页：获取游标之前（或之后）的limit条消息，参数同Msg.get_messages_page
+        """
+        return self._get_messages_page(self.DB.cursor(), username, sort_seq, direction, limit, inclusive)
+
     def get_messages_by_num(self, username, start_sort_seq, msg_num=20):
-        results = [self._get_messages_by_num(self.DB.cursor(), username, start_sort_seq, msg_num)]
-        self.commit()
-        return results
+        return self.get_messages_page(username, start_sort_seq, 'before', msg_num)
 
-    def _get_messages_by_username(self, cursor, username: str,
-                                  time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
+    def _get_messages_sql(self, time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                          start_sort_seq=None):
         if time_range:
             start_time, end_time = convert_to_timestamp(time_range)
         sql = f'''
@@ -140,8 +147,19 @@ class OpenIMMsgDB(DataBaseBase):
         from ChatCRMsg
         where StrTalker=?
         {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
+        {'AND CreateTime>=' + str(int(start_sort_seq)) if start_sort_seq is not None else ''}
         order by CreateTime
         '''
+        return sql
+
+    def get_messages_number(self, username: str,
+                            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                            start_sort_seq=None) -> int:
+        return self.count_rows(self._get_messages_sql(time_range, start_sort_seq), [username])
+
+    def _get_messages_by_username(self, cursor, username: str,
+                                  time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
+        sql = self._get_messages_sql(time_range)
         cursor.execute(sql, [username])
         result = cursor.fetchall()
         if result:
@@ -10,16 +10,15 @@
 """
 import concurrent
 import hashlib
+import heapq
 import os
-import shutil
-import sqlite3
 import threading
 from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime
 from typing import Tuple
 
 from wxManager import MessageType
-from wxManager.merge import increase_data, increase_update_data
+from wxManager.merge import MergeTable, copy_new_shard, database_path, merge_shards
 from wxManager.model.db_model import DataBaseBase
 
 
@@ -66,6 +65,14 @@ class BizMessageDB(DataBaseBase):
         "local_id,server_id,local_type,sort_seq,Name2Id.user_name as sender_username,create_time,strftime('%Y-%m-%d %H:%M:%S',"
         "create_time,'unixepoch','localtime') as StrTime,status,upload_status,server_seq,origin_source,source,"
         "message_content,compress_content")
+    # 合并新解密的数据库时各表的合并方式
+    merge_tables = [
+        MergeTable('Name2Id', 'user_name'),
+        MergeTable('TimeStamp', 'timestamp', update=True),
+        MergeTable('Msg', 'server_id', exclude_column='local_id', prefix=True),
+    ]
+
+    page_executor = None  # 分页查询复用的线程池，第一次分页时创建
 
     def get_messages(self):
         pass
@@ -77,20 +84,36 @@ class BizMessageDB(DataBaseBase):
         # 如果结果不为空，表存在；否则表不存在
         return result
 
-    def _get_messages_by_username(self, cursor, username: str,
-                                  time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
+    def _get_messages_sql(self, username: str,
+                          time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                          start_sort_seq=None):
         table_name = f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
-        if not self.table_exists(cursor, table_name):
-            return None
+        conditions = []
         if time_range:
             start_time, end_time = convert_to_timestamp(time_range)
+            conditions.append(f'create_time>{start_time} AND create_time<{end_time}')
+        if start_sort_seq is not None:
+            conditions.append(f'sort_seq>={int(start_sort_seq)}')
         sql = f'''
 select {BizMessageDB.columns}
 from {table_name} as msg
 join Name2Id on msg.real_sender_id = Name2Id.rowid
-{'where create_time>' + str(start_time) + ' AND create_time<' + str(end_time) if time_range else ''}
+{'where ' + ' AND '.join(conditions) if conditions else ''}
 order by sort_seq
         '''
+        return table_name, sql
+
+    def get_messages_number(self, username: str,
+                            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                            start_sort_seq=None) -> int:
+        table_name, sql = self._get_messages_sql(username, time_range, start_sort_seq)
+        return self.count_rows(sql, table_name=table_name)
+
+    def _get_messages_by_username(self, cursor, username: str,
+                                  time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
+        table_name, sql = self._get_messages_sql(username, time_range)
+        if not self.table_exists(cursor, table_name):
+            return None
         cursor.execute(sql)
         result = cursor.fetchall()
         if result:
@@ -98,6 +121,25 @@ order by sort_seq
         else:
             return None
 
+    def iter_messages_by_username(self, username: str,
+                                  time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                                  batch_size=1000, start_sort_seq=None):
+        """
+        按sort_seq顺序逐条返回所有分库中的消息
+        每个分库用独立的游标分批读取，再多路归并，不会把整个聊天的消息一次性读进内存
+        @param username:
+        @param time_range:
+        @param batch_size: 每个分库每次读取的行数
+        @param start_sort_seq: 只返回sort_seq不小于它的消息，用于增量导出
+        @return: 消息行的迭代器
+        """
+        table_name, sql = self._get_messages_sql(username, time_range, start_sort_seq)
+        shards = [
+            self.iter_rows(db, sql, batch_size=batch_size)
+            for db in self.DB if self.table_exists(db.cursor(), table_name)
+        ]
+        return heapq.merge(*shards, key=lambda row: row[3])
+
     def get_messages_by_username(self, username: str,
                                  time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
         with concurrent.futures.ThreadPoolExecutor() as executor:
@@ -107,15 +149,10 @@ order by sort_seq
                 for db in self.DB
             ]
 
-            # 等待所有任务完成，并获取结果
-            results = []
-            for future in concurrent.futures.as_completed(futures):
-                r1 = future.result()
-                if r1:
-                    # results.append(future.result())
-                    results.extend(r1)
+            # 按分库顺序取结果，每个分库已经按sort_seq排好序，多路归并即可
+            results = [future.result() for future in futures]
 
-        return results
+        return self.merge_sorted(results, key=lambda row: row[3])
         results = []
         # for db in self.DB:
         #     cursor = db.cursor()
@@ -140,19 +177,20 @@ order by sort_seq
         self.commit()
         return results
 
-    def _get_messages_by_num(self, cursor, username, start_sort_seq, msg_num):
+    def _get_messages_page(self, cursor, username, sort_seq, direction, limit, inclusive=False):
         table_name = f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
         if not self.table_exists(cursor, table_name):
             return []
+        condition, params, order = self.page_clause('sort_seq', sort_seq, direction, inclusive)
         sql = f'''
         select {BizMessageDB.columns}
         from {table_name} as msg
         join Name2Id on msg.real_sender_id = Name2Id.rowid
-        where sort_seq < ?
-        order by sort_seq desc 
+        where 1=1 {condition}
+        order by sort_seq {order}
         limit ?
                 '''
-        cursor.execute(sql, [start_sort_seq, msg_num])
+        cursor.execute(sql, [*params, limit])
         result = cursor.fetchall()
         if result:
             return result
@@ -182,30 +220,50 @@ where server_id = ?
             if result:
                 return result
 
-    def get_messages_by_num(self, username, start_sort_seq, msg_num=20):
-        results = []
-        # for db in self.DB:
-        #     cursor = db.cursor()
-        #     yield self._get_messages_by_num(cursor, username, start_sort_seq, msg_num)
-        lock = threading.Lock()  # 锁，用于确保线程安全地写入 results
-
+    def get_messages_page(self, username, sort_seq=None, direction='before', limit=20, inclusive=False):
+        """
+        键集分页：获取游标之前（或之后）的limit条消息
+        每个分库最多预取limit条，多路归并后只取前limit条
+        @param username:
+        @param sort_seq: 游标，None表示从最新（before）或最早（after）的消息开始
+        @param direction: before按sort_seq降序返回更早的消息，after按sort_seq升序返回更晚的消息
+        @param limit:
+        @param inclusive: 是否包含sort_seq等于游标的消息
+        @return: 消息行
+        """
         def task(db):
-            """
-            每个线程执行的任务，获取某个数据库实例中的查询结果。
-            """
             cursor = db.cursor()
             try:
-                data = self._get_messages_by_num(cursor, username, start_sort_seq, msg_num)
-                with lock:  # 确保对 results 的操作是线程安全的
-                    results.append(data)
+                return self._get_messages_page(cursor, username, sort_seq, direction, limit, inclusive)
             finally:
                 cursor.close()
 
-        # 使用线程池
-        with ThreadPoolExecutor(max_workers=len(self.DB)) as executor:
-            executor.map(task, self.DB)
-        self.commit()
-        return results
+        if len(self.DB) == 1:
+            results = [task(self.DB[0])]
+        else:
+            # 翻页很频繁，线程池只创建一次；map按分库顺序返回结果
+            if self.page_executor is None:
+                self.page_executor = ThreadPoolExecutor(max_workers=len(self.DB), thread_name_prefix='message_page')
+            results = list(self.page_executor.map(task, self.DB))
+        return self.merge_sorted(results, key=lambda row: row[3], reverse=direction == 'before', limit=limit)
+
+    def get_sort_seq_by_time(self, username, timestamp):
+        """
+        不早于timestamp的第一条消息的sort_seq
+        @param timestamp: 时间戳（秒）
+        @return: 没有这样的消息时返回None
+        """
+        table_name = f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
+        sql = f'select min(sort_seq) from {table_name} where create_time >= ?'
+        sort_seqs = [value for value in self._shard_values(sql, [int(timestamp)], table_name) if value is not None]
+        return min(sort_seqs) if sort_seqs else None
+
+    def get_messages_by_num(self, username, start_sort_seq, msg_num=20):
+        """
+        获取sort_seq小于start_sort_seq的msg_num条消息
+        @return: 按sort_seq降序排列的消息行
+        """
+        return self.get_messages_page(username, start_sort_seq, 'before', msg_num)
 
     def _get_messages_calendar(self, cursor, username):
         """
@@ -233,11 +291,10 @@ where server_id = ?
         res.sort()
         return res
 
-    def _get_messages_by_type(self, cursor, username: str, type_: MessageType,
-                              time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
+    def _get_messages_by_type_sql(self, username: str, type_: MessageType,
+                                  time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                                  start_sort_seq=None):
         table_name = f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
-        if not self.table_exists(cursor, table_name):
-            return None
         if time_range:
             start_time, end_time = convert_to_timestamp(time_range)
         local_type = get_local_type(type_)
@@ -246,15 +303,36 @@ select {BizMessageDB.columns}
 from {table_name} as msg
 join Name2Id on msg.real_sender_id = Name2Id.rowid
 where local_type=? {'and create_time>' + str(start_time) + ' AND create_time<' + str(end_time) if time_range else ''}
+{'and sort_seq>=' + str(int(start_sort_seq)) if start_sort_seq is not None else ''}
 order by sort_seq
         '''
-        cursor.execute(sql, [local_type])
+        return table_name, sql, [local_type]
+
+    def _get_messages_by_type(self, cursor, username: str, type_: MessageType,
+                              time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
+        table_name, sql, params = self._get_messages_by_type_sql(username, type_, time_range)
+        if not self.table_exists(cursor, table_name):
+            return None
+        cursor.execute(sql, params)
         result = cursor.fetchall()
         if result:
             return result
         else:
             return None
 
+    def iter_messages_by_type(self, username: str, type_: MessageType,
+                              time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                              batch_size=1000, start_sort_seq=None):
+        """
+        按sort_seq顺序逐条返回所有分库中指定类型的消息，参数同iter_messages_by_username
+        """
+        table_name, sql, params = self._get_messages_by_type_sql(username, type_, time_range, start_sort_seq)
+        shards = [
+            self.iter_rows(db, sql, params, batch_size=batch_size)
+            for db in self.DB if self.table_exists(db.cursor(), table_name)
+        ]
+        return heapq.merge(*shards, key=lambda row: row[3])
+
     def get_messages_by_type(self, username: str, type_: MessageType,
                              time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
         with concurrent.futures.ThreadPoolExecutor() as executor:
@@ -264,37 +342,25 @@ order by sort_seq
                 for db in self.DB
             ]
 
-            # 等待所有任务完成，并获取结果
-            results = []
-            for future in concurrent.futures.as_completed(futures):
-                r1 = future.result()
-                if r1:
-                    # results.append(future.result())
-                    results.extend(r1)
+            # 按分库顺序取结果，每个分库已经按sort_seq排好序，多路归并即可
+            results = [future.result() for future in futures]
 
-        return results
+        return self.merge_sorted(results, key=lambda row: row[3])
 
-    def merge(self, db_file_name):
-        def task_(db_path, cursor, db):
-            """
-            每个线程执行的任务，获取某个数据库实例中的查询结果。
-            """
-            increase_data(db_path, cursor, db, 'Name2Id', 'user_name')
-            increase_update_data(db_path, cursor, db, 'TimeStamp', 'timestamp')
-            tgt_conn = sqlite3.connect(db_path)
-            tgt_cur = tgt_conn.cursor()
-            tgt_cur.execute("SELECT name FROM sqlite_master WHERE type='table';")
-            result = tgt_cur.fetchall()
-            tgt_cur.close()
-            tgt_conn.close()
-            # print(result)
-            if result:
-                for row in result:
-                    table_name = row[0]
-                    if table_name.startswith('Msg'):
-                        increase_data(db_path, cursor, db, table_name, 'server_id', exclude_column='local_id')
+    def close(self):
+        if self.page_executor is not None:
+            self.page_executor.shutdown(wait=False)
+            self.page_executor = None
+        super().close()
 
-        tasks = []
+    def merge(self, db_file_name):
+        """
+        合并新解密的数据库：每个分片使用独立的连接，新数据库只ATTACH一次，所有表在一个事务里合并，
+        各分片并行合并
+        @param db_file_name: 新数据库第一个分片的路径
+        @return:
+        """
+        shards = []
         for i in range(100):
             db_path = db_file_name.replace('0', f'{i}')
             if os.path.exists(db_path):
@@ -302,15 +368,10 @@ order by sort_seq
                 file_name = os.path.basename(db_path)
                 if file_name in self.db_file_name:
                     index = self.db_file_name.index(file_name)
-                    db = self.DB[index]
-                    cursor = db.cursor()
-                    task_(db_path, cursor, db)
-                    tasks.append([db_path, cursor, db])
+                    shards.append((database_path(self.DB[index]), db_path))
                 else:
-                    shutil.copy(db_path, os.path.join(self.db_dir, 'message'))
-        # print(tasks)
-        # 使用线程池 (没有加快合并速度)
-        # with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
-        #     executor.map(lambda args: task_(*args), tasks)
+                    copy_new_shard(db_path, os.path.join(self.db_dir, 'message', file_name))
+        # 已有连接上不能有未提交的事务，否则合并连接拿不到写锁
         self.commit()
-        print(len(tasks))
+        merge_shards(shards, self.merge_tables)
+        print(len(shards))
@@ -9,7 +9,9 @@
 @Description : 
 """
 import os
+import threading
 import traceback
+from typing import Callable, Dict
 
 from wxManager.merge import increase_update_data, increase_data
 from wxManager.model.db_model import DataBaseBase
@@ -48,6 +50,23 @@ class ContactDB(DataBaseBase):
             return ''
         return ','.join(map(self.get_label_by_id, label_id_list.strip(',').split(',')))
 
+    def get_label_map(self) -> Dict[str, str]:
+        """
+        一次查出所有标签
+        @return: {标签id: 标签名}
+        """
+        sql = '''
+            select label_id_, label_name_ from contact_label
+        '''
+        try:
+            cursor = self.DB.cursor()
+            cursor.execute(sql)
+            result = cursor.fetchall()
+            cursor.close()
+            return {str(label_id): label_name for label_id, label_name in result}
+        except:
+            return {}
+
     def get_contacts(self):
         if not self.open_flag:
             return []
@@ -100,6 +119,22 @@ WHERE username=?
             return result
         return None
 
+    def get_all_contacts(self):
+        """
+        contact表中的所有联系人（包括陌生人、群成员），列的顺序和get_contact_by_username一样
+        """
+        if not self.open_flag:
+            return []
+        sql = '''
+SELECT username, alias, local_type,flag, remark, nick_name, pin_yin_initial, remark_pin_yin_initial, small_head_url, big_head_url,extra_buffer,head_img_md5,chat_room_notify,is_in_chat_room,description,chat_room_type
+FROM contact
+        '''
+        cursor = self.DB.cursor()
+        cursor.execute(sql)
+        result = cursor.fetchall()
+        cursor.close()
+        return result
+
     def get_chatroom_info(self, username):
         sql = '''
 select id,ext_buffer,username,owner
@@ -115,7 +150,7 @@ where username=?
         return None
 
     def set_remark(self, username, remark):
-        if not remark:
+        if remark is None:
             return False
         sql = '''
         update contact
@@ -148,5 +183,79 @@ where username=?
             self.DB.rollback()
 
 
+class ContactIndex:
+    """
+    联系人索引
+    需要查很多联系人时（联系人列表、群成员）调用load()，用一条SQL读出contact表，之后按wxid查联系人不再访问数据库；
+    没有load()时只查询用到的那一行，解析一两个联系人（例如单聊）不用读整张表。
+    标签用一条SQL全部读出；extra_buffer里的protobuf在联系人第一次被用到时才解析，创建好的联系人对象会被复用
+    """
+
+    def __init__(self, contact_db: ContactDB, factory: Callable):
+        """
+        @param contact_db: 联系人数据库
+        @param factory: 根据contact表的一行创建联系人，func(contact_info_list) -> Contact
+        """
+        self.contact_db = contact_db
+        self.factory = factory
+        self.rows = None  # wxid -> contact表的一行
+        self.labels = None  # 标签id -> 标签名
+        self.contacts = {}  # wxid -> 已经创建的联系人
+        self._lock = threading.RLock()  # 创建群聊联系人时会查询群成员，需要可重入
+
+    def load(self):
+        with self._lock:
+            if self.rows is None:
+                self.rows = {row[0]: row for row in self.contact_db.get_all_contacts()}
+
+    def load_labels(self):
+        with self._lock:
+            if self.labels is None:
+                self.labels = self.contact_db.get_label_map()
+
+    def clear(self):
+        """
+        数据库变化（合并）后调用，下次查询时重新加载
+        """
+        with self._lock:
+            self.rows = None
+            self.labels = None
+            self.contacts.clear()
+
+    def get(self, wxid):
+        """
+        @return: 联系人对象（多处共享，不要修改），contact表里没有时返回None
+        """
+        contact = self.contacts.get(wxid)
+        if contact is not None:
+            return contact
+        with self._lock:
+            contact = self.contacts.get(wxid)
+            if contact is None:
+                if self.rows is not None:
+                    row = self.rows.get(wxid)
+                else:
+                    row = self.contact_db.get_contact_by_username(wxid)
+                if row is None:
+                    return None
+                contact = self.factory(row)
+                self.contacts[wxid] = contact
+            return contact
+
+    def get_labels(self, label_id_list) -> str:
+        if not label_id_list:
+            return ''
+        self.load_labels()
+        return ','.join(self.labels.get(label_id, '') for label_id in label_id_list.strip(',').split(','))
+
+    def update_remark(self, wxid, remark):
+        with self._lock:
+            if self.rows is not None and wxid in self.rows:
+                row = list(self.rows[wxid])
+                row[4] = remark
+                self.rows[wxid] = tuple(row)
+            self.contacts.pop(wxid, None)
+
+
 if __name__ == '__main__':
     pass
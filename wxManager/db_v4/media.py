@@ -9,12 +9,11 @@
 @Description : 
 """
 import os
-import shutil
 import subprocess
 import sys
 import traceback
 
-from wxManager.merge import increase_update_data, increase_data
+from wxManager.merge import copy_new_shard, increase_data, increase_update_data
 from wxManager.model import DataBaseBase
 from wxManager.log import logger
 
@@ -104,7 +103,7 @@ class MediaDB(DataBaseBase):
             print(f'{db_path} 不存在')
             return
         if not self.DB:
-            shutil.copy(db_path,os.path.join(self.db_dir,self.db_file_name))
+            copy_new_shard(db_path, os.path.join(self.db_dir, self.db_file_name))
         else:
             for db in self.DB:
                 cursor = db.cursor()
@@ -308,7 +308,7 @@ def decode_wrapper(tasks):
     return decode_dat(*tasks)
 
 
-def batch_decode_image_multiprocessing(xor_key, file_infos: List[Tuple[str, str, str]]):
+def batch_decode_image_multiprocessing(xor_key, file_infos: List[Tuple[str, str, str]], executor=None):
     """
 
     :param xor_key: 异或加密密钥
@@ -316,6 +316,7 @@ def batch_decode_image_multiprocessing(xor_key, file_infos: List[Tuple[str, str,
     item: [input_path: 输入图片路径
             output_dir: 输出图片文件夹
             dst_name: 输出文件名]
+    :param executor: 共享的进程池，为空时临时创建一个
     :return:
     """
     if len(file_infos) < 1:
@@ -325,8 +326,10 @@ def batch_decode_image_multiprocessing(xor_key, file_infos: List[Tuple[str, str,
         k, m = divmod(len(lst), n)
         return [lst[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(n)]
 
+    tasks = [(xor_key, file_path, out_path, file_name) for file_path, out_path, file_name in file_infos]
+    if executor is not None:
+        return list(executor.map(decode_wrapper, tasks, chunksize=200))
     with ProcessPoolExecutor(max_workers=10) as executor:
-        tasks = [(xor_key, file_path, out_path, file_name) for file_path, out_path, file_name in file_infos]
         # print(len(split_list(tasks, 10)), '总任务数', len(file_infos))
         results = list(executor.map(decode_wrapper, tasks, chunksize=200))  # 使用顶层定义的函数
     return results
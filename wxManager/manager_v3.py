@@ -14,7 +14,7 @@ import re
 import traceback
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import date
-from typing import Tuple, List, Any
+from typing import Tuple, List, Any, Iterator, Dict
 
 import xmltodict
 
@@ -29,6 +29,8 @@ from wxManager.db_v3.misc import Misc
 from wxManager.db_v3.msg import Msg
 from wxManager.db_v3.media_msg import MediaMsg
 from wxManager.db_v3.emotion import Emotion
+from wxManager.merge import MergePlan, save_merge_plan
+from wxManager.model.wire import MessageBatch, pack_messages, unpack_messages
 from wxManager.db_v3.open_im_contact import OpenIMContactDB
 from wxManager.db_v3.open_im_media import OpenIMMediaDB
 from wxManager.db_v3.open_im_msg import OpenIMMsgDB
@@ -37,6 +39,7 @@ from wxManager.db_v3.micro_msg import MicroMsg
 from wxManager.db_v3.favorite import Favorite
 from wxManager.log import logger
 from wxManager.model.contact import Contact, Me, ContactType, Person
+from wxManager.model.message import Message
 from wxManager.parser.file_parser import get_image_type
 from wxManager.parser.util.protocbuf.roomdata_pb2 import ChatRoomData
 from wxManager.parser.wechat_v3 import FACTORY_REGISTRY, parser_sub_type, Singleton
@@ -162,12 +165,14 @@ def parser_messages(messages, username, db_dir=''):
         yield FACTORY_REGISTRY[msg_type].create(message, username, context)
 
 
-def _process_messages_batch(messages_batch, username, db_dir) -> List:
-    """Helper function to process a batch of messages."""
+def _process_messages_batch(messages_batch, username, db_dir) -> MessageBatch:
+    """
+    子进程中解析一批消息，打包成按列存储的MessageBatch返回，比直接返回消息对象的列表传输更快
+    """
     processed = []
     for message in parser_messages(messages_batch, username, db_dir):
         processed.append(message)
-    return processed
+    return pack_messages(processed)
 
 
 class DataBaseV3(DataBaseInterface):
@@ -303,16 +308,77 @@ class DataBaseV3(DataBaseInterface):
                     for batch in raw_message_batches
                 }
 
-                # Collect results
+                # Collect results，按提交顺序收集，各批次首尾相接，结果仍然有序
+                # 返回的是列表，每批都在这里立即还原成消息对象
                 for future in future_to_batch.keys():
-                    res.extend(future.result())
+                    res.extend(unpack_messages(future.result()))
 
         et = time.time()
         logger.error(f'获取聊天记录完成：{et}')
         logger.error(f'获取聊天记录耗时：{et - st:.2f}s/{len(res)}条消息')
-        res.sort()
         return res
 
+    def iter_messages(
+            self,
+            username_: str,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            start_sort_seq=None,
+    ):
+        if username_.startswith('gh_'):
+            # 公众号和企业微信的消息都在单个数据库里，查询结果已经按时间排好序
+            messages = self.public_msg_db.get_messages_by_username(username_, time_range)
+        elif username_.endswith('@openim'):
+            messages = self.open_msg_db.get_messages_by_username(username_, time_range)
+        else:
+            messages = self.msg_db.iter_messages_by_username(username_, time_range, start_sort_seq=start_sort_seq)
+        if start_sort_seq is not None and not isinstance(messages, Iterator):
+            # 这两个库的查询不支持起点，row[5]是CreateTime，即v3消息的sort_seq
+            messages = [row for row in messages or [] if row[5] >= start_sort_seq]
+        yield from parser_messages(messages, username_, self.db_dir)
+
+    def iter_messages_by_type(
+            self,
+            username_: str,
+            type_: MessageType,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            start_sort_seq=None,
+    ):
+        if username_.startswith('gh_'):
+            messages = self.public_msg_db.get_messages_by_type(username_, type_, time_range)
+        elif username_.endswith('@openim'):
+            messages = self.open_msg_db.get_messages_by_type(username_, type_, time_range)
+        else:
+            messages = self.msg_db.iter_messages_by_type(username_, type_, time_range, start_sort_seq=start_sort_seq)
+        if start_sort_seq is not None and not isinstance(messages, Iterator):
+            messages = [row for row in messages or [] if row[5] >= start_sort_seq]
+        yield from parser_messages(messages, username_, self.db_dir)
+
+    def get_messages_page(self, username, sort_seq=None, direction='before', limit=20, inclusive=False) -> List[Message]:
+        """
+        键集分页获取消息，所有分库的结果在数据库层归并，只解析返回的limit条
+        @param username:
+        @param sort_seq: 游标（CreateTime），None表示从最新（before）或最早（after）的消息开始
+        @param direction: before按时间降序返回更早的消息，after按时间升序返回更晚的消息
+        @param limit:
+        @param inclusive: 是否包含sort_seq等于游标的消息
+        @return: 消息列表
+        """
+        if username.startswith('gh'):
+            messages = self.public_msg_db.get_messages_page(username, sort_seq, direction, limit, inclusive)
+        elif username.endswith('@openim'):
+            messages = self.open_msg_db.get_messages_page(username, sort_seq, direction, limit, inclusive)
+        else:
+            messages = self.msg_db.get_messages_page(username, sort_seq, direction, limit, inclusive)
+        return list(parser_messages(messages, username, self.db_dir))
+
+    def get_sort_seq_by_time(self, username, timestamp):
+        """
+        v3消息的sort_seq就是CreateTime，不需要查询
+        @param timestamp: 时间戳（秒）
+        @return: timestamp对应的游标
+        """
+        return int(timestamp)
+
     def get_messages_by_num(self, username, start_sort_seq, msg_num=20):
         """
         获取小于start_sort_seq的msg_num个消息
@@ -321,18 +387,7 @@ class DataBaseV3(DataBaseInterface):
         @param msg_num:
         @return: messages, 最后一条消息的start_sort_seq
         """
-        if username.startswith('gh'):
-            messages = self.public_msg_db.get_messages_by_num(username, start_sort_seq, msg_num)
-        elif username.endswith('@openim'):
-            messages = self.open_msg_db.get_messages_by_num(username, start_sort_seq, msg_num)
-        else:
-            messages = self.msg_db.get_messages_by_num(username, start_sort_seq, msg_num)
-        result = []
-        for messages_ in messages:
-            for message in parser_messages(messages_, username, self.db_dir):
-                result.append(message)
-        result.sort(reverse=True)
-        res = result[:msg_num]
+        res = self.get_messages_page(username, start_sort_seq, 'before', msg_num)
         return res, res[-1].sort_seq if res else 0
 
     def get_message_by_server_id(self, username, server_id):
@@ -351,6 +406,18 @@ class DataBaseV3(DataBaseInterface):
     def get_messages_all(self, time_range=None):
         return self.msg_db.get_messages_all(time_range)
 
+    def get_messages_number(
+            self,
+            username_,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            start_sort_seq=None,
+    ) -> int:
+        if username_.startswith('gh_'):
+            return self.public_msg_db.get_messages_number(username_, time_range, start_sort_seq)
+        elif username_.endswith('@openim'):
+            return self.open_msg_db.get_messages_number(username_, time_range, start_sort_seq)
+        return self.msg_db.get_messages_number(username_, time_range, start_sort_seq)
+
     def get_messages_calendar(self, username_):
         return self.msg_db.get_messages_calendar(username_)
 
@@ -384,10 +451,10 @@ class DataBaseV3(DataBaseInterface):
                     executor.submit(_process_messages_batch, batch, username_, self.db_dir): batch
                     for batch in raw_message_batches
                 }
-                # Collect results
+                # Collect results，按提交顺序收集，各批次首尾相接，结果仍然有序
+                # 返回的是列表，每批都在这里立即还原成消息对象
                 for future in future_to_batch.keys():
-                    res.extend(future.result())
-        res.sort()
+                    res.extend(unpack_messages(future.result()))
         return res
 
     def get_emoji_url(self, md5: str, thumb: bool = False) -> str | bytes:
@@ -473,6 +540,9 @@ class DataBaseV3(DataBaseInterface):
     def get_avatar_buffer(self, username) -> bytes:
         return self.misc_db.get_avatar_buffer(username)
 
+    def get_avatar_buffers(self, usernames: List[str]) -> Dict[str, bytes]:
+        return self.misc_db.get_avatar_buffers(usernames)
+
     def create_contact(self, contact_info_list) -> Person:
         detail = decodeExtraBuf(contact_info_list[9])
         wxid = contact_info_list[0]
@@ -664,7 +734,15 @@ class DataBaseV3(DataBaseInterface):
     def get_favorite_items(self, time_range):
         return self.favorite_db.get_items(time_range)
 
-    def merge(self, db_dir):
+    def merge(self, db_dir, tables: List[str] = None, dry_run=False, exact=False) -> dict:
+        """
+        批量将db_dir中的数据合入到数据库中
+        @param db_dir: 新解密的数据库所在的文件夹
+        @param tables: 只合并这些表，支持通配符，默认合并所有表
+        @param dry_run: 只生成合并计划，不写入数据
+        @param exact: 生成计划时精确计算新增行数
+        @return: 合并计划（dry_run为False时是每张表实际写入的行数）
+        """
         merge_tasks = {
             self.msg_db: os.path.join(db_dir, 'Multi', 'MSG0.db'),
             self.media_msg_db: os.path.join(db_dir, 'Multi', 'MediaMSG0.db'),
@@ -685,7 +763,7 @@ class DataBaseV3(DataBaseInterface):
             db_instance.merge(db_path)
 
         # 使用 ThreadPoolExecutor 进行多线程合并
-        with concurrent.futures.ThreadPoolExecutor() as executor:
+        with MergePlan(dry_run, tables, exact) as plan, concurrent.futures.ThreadPoolExecutor() as executor:
             futures = {executor.submit(merge_task, db, path): (db, path) for db, path in merge_tasks.items()}
 
             # 等待所有任务完成
@@ -693,6 +771,22 @@ class DataBaseV3(DataBaseInterface):
                 db, path = futures[future]
                 try:
                     future.result()  # 这里会抛出异常（如果有的话）
-                    print(f"成功合并数据库: {path}")
+                    print(f"成功{'检查' if dry_run else '合并'}数据库: {path}")
                 except Exception as e:
                     print(f"合并 {path} 失败: {e}")
+                    plan.add(source=path, error=str(e))
+        return plan.to_dict()
+
+    def plan_merge(self, db_dir, tables: List[str] = None, exact=False, output_path=None) -> dict:
+        """
+        生成合并计划：只读地比较新旧数据库，估算每张表要新增、更新的行数和写入的字节数
+        @param db_dir: 新解密的数据库所在的文件夹
+        @param tables: 只估算这些表，支持通配符
+        @param exact: 精确计算新增行数
+        @param output_path: 合并计划保存成json文件的路径
+        @return: 合并计划
+        """
+        plan = self.merge(db_dir, tables, dry_run=True, exact=exact)
+        if output_path:
+            save_merge_plan(plan, output_path)
+        return plan
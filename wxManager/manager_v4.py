@@ -9,12 +9,14 @@
 @Description : 
 """
 import concurrent
+import copy
+import hashlib
 import os
 import re
 from concurrent.futures import ProcessPoolExecutor, as_completed, ThreadPoolExecutor
 from datetime import date, datetime
 from multiprocessing import Pool, cpu_count
-from typing import Tuple, List, Any
+from typing import Tuple, List, Any, Dict
 
 import zstandard as zstd
 
@@ -24,14 +26,16 @@ from wxManager.db_v4.biz_message import BizMessageDB
 from wxManager.db_v4.emotion import EmotionDB
 from wxManager.db_v4.media import MediaDB
 from wxManager.db_v4 import ContactDB, HeadImageDB, SessionDB, MessageDB, HardLinkDB
+from wxManager.db_v4.contact import ContactIndex
 from wxManager.db_main import DataBaseInterface, Context
 from wxManager.model.contact import Contact, ContactType, Person
-from wxManager.model import Me
+from wxManager.model import Me, Message
 from wxManager.parser.util.protocbuf.roomdata_pb2 import ChatRoomData
 from wxManager.parser.wechat_v4 import FACTORY_REGISTRY, Singleton
 from wxManager.log import logger
+from wxManager.merge import MergePlan, save_merge_plan
+from wxManager.model.wire import MessageBatch, pack_messages, unpack_messages
 from wxManager.parser.util.protocbuf import contact_pb2
-from google.protobuf.json_format import MessageToDict
 
 
 def decompress(data):
@@ -40,9 +44,17 @@ def decompress(data):
     return x.decode('utf-8')
 
 
-def parser_messages(messages, username, db_dir=''):
-    context = DataBaseV4()
-    context.init_database(db_dir)
+def parser_messages(messages, username, db_dir='', chatroom_snapshot=None, context=None):
+    """
+    @param chatroom_snapshot: 父进程算好的群成员快照（get_chatroom_snapshot），群信息没有变化时不再重新解析群成员
+    @param context: 已经初始化的DataBaseV4，在父进程里解析时传入自己，复用联系人索引和群成员缓存；
+                    子进程里为None，新建一个
+    """
+    if context is None:
+        context = DataBaseV4()
+        context.init_database(db_dir)
+        if chatroom_snapshot and username.endswith('@chatroom'):
+            context.set_chatroom_snapshot(username, chatroom_snapshot)
     if username.endswith('@chatroom'):
         contacts = context.get_chatroom_members(username)
     else:
@@ -60,19 +72,23 @@ def parser_messages(messages, username, db_dir=''):
         yield FACTORY_REGISTRY[type_].create(message, username, context)
 
 
-def _process_messages_batch(messages_batch, username, db_dir) -> List:
-    """Helper function to process a batch of messages."""
+def _process_messages_batch(messages_batch, username, db_dir, chatroom_snapshot=None) -> MessageBatch:
+    """
+    子进程中解析一批消息，打包成按列存储的MessageBatch返回，比直接返回消息对象的列表传输更快
+    """
     processed = []
-    for message in parser_messages(messages_batch, username, db_dir):
+    for message in parser_messages(messages_batch, username, db_dir, chatroom_snapshot):
         processed.append(message)
-    return processed
+    return pack_messages(processed)
 
 
 class DataBaseV4(DataBaseInterface):
     def __init__(self):
         super().__init__()
         self.db_dir = ''
-        self.chatroom_members_map = {}
+        self.chatroom_members_map = {}  # 群聊wxid -> (群信息版本, 群成员)
+        self.chatroom_data_map = {}  # 群聊wxid -> (群信息版本, ChatRoomData)
+        self.chatroom_name_map = {}  # 群聊wxid -> (群信息版本, 用群成员拼出来的群名)
         self.contacts_map = {}
 
         # V4
@@ -85,6 +101,7 @@ class DataBaseV4(DataBaseInterface):
         self.hardlink_db = HardLinkDB('hardlink/hardlink.db')
         self.emotion_db = EmotionDB('emoticon/emoticon.db')
         self.audio2text_db = Audio2TextDB('Audio2Text.db')
+        self.contact_index = ContactIndex(self.contact_db, self.create_contact)
 
     def init_database(self, db_dir=''):
         Me().load_from_json(os.path.join(db_dir, 'info.json'))  # 加载自己的信息
@@ -146,7 +163,7 @@ class DataBaseV4(DataBaseInterface):
             messages = self.message_db.get_messages_by_username(username_, time_range)
 
         if len(messages) < 20000:
-            for message in parser_messages(messages, username_, self.db_dir):
+            for message in parser_messages(messages, username_, self.db_dir, context=self):
                 res.append(message)
         else:
             raw_message_batches = split_list(messages, len(messages) // 10000 + 1)
@@ -156,23 +173,79 @@ class DataBaseV4(DataBaseInterface):
             # for batch in raw_message_batches:
             #     print(len(batch))
 
+            # 群成员在父进程里解析一次，快照随任务传给子进程
+            chatroom_snapshot = self.get_chatroom_snapshot(username_)
             with ProcessPoolExecutor(max_workers=min(len(raw_message_batches), 16)) as executor:
                 # Submit tasks
                 future_to_batch = {
-                    executor.submit(_process_messages_batch, batch, username_, self.db_dir): batch
+                    executor.submit(_process_messages_batch, batch, username_, self.db_dir, chatroom_snapshot): batch
                     for batch in raw_message_batches
                 }
 
-                # Collect results
+                # Collect results，按提交顺序收集，各批次首尾相接，结果仍然有序
+                # 返回的是列表，每批都在这里立即还原成消息对象
                 for future in future_to_batch.keys():
-                    res.extend(future.result())
+                    res.extend(unpack_messages(future.result()))
 
         et = time.time()
         logger.error(f'获取聊天记录完成：{et}')
         logger.error(f'获取聊天记录耗时：{et - st:.2f}s/{len(res)}条消息 {username_}')
-        res.sort()
         return res
 
+    def iter_messages(
+            self,
+            username_: str,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            start_sort_seq=None,
+    ):
+        if username_.startswith('gh_'):
+            messages = self.biz_message_db.iter_messages_by_username(username_, time_range, start_sort_seq=start_sort_seq)
+        else:
+            messages = self.message_db.iter_messages_by_username(username_, time_range, start_sort_seq=start_sort_seq)
+        yield from parser_messages(messages, username_, self.db_dir, context=self)
+
+    def iter_messages_by_type(
+            self,
+            username_: str,
+            type_: MessageType,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            start_sort_seq=None,
+    ):
+        if username_.startswith('gh_'):
+            messages = self.biz_message_db.iter_messages_by_type(
+                username_, type_, time_range, start_sort_seq=start_sort_seq
+            )
+        else:
+            messages = self.message_db.iter_messages_by_type(
+                username_, type_, time_range, start_sort_seq=start_sort_seq
+            )
+        yield from parser_messages(messages, username_, self.db_dir, context=self)
+
+    def get_messages_page(self, username, sort_seq=None, direction='before', limit=20, inclusive=False) -> List[Message]:
+        """
+        键集分页获取消息，所有分库的结果在数据库层归并，只解析返回的limit条
+        @param username:
+        @param sort_seq: 游标，None表示从最新（before）或最早（after）的消息开始
+        @param direction: before按sort_seq降序返回更早的消息，after按sort_seq升序返回更晚的消息
+        @param limit:
+        @param inclusive: 是否包含sort_seq等于游标的消息
+        @return: 消息列表
+        """
+        if username.startswith('gh_'):
+            messages = self.biz_message_db.get_messages_page(username, sort_seq, direction, limit, inclusive)
+        else:
+            messages = self.message_db.get_messages_page(username, sort_seq, direction, limit, inclusive)
+        return list(parser_messages(messages, username, self.db_dir, context=self))
+
+    def get_sort_seq_by_time(self, username, timestamp):
+        """
+        @param timestamp: 时间戳（秒）
+        @return: 不早于timestamp的第一条消息的sort_seq，没有这样的消息时返回None
+        """
+        if username.startswith('gh_'):
+            return self.biz_message_db.get_sort_seq_by_time(username, timestamp)
+        return self.message_db.get_sort_seq_by_time(username, timestamp)
+
     def get_messages_by_num(self, username, start_sort_seq, msg_num=20):
         """
         获取小于start_sort_seq的msg_num个消息
@@ -181,16 +254,7 @@ class DataBaseV4(DataBaseInterface):
         @param msg_num:
         @return: messages, 最后一条消息的start_sort_seq
         """
-        result = []
-        if username.startswith('gh_'):
-            messages = self.biz_message_db.get_messages_by_num(username, start_sort_seq, msg_num)
-        else:
-            messages = self.message_db.get_messages_by_num(username, start_sort_seq, msg_num)
-        for messages in messages:
-            for message in parser_messages(messages, username, self.db_dir):
-                result.append(message)
-        result.sort(reverse=True)
-        res = result[:msg_num]
+        res = self.get_messages_page(username, start_sort_seq, 'before', msg_num)
         return res, res[-1].sort_seq if res else 0
 
     def get_message_by_server_id(self, username, server_id):
@@ -202,7 +266,7 @@ class DataBaseV4(DataBaseInterface):
         """
         message = self.message_db.get_message_by_server_id(username, server_id)
         if message:
-            messages_iter = parser_messages([message], username, self.db_dir)
+            messages_iter = parser_messages([message], username, self.db_dir, context=self)
             return next(messages_iter)
         return None
 
@@ -224,22 +288,34 @@ class DataBaseV4(DataBaseInterface):
             messages = self.message_db.get_messages_by_type(username_, type_, time_range)
 
         if len(messages) < 20000:
-            for message in parser_messages(messages, username_, self.db_dir):
+            for message in parser_messages(messages, username_, self.db_dir, context=self):
                 res.append(message)
         else:
             raw_message_batches = split_list(messages, len(messages) // 10000 + 1)
+            # 群成员在父进程里解析一次，快照随任务传给子进程
+            chatroom_snapshot = self.get_chatroom_snapshot(username_)
             with ProcessPoolExecutor(max_workers=min(len(raw_message_batches), 16)) as executor:
                 # Submit tasks
                 future_to_batch = {
-                    executor.submit(_process_messages_batch, batch, username_, self.db_dir): batch
+                    executor.submit(_process_messages_batch, batch, username_, self.db_dir, chatroom_snapshot): batch
                     for batch in raw_message_batches
                 }
-                # Collect results
+                # Collect results，按提交顺序收集，各批次首尾相接，结果仍然有序
+                # 返回的是列表，每批都在这里立即还原成消息对象
                 for future in future_to_batch.keys():
-                    res.extend(future.result())
-        res.sort()
+                    res.extend(unpack_messages(future.result()))
         return res
 
+    def get_messages_number(
+            self,
+            username_,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            start_sort_seq=None,
+    ) -> int:
+        if username_.startswith('gh_'):
+            return self.biz_message_db.get_messages_number(username_, time_range, start_sort_seq)
+        return self.message_db.get_messages_number(username_, time_range, start_sort_seq)
+
     def get_messages_calendar(self, username_: str):
         if username_.startswith('gh_'):
             return self.biz_message_db.get_messages_calendar(username_)
@@ -294,6 +370,9 @@ class DataBaseV4(DataBaseInterface):
     def get_avatar_buffer(self, username) -> bytes:
         return self.head_image_db.get_avatar_buffer(username)
 
+    def get_avatar_buffers(self, usernames: List[str]) -> Dict[str, bytes]:
+        return self.head_image_db.get_avatar_buffers(usernames)
+
     def create_contact(self, contact_info_list) -> Person:
         wxid, local_type, flag = contact_info_list[0], contact_info_list[2], contact_info_list[3]
         nickname = contact_info_list[5]
@@ -310,19 +389,16 @@ class DataBaseV4(DataBaseInterface):
             try:
                 # 创建顶级消息对象
                 message = contact_pb2.ContactInfo()
-                # 解析二进制数据
+                # 解析二进制数据，直接读取需要的字段，不转换成字典
                 message.ParseFromString(contact_info_list[10])
-                # 转换为 JSON 格式
-                detail = MessageToDict(message)
-                gender_code = detail.get('gender', 0)
+                gender_code = message.gender
                 if gender_code == 1:
                     gender = '男'
                 elif gender_code == 2:
                     gender = '女'
-                label_list = detail.get('labelList', '').strip(',').split(',')
-                signature = detail.get('signature', '')
-                region = (detail.get('country', ''), detail.get('province', ''), detail.get('city', ''))
-                label_list = self.contact_db.get_labels(detail.get('labelList')).split(',')
+                signature = message.signature
+                region = (message.country, message.province, message.city)
+                label_list = self.contact_index.get_labels(message.label_list).split(',')
             except:
                 pass
                 # logger.error(f'{wxid} {contact_info_list[5]}联系人解析失败\n{contact_info_list[10]}')
@@ -371,25 +447,31 @@ class DataBaseV4(DataBaseInterface):
     def get_contacts(self) -> List[Person]:
         contacts = []
         contact_lists = self.contact_db.get_contacts()
+        self.contact_index.load()
         for contact_info_list in contact_lists:
             if contact_info_list:
-                contact = self.create_contact(contact_info_list)
-                contacts.append(contact)
+                contact = self.contact_index.get(contact_info_list[0]) or self.create_contact(contact_info_list)
+                contacts.append(copy.copy(contact))
         return contacts
 
     def set_remark(self, username: str, remark) -> bool:
         if username in self.contacts_map:
             self.contacts_map[username].remark = remark
-        return self.contact_db.set_remark(username, remark)
+        result = self.contact_db.set_remark(username, remark)
+        # 清空备注时也要刷新，否则索引和群成员、群名里还是旧备注
+        self.contact_index.update_remark(username, remark or '')
+        self.chatroom_members_map.clear()
+        self.chatroom_name_map.clear()
+        return result
 
     def set_avatar_buffer(self, username, avatar_path):
         return self.head_image_db.set_avatar_buffer(username, avatar_path)
 
     def get_contact_by_username(self, wxid: str) -> Person:
-        contact_info_list = self.contact_db.get_contact_by_username(wxid)
-        if contact_info_list:
-            contact = self.create_contact(contact_info_list)
-            return contact
+        contact = self.contact_index.get(wxid)
+        if contact:
+            # 索引里的对象是共享的，返回副本，调用方可以修改（例如群成员改成群昵称）
+            return copy.copy(contact)
         else:
             contact = Contact(
                 wxid=wxid,
@@ -398,22 +480,62 @@ class DataBaseV4(DataBaseInterface):
             )
         return contact
 
+    def _get_chatroom_version(self, chatroom_name):
+        """
+        @return: (群信息版本, chat_room.ext_buffer)，群聊不存在时返回 ('', None)
+        群信息版本是ext_buffer的md5，群成员、群昵称变化后版本就会变化
+        """
+        chatroom = self.contact_db.get_chatroom_info(chatroom_name)
+        if chatroom is None:
+            return '', None
+        ext_buffer = chatroom[1] or b''
+        return hashlib.md5(ext_buffer).hexdigest(), ext_buffer
+
+    def _get_chatroom_data(self, chatroom_name, version, ext_buffer) -> ChatRoomData:
+        cached = self.chatroom_data_map.get(chatroom_name)
+        if cached and cached[0] == version:
+            return cached[1]
+        # 解析RoomData数据
+        parsechatroom = ChatRoomData()
+        parsechatroom.ParseFromString(ext_buffer)
+        self.chatroom_data_map[chatroom_name] = (version, parsechatroom)
+        return parsechatroom
+
+    def get_chatroom_snapshot(self, chatroom_name):
+        """
+        群成员快照，可以pickle后传给子进程
+        @return: (群信息版本, 群成员)，不是群聊时返回None
+        """
+        if not chatroom_name.endswith('@chatroom'):
+            return None
+        members = self.get_chatroom_members(chatroom_name)
+        return self.chatroom_members_map.get(chatroom_name, ('', members))
+
+    def set_chatroom_snapshot(self, chatroom_name, snapshot):
+        """
+        使用其他进程算好的群成员快照，只在交接时检查一次版本，和数据库里的群信息一致时get_chatroom_members直接返回快照
+        """
+        if snapshot and snapshot[0] == self._get_chatroom_version(chatroom_name)[0]:
+            self.chatroom_members_map[chatroom_name] = snapshot
+
     def get_chatroom_members(self, chatroom_name) -> dict[Any, Person] | Any:
         """
         获取群成员
+        缓存命中时不再查询数据库，群信息变化（合并数据库、修改备注）时缓存会被清空
         @param chatroom_name:
         @return:
         """
-        if chatroom_name in self.chatroom_members_map:
-            return self.chatroom_members_map[chatroom_name]
+        cached = self.chatroom_members_map.get(chatroom_name)
+        if cached:
+            return cached[1]
+        version, ext_buffer = self._get_chatroom_version(chatroom_name)
+        if ext_buffer is None:
+            self.chatroom_members_map[chatroom_name] = (version, {})
+            return {}
         result = {}
-        chatroom = self.contact_db.get_chatroom_info(chatroom_name)
-
-        if chatroom is None:
-            return result
-        # 解析RoomData数据
-        parsechatroom = ChatRoomData()
-        parsechatroom.ParseFromString(chatroom[1])
+        parsechatroom = self._get_chatroom_data(chatroom_name, version, ext_buffer)
+        # 要查很多联系人，一次读出整张联系人表
+        self.contact_index.load()
         # 群成员数据放入字典存储
         for mem in parsechatroom.members:
             contact = self.get_contact_by_username(mem.wxID)
@@ -421,17 +543,17 @@ class DataBaseV4(DataBaseInterface):
                 if mem.displayName:
                     contact.remark = mem.displayName
                 result[contact.wxid] = contact
-        self.chatroom_members_map[chatroom_name] = result
+        self.chatroom_members_map[chatroom_name] = (version, result)
         return result
 
     def _get_chatroom_name(self, wxid):
-        chatroom = self.contact_db.get_chatroom_info(wxid)
-
-        if chatroom is None:
+        cached = self.chatroom_name_map.get(wxid)
+        if cached:
+            return cached[1]
+        version, ext_buffer = self._get_chatroom_version(wxid)
+        if ext_buffer is None:
             return ''
-        # 解析RoomData数据
-        parsechatroom = ChatRoomData()
-        parsechatroom.ParseFromString(chatroom[1])
+        parsechatroom = self._get_chatroom_data(wxid, version, ext_buffer)
         chatroom_name = ''
         # 群成员数据放入字典存储
         for mem in parsechatroom.members[:5]:
@@ -442,18 +564,23 @@ class DataBaseV4(DataBaseInterface):
             else:
                 contact = self.get_contact_by_username(mem.wxID)
                 chatroom_name += f'{contact.remark}、'
-        return chatroom_name.rstrip('、')
+        chatroom_name = chatroom_name.rstrip('、')
+        self.chatroom_name_map[wxid] = (version, chatroom_name)
+        return chatroom_name
 
     # 联系人结束
 
     def get_favorite_items(self, time_range):
         return self.favorite_db.get_items(time_range)
 
-    def merge(self, db_dir):
+    def merge(self, db_dir, tables: List[str] = None, dry_run=False, exact=False) -> dict:
         """
-        批量将db_path中的数据合入到数据库中
-        @param db_path:
-        @return:
+        批量将db_dir中的数据合入到数据库中
+        @param db_dir: 新解密的数据库所在的文件夹
+        @param tables: 只合并这些表，支持通配符，默认合并所有表
+        @param dry_run: 只生成合并计划，不写入数据
+        @param exact: 生成计划时精确计算新增行数
+        @return: 合并计划（dry_run为False时是每张表实际写入的行数）
         """
         merge_tasks = {
             self.head_image_db: os.path.join(db_dir, 'head_image', 'head_image.db'),
@@ -471,7 +598,7 @@ class DataBaseV4(DataBaseInterface):
             db_instance.merge(db_path)
 
         # 使用 ThreadPoolExecutor 进行多线程合并
-        with concurrent.futures.ThreadPoolExecutor() as executor:
+        with MergePlan(dry_run, tables, exact) as plan, concurrent.futures.ThreadPoolExecutor() as executor:
             futures = {executor.submit(merge_task, db, path): (db, path) for db, path in merge_tasks.items()}
 
             # 等待所有任务完成
@@ -479,6 +606,27 @@ class DataBaseV4(DataBaseInterface):
                 db, path = futures[future]
                 try:
                     future.result()  # 这里会抛出异常（如果有的话）
-                    print(f"成功合并数据库: {path}")
+                    print(f"成功{'检查' if dry_run else '合并'}数据库: {path}")
                 except Exception as e:
                     print(f"合并 {path} 失败: {e}")
+                    plan.add(source=path, error=str(e))
+        if not dry_run:
+            # 联系人、群成员可能有变化，下次查询时重新加载
+            self.contact_index.clear()
+            self.chatroom_members_map.clear()
+            self.chatroom_name_map.clear()
+        return plan.to_dict()
+
+    def plan_merge(self, db_dir, tables: List[str] = None, exact=False, output_path=None) -> dict:
+        """
+        生成合并计划：只读地比较新旧数据库，估算每张表要新增、更新的行数和写入的字节数
+        @param db_dir: 新解密的数据库所在的文件夹
+        @param tables: 只估算这些表，支持通配符
+        @param exact: 精确计算新增行数
+        @param output_path: 合并计划保存成json文件的路径
+        @return: 合并计划
+        """
+        plan = self.merge(db_dir, tables, dry_run=True, exact=exact)
+        if output_path:
+            save_merge_plan(plan, output_path)
+        return plan
@@ -1,188 +1,791 @@
+import contextlib
+import fnmatch
+import json
 import os
+import shutil
 import sqlite3
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Tuple
+from urllib.request import pathname2url
 
 from wxManager.log import logger
 
+MERGE_SCHEMA = 'merge_src'  # 新数据库ATTACH到已有连接上时使用的schema名
+MERGE_TEMP_TABLE = 'merge_rows'  # 增量更新时暂存变化行的临时表
+WATERMARK_TABLE = 'merge_watermark'  # 保存在已有数据库里的合并水位线表
+# 分片合并时使用的pragma，只对合并用的独立连接生效，不会改动数据库文件
+# journal_mode=WAL会持久写入数据库文件，不放在默认值里；调用方传入journal_mode时合并完成后会恢复原来的模式
+MERGE_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'cache_size': -65536,  # 负数表示KB，64MB
+    'temp_store': 'MEMORY',
+}
 
-def table_exists(conn, table_name):
+
+class MergeTable(NamedTuple):
+    """
+    分片合并时一张（一类）表的合并方式
+    """
+    table_name: str  # 表名，prefix为True时是表名前缀
+    col_name: str  # 根据该列判断是否是新增数据
+    update: bool = False  # True：有变化的行删除旧数据后重新插入（increase_update_data）；False：只插入新增的行（increase_data）
+    exclude_column: str = ''  # 不写入的列（自增ID），update为True时表示排除第一列
+    prefix: bool = False  # 是否按前缀匹配新数据库中的所有表，例如V4的Msg_*
+
+
+def quote_name(name):
+    """给表名、列名加上引号"""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def table_exists(conn, table_name, schema='main'):
     """检查表是否存在"""
     cursor = conn.cursor()
-    cursor.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
-    return cursor.fetchone()[0] > 0
+    cursor.execute(f"SELECT count(*) FROM {schema}.sqlite_master WHERE type='table' AND name=?", (table_name,))
+    exists = cursor.fetchone()[0] > 0
+    cursor.close()
+    return exists
 
 
-def get_create_statements(conn, table_name, object_type):
+def get_create_statements(conn, table_name, object_type, schema='main'):
     """获取指定表的 CREATE TABLE 或 CREATE INDEX 语句"""
     cursor = conn.cursor()
-    cursor.execute(f"SELECT sql FROM sqlite_master WHERE type='{object_type}' AND tbl_name=?", (table_name,))
-    return [row[0] for row in cursor.fetchall() if row[0]]  # 过滤掉 None 值
+    cursor.execute(f"SELECT sql FROM {schema}.sqlite_master WHERE type=? AND tbl_name=?", (object_type, table_name))
+    statements = [row[0] for row in cursor.fetchall() if row[0]]  # 过滤掉 None 值
+    cursor.close()
+    return statements
+
+
+def get_column_names(conn, table_name, schema='main'):
+    cursor = conn.cursor()
+    cursor.execute(f"PRAGMA {schema}.table_info({quote_name(table_name)})")
+    column_names = [info[1] for info in cursor.fetchall()]
+    cursor.close()
+    return column_names
+
+
+@contextlib.contextmanager
+def attach_database(conn, db_path, schema=MERGE_SCHEMA):
+    """
+    把db_path数据库ATTACH到conn上，合并时直接在SQLite里跨库读写，数据不经过Python
+    ATTACH/DETACH不能在事务中执行，进入和退出时都会先提交当前事务
+    @param conn: 已有数据库的连接
+    @param db_path: 新数据库的路径
+    @param schema: ATTACH后新数据库的schema名
+    """
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute(f'ATTACH DATABASE ? AS {schema}', (db_path,))
+    try:
+        yield schema
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.execute(f'DETACH DATABASE {schema}')
+
+
+def copy_table_schema(conn, table_name, schema=MERGE_SCHEMA):
+    """
+    已有数据库里没有这张表时，从ATTACH的新数据库复制表结构和索引
+    """
+    if table_exists(conn, table_name):
+        return
+    # 复制表结构
+    create_table_sql = get_create_statements(conn, table_name, "table", schema)
+    if create_table_sql:
+        conn.execute(create_table_sql[0])  # 执行 CREATE TABLE 语句
+        print(f"表 {table_name} 结构已复制")
+    # 复制索引
+    create_index_sql_list = get_create_statements(conn, table_name, "index", schema)
+    for create_index_sql in create_index_sql_list:
+        conn.execute(create_index_sql)  # 执行 CREATE INDEX 语句
+        print(f"索引已复制: {create_index_sql}")
+
+
+def get_merge_columns(conn, table_name, col_name, col_index=-1, exclude_columns=(), schema=MERGE_SCHEMA):
+    """
+    @return: (两个库都有的列名, 用于判断是否是新增数据的列名)，出错时返回 ([], '')
+    """
+    column_names = [name for name in get_column_names(conn, table_name) if name not in exclude_columns]
+    source_columns = set(get_column_names(conn, table_name, schema))
+    if col_name not in column_names:
+        if 0 <= col_index < len(column_names):
+            col_name = column_names[col_index]
+        else:
+            print(f"错误: 列 {col_name} 在表 {table_name} 中不存在")
+            return [], ''
+    # 新数据库里缺少的列不写入，使用默认值
+    column_names = [name for name in column_names if name in source_columns]
+    if col_name not in column_names:
+        print(f"错误: 列 {col_name} 在新数据库的表 {table_name} 中不存在")
+        return [], ''
+    return column_names, col_name
+
+
+def create_watermark_table(cursor):
+    """
+    合并水位线：每个(新数据库分片, 表)上次合并到的最大rowid，以及这一行的key，用来判断水位线是否还有效
+    """
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS main.{WATERMARK_TABLE} (
+            source TEXT,
+            table_name TEXT,
+            max_rowid INTEGER,
+            key_value,
+            update_time INTEGER,
+            PRIMARY KEY (source, table_name)
+        )
+    """)
+
+
+def load_merge_watermark(cursor, source, table_name, key, schema=MERGE_SCHEMA):
+    """
+    @param source: 新数据库分片的文件名
+    @param table_name: 表名
+    @param key: 判断是否是新增数据的列（已加引号）
+    @return: 上次合并到的rowid；没有水位线或者水位线失效（新数据库被重新生成过）时返回None
+    """
+    cursor.execute(
+        f"SELECT max_rowid, key_value FROM main.{WATERMARK_TABLE} WHERE source=? AND table_name=?",
+        (source, table_name)
+    )
+    row = cursor.fetchone()
+    if not row:
+        return None
+    max_rowid, key_value = row
+    try:
+        cursor.execute(f"SELECT {key} FROM {schema}.{quote_name(table_name)} WHERE rowid=?", (max_rowid,))
+    except sqlite3.OperationalError:
+        # WITHOUT ROWID 的表没有rowid
+        return None
+    current = cursor.fetchone()
+    if not current or current[0] != key_value:
+        logger.info(f'{source} {table_name} 的合并水位线失效，全量比较')
+        return None
+    return max_rowid
+
+
+def save_merge_watermark(cursor, source, table_name, key, schema=MERGE_SCHEMA):
+    try:
+        cursor.execute(f"SELECT rowid, {key} FROM {schema}.{quote_name(table_name)} ORDER BY rowid DESC LIMIT 1")
+    except sqlite3.OperationalError:
+        return
+    row = cursor.fetchone()
+    if not row:
+        return
+    cursor.execute(
+        f"INSERT OR REPLACE INTO main.{WATERMARK_TABLE} VALUES (?, ?, ?, ?, ?)",
+        (source, table_name, row[0], row[1], int(time.time()))
+    )
+
+
+def is_indexed(conn, table_name, column_name, schema='main'):
+    """
+    判断列是否是某个索引的第一列（或者是INTEGER PRIMARY KEY）
+    """
+    table = quote_name(table_name)
+    for _, name, type_, _, _, pk in conn.execute(f"PRAGMA {schema}.table_info({table})").fetchall():
+        if name == column_name and pk == 1 and type_.upper() == 'INTEGER':
+            return True
+    for index in conn.execute(f"PRAGMA {schema}.index_list({table})").fetchall():
+        columns = conn.execute(f"PRAGMA {schema}.index_info({quote_name(index[1])})").fetchall()
+        if columns and columns[0][2] == column_name:
+            return True
+    return False
+
+
+def insert_new_rows(conn, cursor, table_name, col_name, col_index=-1, exclude_column='', schema=MERGE_SCHEMA,
+                    watermark_source=None):
+    """
+    把ATTACH的新数据库中col_name不存在于已有数据库的行插入已有数据库，不提交事务
+    @param watermark_source: 新数据库分片的文件名，不为空时使用合并水位线，只比较上次合并之后新增的行
+    @return: 插入的行数
+    """
+    if not table_exists(conn, table_name, schema):
+        return 0
+    copy_table_schema(conn, table_name, schema)
+    exclude_columns = (exclude_column,) if exclude_column else ()
+    column_names, key_name = get_merge_columns(conn, table_name, col_name, col_index, exclude_columns, schema)
+    if not column_names:
+        return 0
+    table = quote_name(table_name)
+    columns = ', '.join(map(quote_name, column_names))
+    key = quote_name(key_name)
+    start_rowid = None
+    if watermark_source:
+        start_rowid = load_merge_watermark(cursor, watermark_source, table_name, key, schema)
+    if start_rowid is None:
+        # 全量比较：NOT IN 的子查询只会建一次临时索引（key列有索引时直接用索引），
+        # 相关子查询 NOT EXISTS 在key列没有索引时会退化成逐行全表扫描
+        cursor.execute(f"""
+            INSERT INTO main.{table} ({columns})
+            SELECT {columns}
+            FROM {schema}.{table}
+            WHERE {key} NOT IN (SELECT {key} FROM main.{table} WHERE {key} IS NOT NULL)
+        """)
+    elif is_indexed(conn, table_name, key_name):
+        # 只看水位线之后的行，每行用索引查一次是否已经存在
+        cursor.execute(f"""
+            INSERT INTO main.{table} ({columns})
+            SELECT {columns}
+            FROM {schema}.{table} AS new_rows
+            WHERE new_rows.rowid > ?
+              AND NOT EXISTS (SELECT 1 FROM main.{table} AS old_rows WHERE old_rows.{key} = new_rows.{key})
+        """, (start_rowid,))
+    else:
+        # key列没有索引时不在用户的数据库上建索引，而是从新数据库一侧查：
+        # 水位线之后的少量key建一个临时索引，已有数据库只顺序扫描一遍找出其中已经存在的key
+        cursor.execute(f"""
+            INSERT INTO main.{table} ({columns})
+            SELECT {columns}
+            FROM {schema}.{table}
+            WHERE rowid > ?
+              AND {key} NOT IN (
+                SELECT {key} FROM main.{table}
+                WHERE {key} IN (SELECT {key} FROM {schema}.{table} WHERE rowid > ?)
+              )
+        """, (start_rowid, start_rowid))
+    inserted = max(cursor.rowcount, 0)
+    if watermark_source:
+        save_merge_watermark(cursor, watermark_source, table_name, key, schema)
+    return inserted
+
+
+def update_changed_rows(conn, cursor, table_name, col_name, col_index=-1, exclude_first_column=False,
+                        schema=MERGE_SCHEMA):
+    """
+    用ATTACH的新数据库中有变化的行替换已有数据库中col_name相同的行，不提交事务
+    @return: 更新的行数
+    """
+    if not table_exists(conn, table_name, schema):
+        return 0
+    copy_table_schema(conn, table_name, schema)
+    exclude_columns = get_column_names(conn, table_name)[:1] if exclude_first_column else ()
+    column_names, key = get_merge_columns(conn, table_name, col_name, col_index, exclude_columns, schema)
+    if not column_names:
+        return 0
+    table = quote_name(table_name)
+    columns = ', '.join(map(quote_name, column_names))
+    key = quote_name(key)
+    cursor.execute(f"DROP TABLE IF EXISTS temp.{MERGE_TEMP_TABLE}")
+    # 新数据库中与已有数据不完全相同的行（EXCEPT按整行比较并去重）
+    cursor.execute(f"""
+        CREATE TEMP TABLE {MERGE_TEMP_TABLE} AS
+        SELECT {columns} FROM {schema}.{table}
+        EXCEPT
+        SELECT {columns} FROM main.{table}
+    """)
+    cursor.execute(f"SELECT count(*) FROM temp.{MERGE_TEMP_TABLE}")
+    updated = cursor.fetchone()[0]
+    if updated:
+        cursor.execute(f"""
+            DELETE FROM main.{table}
+            WHERE {key} IN (SELECT {key} FROM temp.{MERGE_TEMP_TABLE})
+        """)
+        cursor.execute(f"""
+            INSERT INTO main.{table} ({columns})
+            SELECT {columns} FROM temp.{MERGE_TEMP_TABLE}
+        """)
+    cursor.execute(f"DROP TABLE temp.{MERGE_TEMP_TABLE}")
+    return updated
+
+
+_merge_plan = None  # 当前生效的合并计划，合并在多个线程里进行，所以用模块级变量而不是线程局部变量
+
+
+def current_merge_plan():
+    """
+    @return: 当前生效的MergePlan，没有时返回None
+    """
+    return _merge_plan
+
+
+def connect_readonly(db_path, new_db_path=None):
+    """
+    只读方式打开已有数据库，并以只读方式ATTACH新数据库，生成合并计划时不会改动任何文件
+    """
+    conn = sqlite3.connect(f'file:{pathname2url(os.path.abspath(db_path))}?mode=ro', uri=True)
+    if new_db_path:
+        conn.execute(
+            f'ATTACH DATABASE ? AS {MERGE_SCHEMA}', (f'file:{pathname2url(os.path.abspath(new_db_path))}?mode=ro',)
+        )
+    return conn
+
+
+def expand_merge_tables(conn, tables: List[MergeTable], schema=MERGE_SCHEMA) -> List[Tuple[MergeTable, str]]:
+    """
+    把按前缀匹配的MergeTable展开成新数据库中实际存在的表
+    @return: List[(合并方式, 表名)]
+    """
+    new_tables = [
+        row[0] for row in conn.execute(f"SELECT name FROM {schema}.sqlite_master WHERE type='table'").fetchall()
+    ]
+    result = []
+    for table in tables:
+        if table.prefix:
+            result.extend((table, name) for name in new_tables if name.startswith(table.table_name))
+        elif table.table_name in new_tables:
+            result.append((table, table.table_name))
+    return result
+
+
+def estimate_table(conn, table_name, col_name, col_index=-1, exclude_columns=(), update=False, exact=False,
+                   watermark_source=None, schema=MERGE_SCHEMA) -> dict:
+    """
+    估算一张表合并时新增、更新的行数和写入的字节数，只读
+    只插入新增行的表：有有效的合并水位线或者exact为True时精确计算；
+    否则key在已有数据key范围之外的行一定是新增的，范围之内的按行数差估算（偏小）
+    增量更新的表一般很小，直接用EXCEPT精确计算
+    @return: 计划条目
+    """
+    table = quote_name(table_name)
+    entry = {'table': table_name, 'mode': 'update' if update else 'insert'}
+    entry['source_rows'] = conn.execute(f"SELECT count(*) FROM {schema}.{table}").fetchone()[0]
+    if not table_exists(conn, table_name):
+        # 已有数据库里没有这张表，合并时先复制表结构再全部插入
+        column_names = [name for name in get_column_names(conn, table_name, schema) if name not in exclude_columns]
+        entry.update(create_table=True, key=col_name, target_rows=0, new_rows=entry['source_rows'], updated_rows=0,
+                     exact=True)
+    else:
+        column_names, key_name = get_merge_columns(conn, table_name, col_name, col_index, exclude_columns, schema)
+        if not column_names:
+            entry['error'] = f'列 {col_name} 不存在'
+            return entry
+        key = quote_name(key_name)
+        columns = ', '.join(map(quote_name, column_names))
+        entry['key'] = key_name
+        entry['target_rows'] = conn.execute(f"SELECT count(*) FROM main.{table}").fetchone()[0]
+        entry['source_key_range'] = list(conn.execute(f"SELECT min({key}), max({key}) FROM {schema}.{table}").fetchone())
+        target_min, target_max = conn.execute(f"SELECT min({key}), max({key}) FROM main.{table}").fetchone()
+        entry['target_key_range'] = [target_min, target_max]
+        if update:
+            diff = f"SELECT {columns} FROM {schema}.{table} EXCEPT SELECT {columns} FROM main.{table}"
+            changed = conn.execute(f"SELECT count(*) FROM ({diff})").fetchone()[0]
+            updated = conn.execute(
+                f"SELECT count(*) FROM ({diff}) WHERE {key} IN (SELECT {key} FROM main.{table})"
+            ).fetchone()[0] if changed else 0
+            entry.update(new_rows=changed - updated, updated_rows=updated, exact=True)
+        else:
+            start_rowid = None
+            if watermark_source and table_exists(conn, WATERMARK_TABLE):
+                start_rowid = load_merge_watermark(conn.cursor(), watermark_source, table_name, key, schema)
+            anti_join = f"{key} NOT IN (SELECT {key} FROM main.{table} WHERE {key} IS NOT NULL)"
+            if start_rowid is not None:
+                new_rows = conn.execute(
+                    f"SELECT count(*) FROM {schema}.{table} WHERE rowid > ? AND {anti_join}", (start_rowid,)
+                ).fetchone()[0]
+                entry.update(watermark=start_rowid, exact=True)
+            elif exact or target_min is None:
+                new_rows = conn.execute(f"SELECT count(*) FROM {schema}.{table} WHERE {anti_join}").fetchone()[0]
+                entry['exact'] = True
+            else:
+                outside = conn.execute(
+                    f"SELECT count(*) FROM {schema}.{table} WHERE {key} < ? OR {key} > ?", (target_min, target_max)
+                ).fetchone()[0]
+                inside = entry['source_rows'] - outside
+                new_rows = outside + max(0, inside - entry['target_rows'])
+                entry['exact'] = False
+            entry.update(new_rows=new_rows, updated_rows=0)
+    # 用新数据库最后1000行估算平均每行的字节数
+    row_bytes = ' + '.join(f'ifnull(length(CAST({quote_name(name)} AS BLOB)), 0)' for name in column_names) or '0'
+    sample = f"SELECT {', '.join(map(quote_name, column_names))} FROM {schema}.{table}"
+    try:
+        avg_bytes = conn.execute(f"SELECT avg({row_bytes}) FROM ({sample} ORDER BY rowid DESC LIMIT 1000)").fetchone()[0]
+    except sqlite3.OperationalError:
+        # WITHOUT ROWID 的表
+        avg_bytes = conn.execute(f"SELECT avg({row_bytes}) FROM ({sample} LIMIT 1000)").fetchone()[0]
+    entry['bytes'] = int((avg_bytes or 0) * (entry['new_rows'] + entry['updated_rows']))
+    return entry
+
+
+class MergePlan:
+    """
+    合并计划
+    dry_run为True时各个merge只估算每张表要新增、更新的行数和字节数，不写入任何数据；
+    dry_run为False时正常合并，并记录每张表实际写入的行数和出错信息
+    tables不为空时只合并（估算）这些表，支持通配符，例如 ['Contact', 'Msg_*']
+
+    with MergePlan(dry_run=True) as plan:
+        database.merge(db_dir)
+    plan.save('merge_plan.json')
+    """
+
+    def __init__(self, dry_run=True, tables: List[str] = None, exact=False):
+        """
+        @param dry_run: 只生成计划不合并
+        @param tables: 只合并这些表，默认合并所有表
+        @param exact: 生成计划时精确计算新增行数（需要做一次只读的反连接，大表比较慢）
+        """
+        self.dry_run = dry_run
+        self.tables = list(tables) if tables else []
+        self.exact = exact
+        self.entries = []
+        self._lock = threading.Lock()
+        self._previous = None
+
+    def __enter__(self):
+        global _merge_plan
+        self._previous = _merge_plan
+        _merge_plan = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        global _merge_plan
+        _merge_plan = self._previous
+
+    def selected(self, table_name) -> bool:
+        return not self.tables or any(fnmatch.fnmatchcase(table_name, pattern) for pattern in self.tables)
+
+    def add(self, **entry):
+        with self._lock:
+            self.entries.append(entry)
+
+    def estimate(self, db_path, new_db_path, tables: List[Tuple[MergeTable, str]], watermark_source=None,
+                 col_index=-1):
+        """
+        估算一个数据库（分片）的合并
+        @param db_path: 已有数据库的路径
+        @param new_db_path: 新数据库的路径
+        @param tables: List[(合并方式, 表名)]
+        @param watermark_source: 合并水位线的来源名称
+        @param col_index: 列名不存在时用第几列判断是否是新增数据
+        """
+        try:
+            conn = connect_readonly(db_path, new_db_path)
+        except sqlite3.Error as e:
+            self.add(database=db_path, source=new_db_path, error=str(e))
+            return
+        try:
+            for table, table_name in tables:
+                if not self.selected(table_name) or not table_exists(conn, table_name, MERGE_SCHEMA):
+                    continue
+                exclude_columns = (table.exclude_column,) if table.exclude_column else ()
+                if table.update and table.exclude_column:
+                    exclude_columns = tuple(get_column_names(conn, table_name)[:1])
+                try:
+                    entry = estimate_table(conn, table_name, table.col_name, col_index, exclude_columns,
+                                           update=table.update, exact=self.exact, watermark_source=watermark_source)
+                except sqlite3.Error as e:
+                    entry = {'table': table_name, 'error': str(e)}
+                self.add(database=db_path, source=new_db_path, **entry)
+        finally:
+            conn.close()
+
+    def summary(self) -> dict:
+        with self._lock:
+            entries = list(self.entries)
+        return {
+            'databases': len({entry.get('database') for entry in entries}),
+            'tables': sum(1 for entry in entries if entry.get('table')),
+            'new_rows': sum(entry.get('new_rows', 0) for entry in entries),
+            'updated_rows': sum(entry.get('updated_rows', 0) for entry in entries),
+            'merged_rows': sum(entry.get('merged_rows', 0) for entry in entries),
+            'bytes': sum(entry.get('bytes', 0) for entry in entries),
+            'errors': sum(1 for entry in entries if entry.get('error')),
+        }
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            entries = list(self.entries)
+        return {
+            'dry_run': self.dry_run,
+            'tables': self.tables,
+            'exact': self.exact,
+            'time': int(time.time()),
+            'summary': self.summary(),
+            'entries': entries,
+        }
+
+    def save(self, path):
+        save_merge_plan(self.to_dict(), path)
+
+
+def save_merge_plan(plan: dict, path):
+    """
+    合并计划保存成json文件
+    """
+
+    def default(value):
+        # 键的范围可能是二进制
+        return value.hex() if isinstance(value, bytes) else str(value)
+
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(plan, f, ensure_ascii=False, indent=1, default=default)
+
+
+def copy_new_shard(db_path, destination):
+    """
+    已有数据库里没有的分片直接复制过去，生成合并计划时只记录要复制的字节数
+    """
+    plan = current_merge_plan()
+    if plan and plan.dry_run:
+        plan.add(database=destination, source=db_path, mode='copy', bytes=os.path.getsize(db_path))
+        return
+    shutil.copy(db_path, destination)
+    if plan:
+        plan.add(database=destination, source=db_path, mode='copy', bytes=os.path.getsize(db_path))
 
 
 def increase_data(db_path, src_cursor, src_conn, table_name, col_name, col_index=-1, exclude_column=''):
     """
     将db_path数据库的内容增量写入connect数据库中
+    新数据库ATTACH到已有连接上，用一条 INSERT ... SELECT ... WHERE key NOT IN (...) 在SQLite内部完成反连接，
+    不会把两张表的数据读进Python，内存占用与表的大小无关
     @param db_path: 新的数据库路径
     @param src_cursor: 待写入数据库游标
     @param src_conn: 待写入数据库连接
     @param table_name: 待写入的表名
     @param col_name: 根据该列进行判断是否是新增数据
-    @param col_index: 待写入的列号
+    @param col_index: col_name不存在时使用该列号对应的列
     @param exclude_column: 是否不考虑某一列（针对某一列是自增ID的表）
-    @return:
+    @return: 插入的行数
     """
     if not (os.path.exists(db_path) or os.path.isfile(db_path)):
         print(f'{db_path} 不存在')
-        return
+        return 0
     if not src_cursor or not src_conn:
         print(f'{db_path} 数据库连接无效，增量解析失败')
-        return
-    tgt_conn = sqlite3.connect(db_path)
-    tgt_cur = tgt_conn.cursor()
-
+        return 0
+    plan = current_merge_plan()
+    if plan:
+        if not plan.selected(table_name):
+            return 0
+        if plan.dry_run:
+            table = MergeTable(table_name, col_name, exclude_column=exclude_column)
+            plan.estimate(database_path(src_conn), db_path, [(table, table_name)], col_index=col_index)
+            return 0
     try:
-        if not table_exists(src_conn, table_name):
-            # 复制表结构
-            create_table_sql = get_create_statements(tgt_conn, table_name, "table")
-            if create_table_sql:
-                src_conn.execute(create_table_sql[0])  # 执行 CREATE TABLE 语句
-                print(f"表 {table_name} 结构已复制")
-
-            # 复制索引
-            create_index_sql_list = get_create_statements(tgt_conn, table_name, "index")
-            for create_index_sql in create_index_sql_list:
-                src_conn.execute(create_index_sql)  # 执行 CREATE INDEX 语句
-                print(f"索引已复制: {create_index_sql}")
-        # 获取列名
-        src_cursor.execute(f"PRAGMA table_info({table_name})")
-        columns_info = src_cursor.fetchall()
-        column_names = [info[1] for info in columns_info]
-        if columns_info and exclude_column:
-            try:
-                exclude_col_index = column_names.index(exclude_column)
-            except ValueError:
-                print(f"错误: 列 {exclude_column} 在表 {table_name} 中不存在")
-                return
-            column_names = column_names[:exclude_col_index]+column_names[exclude_col_index+1:]
-        num_columns = len(column_names)
-        if col_index == -1:
-            try:
-                col_index = column_names.index(col_name)
-            except ValueError:
-                print(f"错误: 列 {col_name} 在表 {table_name} 中不存在")
-                return
-        # 从数据库B中选择主键不在数据库A中的行
-        query = f"""
-           SELECT {', '.join(column_names)}
-           FROM {table_name} 
-        """
-        tgt_cur.execute(query)
-        target_rows = tgt_cur.fetchall()
-        query = f'''
-        SELECT {col_name}
-        FROM {table_name}
-        '''
-        src_cursor.execute(query)
-        source_rows = src_cursor.fetchall()
-
-        source_rows = {r[0] for r in source_rows}
-        rows_to_insert = [row for row in target_rows if row[col_index] not in source_rows]
-        if rows_to_insert:
-            insert_query = f"""
-                INSERT INTO {table_name} ({', '.join(column_names)})
-                VALUES ({', '.join(['?'] * num_columns)})
-            """
-            src_cursor.executemany(insert_query, rows_to_insert)
+        with attach_database(src_conn, db_path) as schema:
+            inserted = insert_new_rows(src_conn, src_cursor, table_name, col_name, col_index, exclude_column, schema)
             src_conn.commit()
-            print(f"{len(rows_to_insert)} 行已插入到 {table_name} 表中")
-        else:
-            pass
-            # print(f"没有需要插入的数据，{table_name} 表已是最新")
+        if inserted:
+            print(f"{inserted} 行已插入到 {table_name} 表中")
+        if plan:
+            plan.add(database=database_path(src_conn), source=db_path, table=table_name, mode='insert',
+                     merged_rows=inserted)
+        return inserted
     except sqlite3.Error as e:
         print(f"{db_path} 数据库操作错误: {e}")
-    finally:
-        tgt_cur.close()
-        tgt_conn.close()
+        logger.error(traceback.format_exc())
+        if plan:
+            plan.add(database=database_path(src_conn), source=db_path, table=table_name, mode='insert', error=str(e))
+        return 0
 
 
 def increase_update_data(db_path, src_cur, src_conn, table_name, col_name, col_index=-1, exclude_first_column=False):
     """
     将 db_path 数据库的内容增量写入 src_conn 连接的数据库，如果有冲突则删除旧数据并更新
+    用 EXCEPT 在SQLite内部找出新数据库中有变化的行，再按col_name删除旧行、插入新行，全部在一个事务里完成
     :param db_path: 目标数据库文件路径
     :param src_cur: 源数据库游标
     :param src_conn: 源数据库连接
     :param table_name: 需要同步的表名
     :param col_name: 用于匹配的列名
-    :param col_index: 指定列的索引（默认为 -1，即自动检测）
+    :param col_index: col_name不存在时使用该列号对应的列
     :param exclude_first_column: 是否排除第一列
+    :return: 更新的行数
     """
     if not (os.path.exists(db_path) or os.path.isfile(db_path)):
         print(f'{db_path} 不存在')
-        return
-
-    tgt_conn = sqlite3.connect(db_path)
-    tgt_cur = tgt_conn.cursor()
+        return 0
+    if not src_cur or not src_conn:
+        print(f'{db_path} 数据库连接无效，增量解析失败')
+        return 0
+    plan = current_merge_plan()
+    if plan:
+        if not plan.selected(table_name):
+            return 0
+        if plan.dry_run:
+            table = MergeTable(table_name, col_name, update=True, exclude_column='*' if exclude_first_column else '')
+            plan.estimate(database_path(src_conn), db_path, [(table, table_name)], col_index=col_index)
+            return 0
     try:
-        if not table_exists(tgt_conn, table_name):
-            # 复制表结构
-            create_table_sql = get_create_statements(src_conn, table_name, "table")
-            if create_table_sql:
-                tgt_conn.execute(create_table_sql[0])  # 执行 CREATE TABLE 语句
-                print(f"表 {table_name} 结构已复制")
-
-            # 复制索引
-            create_index_sql_list = get_create_statements(src_conn, table_name, "index")
-            for create_index_sql in create_index_sql_list:
-                tgt_conn.execute(create_index_sql)  # 执行 CREATE INDEX 语句
-                print(f"索引已复制: {create_index_sql}")
-
-        # 获取列名
-        src_cur.execute(f"PRAGMA table_info({table_name})")
-        columns_info = src_cur.fetchall()
-        if exclude_first_column:
-            columns_info = columns_info[1:]
-
-        column_names = [info[1] for info in columns_info]
-        num_columns = len(column_names)
-
-        if col_index == -1:
-            try:
-                col_index = column_names.index(col_name)
-            except ValueError:
-                print(f"错误: 列 {col_name} 在 {table_name} 表中不存在。")
-                return
-
-        # 查询目标数据库的数据
-        query = f"SELECT {', '.join(column_names)} FROM {table_name}"
-        tgt_cur.execute(query)
-        source_rows = set(tgt_cur.fetchall())  # 使用 set() 加速查询
-
-        # 查询源数据库已有的数据
-        src_cur.execute(query)
-        existing_rows = set(src_cur.fetchall())
-
-        # 需要删除并重新插入的行
-        rows_to_insert = [row for row in source_rows if row not in existing_rows]
-
-        if rows_to_insert:
-            delete_query = f"DELETE FROM {table_name} WHERE {col_name} = ?"
-            src_cur.executemany(delete_query, [(row[col_index],) for row in rows_to_insert])
-            src_conn.commit()
-
-            insert_query = f"INSERT INTO {table_name} ({', '.join(column_names)}) VALUES ({', '.join(['?'] * num_columns)})"
-            src_cur.executemany(insert_query, rows_to_insert)
+        with attach_database(src_conn, db_path) as schema:
+            updated = update_changed_rows(src_conn, src_cur, table_name, col_name, col_index, exclude_first_column,
+                                          schema)
             src_conn.commit()
-            print(f"{len(rows_to_insert)} 行已更新到 {table_name} 表中。")
-        else:
-            pass
-            # print(f"没有需要插入的数据，{table_name} 表已是最新。")
+        if updated:
+            print(f"{updated} 行已更新到 {table_name} 表中。")
+        if plan:
+            plan.add(database=database_path(src_conn), source=db_path, table=table_name, mode='update',
+                     merged_rows=updated)
+        return updated
     except sqlite3.Error as e:
         print(f"{db_path} 数据库操作错误: {e}")
+        logger.error(traceback.format_exc())
+        if plan:
+            plan.add(database=database_path(src_conn), source=db_path, table=table_name, mode='update', error=str(e))
+        return 0
+
+
+def database_path(conn) -> str:
+    """
+    @return: 连接打开的数据库文件路径
+    """
+    for _, name, file in conn.execute('PRAGMA database_list').fetchall():
+        if name == 'main':
+            return file
+    return ''
+
+
+def merge_shard(db_path, new_db_path, tables: List[MergeTable], pragmas: Dict = None,
+                use_watermark=True) -> Dict[str, int]:
+    """
+    合并一个分片：使用独立的连接，新数据库只ATTACH一次，所有表在同一个事务里合并，最后只提交一次
+    @param db_path: 已有数据库的路径
+    @param new_db_path: 新数据库的路径
+    @param tables: 要合并的表
+    @param pragmas: 合并连接使用的pragma，默认MERGE_PRAGMAS
+    @param use_watermark: 只插入新增行的表使用合并水位线，水位线和数据在同一个事务里提交
+    @return: {表名: 写入的行数}
+    """
+    plan = current_merge_plan()
+    watermark_source = os.path.basename(new_db_path) if use_watermark else None
+    if plan and plan.dry_run:
+        try:
+            with contextlib.closing(connect_readonly(db_path, new_db_path)) as conn:
+                merge_tables = expand_merge_tables(conn, tables)
+        except sqlite3.Error as e:
+            plan.add(database=db_path, source=new_db_path, error=str(e))
+            return {}
+        plan.estimate(db_path, new_db_path, merge_tables, watermark_source)
+        return {}
+    pragmas = MERGE_PRAGMAS if pragmas is None else pragmas
+    result = {}
+    conn = sqlite3.connect(db_path, isolation_level=None)  # 手动管理事务
+    cursor = conn.cursor()
+    journal_mode = None
+    try:
+        if 'journal_mode' in pragmas:
+            journal_mode = cursor.execute('PRAGMA journal_mode').fetchone()[0]
+        for key, value in pragmas.items():
+            cursor.execute(f'PRAGMA {key}={value}')
+        cursor.execute(f'ATTACH DATABASE ? AS {MERGE_SCHEMA}', (new_db_path,))
+        try:
+            merge_tables = expand_merge_tables(conn, tables)
+            if plan:
+                merge_tables = [(table, table_name) for table, table_name in merge_tables if plan.selected(table_name)]
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                if use_watermark:
+                    create_watermark_table(cursor)
+                for table, table_name in merge_tables:
+                    if table.update:
+                        num = update_changed_rows(conn, cursor, table_name, table.col_name,
+                                                  exclude_first_column=bool(table.exclude_column))
+                    else:
+                        num = insert_new_rows(conn, cursor, table_name, table.col_name,
+                                              exclude_column=table.exclude_column,
+                                              watermark_source=watermark_source)
+                    if num:
+                        result[table_name] = num
+                cursor.execute('COMMIT')
+            except:
+                cursor.execute('ROLLBACK')
+                raise
+        finally:
+            cursor.execute(f'DETACH DATABASE {MERGE_SCHEMA}')
+    finally:
+        if journal_mode:
+            # 恢复数据库原来的日志模式，避免合并后微信的数据库一直处于WAL模式
+            with contextlib.suppress(sqlite3.Error):
+                cursor.execute(f'PRAGMA journal_mode={journal_mode}')
+        cursor.close()
+        conn.close()
+    if plan:
+        for table, table_name in merge_tables:
+            plan.add(database=db_path, source=new_db_path, table=table_name,
+                     mode='update' if table.update else 'insert', merged_rows=result.get(table_name, 0))
+    return result
+
+
+def merge_shards(shards: List[Tuple[str, str]], tables: List[MergeTable], max_workers=None,
+                 pragmas: Dict = None, use_watermark=True) -> Dict[str, Dict[str, int]]:
+    """
+    并行合并多个分片，每个分片一个连接、一个事务
+    sqlite3在执行SQL时会释放GIL，各分片的连接在线程池里真正并行执行，合并耗时取决于分片数而不是表的数量
+    @param shards: List[(已有数据库的路径, 新数据库的路径)]
+    @param tables: 每个分片要合并的表
+    @param max_workers: 同时合并的分片数，默认min(分片数, CPU核数)
+    @param pragmas: 合并连接使用的pragma
+    @param use_watermark: 是否使用合并水位线
+    @return: {已有数据库的路径: {表名: 写入的行数}}
+    """
+    results = {}
+    if not shards:
+        return results
+    max_workers = max_workers or min(len(shards), os.cpu_count() or 4)
+    st = time.time()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            db_path: executor.submit(merge_shard, db_path, new_db_path, tables, pragmas, use_watermark)
+            for db_path, new_db_path in shards
+        }
+        for db_path, future in futures.items():
+            try:
+                results[db_path] = future.result()
+            except sqlite3.Error as e:
+                logger.error(f'{db_path} 合并失败\n{traceback.format_exc()}')
+                results[db_path] = {}
+                plan = current_merge_plan()
+                if plan:
+                    plan.add(database=db_path, error=str(e))
+    num = sum(sum(result.values()) for result in results.values())
+    logger.info(f'合并{len(shards)}个分片，写入{num}行，耗时{time.time() - st:.2f}s')
+    return results
+
+
+def benchmark(row_num=1000000, work_dir=None):
+    """
+    合并性能测试：已有数据库和新数据库各row_num行，一半重叠，新数据库中重叠部分有10%的行内容有变化
+    python -m wxManager.merge
+    """
+    import tempfile
+
+    work_dir = work_dir or tempfile.mkdtemp(prefix='merge_benchmark_')
+    old_path = os.path.join(work_dir, 'old.db')
+    new_path = os.path.join(work_dir, 'new.db')
+
+    def create_db(path, start, changed):
+        conn = sqlite3.connect(path)
+        conn.execute(
+            'CREATE TABLE Msg (local_id INTEGER PRIMARY KEY AUTOINCREMENT, server_id INTEGER, '
+            'sort_seq INTEGER, content TEXT)'
+        )
+        conn.executemany(
+            'INSERT INTO Msg (server_id, sort_seq, content) VALUES (?, ?, ?)',
+            ((i, i, f'{"new" if changed and i % 10 == 0 else "old"} message {i}') for i in
+             range(start, start + row_num))
+        )
+        conn.commit()
+        conn.close()
+
+    try:
+        st = time.time()
+        create_db(old_path, 0, False)
+        create_db(new_path, row_num // 2, True)
+        print(f'生成测试数据：{2 * row_num}行，耗时{time.time() - st:.2f}s')
+        for name, func, kwargs in [
+            ('increase_data', increase_data, {'exclude_column': 'local_id'}),
+            ('increase_update_data', increase_update_data, {'exclude_first_column': True}),
+        ]:
+            db_path = os.path.join(work_dir, f'{name}.db')
+            shutil.copyfile(old_path, db_path)
+            conn = sqlite3.connect(db_path)
+            cursor = conn.cursor()
+            st = time.time()
+            num = func(new_path, cursor, conn, 'Msg', 'server_id', **kwargs)
+            cost = time.time() - st
+            total = conn.execute('SELECT count(*) FROM Msg').fetchone()[0]
+            print(f'{name}：写入{num}行，合并后{total}行，耗时{cost:.2f}s，{row_num / cost:.0f}行/s')
+            cursor.close()
+            conn.close()
     finally:
-        tgt_cur.close()
-        tgt_conn.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
 
 
 if __name__ == "__main__":
-    # 源数据库文件列表
-    source_databases = ["Msg0/MSG2.db", "Msg/MSG2.db", "Msg/MSG3.db"]
+    benchmark()
@@ -13,6 +13,7 @@ from .message import Message, MessageType, TextMessage, ImageMessage, FileMessag
     EmojiMessage, QuoteMessage, MergedMessage, LinkMessage, PositionMessage
 from .db_model import DataBaseBase
 from .contact import Person, Contact, OpenIMContact, Me
+from .compact import CompactMessage, compact_message, compact_messages
 
 if __name__ == '__main__':
     pass
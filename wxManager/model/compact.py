@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@File        : wxManager-compact.py
+@Description : 紧凑的消息对象，用于在内存里长时间保存大量消息
+"""
+import dataclasses
+import sys
+import time
+from typing import Dict, Iterable
+
+from wxManager.model.contact import Person
+from wxManager.model.message import Message, TextMessage, QuoteMessage, FileMessage, ImageMessage, EmojiMessage, \
+    VideoMessage, AudioMessage, LinkMessage, WeChatVideoMessage, MergedMessage, VoipMessage, PositionMessage, \
+    BusinessCardMessage, TransferMessage, RedEnvelopeMessage, FavNoteMessage, PatMessage
+
+STR_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+DERIVED_FIELDS = ('str_time', 'display_name', 'avatar_src')  # 紧凑消息里现算的字段
+
+
+def _own_fields(cls):
+    """
+    @return: cls自己定义的字段（不包括父类的字段）
+    """
+    base_fields = {field.name for field in dataclasses.fields(cls.__bases__[0])} \
+        if dataclasses.is_dataclass(cls.__bases__[0]) else set()
+    return tuple(field.name for field in dataclasses.fields(cls) if field.name not in base_fields)
+
+
+class CompactMessage:
+    """
+    紧凑消息
+    和Message的字段一样，但是：
+        1. 使用__slots__，没有每个对象一个的__dict__
+        2. str_time由timestamp现算，不再每条消息保存一个字符串
+        3. display_name、avatar_src来自共享的联系人对象sender，只有和联系人不一样时（例如合并转发的消息）才单独保存
+        4. talker_id、sender_id使用驻留字符串，同一个人的消息共用一个字符串
+    字段可以直接读写；to_text、to_json以及各消息类型特有的方法先还原成原来的消息对象再调用，结果相同
+    """
+    __slots__ = tuple(name for name in _own_fields(Message) if name not in DERIVED_FIELDS) + (
+        'sender', '_str_time', '_display_name', '_avatar_src'
+    )
+    full_class = Message
+    field_names = tuple(field.name for field in dataclasses.fields(Message))
+
+    @property
+    def str_time(self):
+        if self._str_time is not None:
+            return self._str_time
+        return format_time(self.timestamp)
+
+    @str_time.setter
+    def str_time(self, value):
+        self._str_time = value
+
+    @property
+    def display_name(self):
+        if self._display_name is not None:
+            return self._display_name
+        return self.sender.remark if self.sender else ''
+
+    @display_name.setter
+    def display_name(self, value):
+        self._display_name = value
+
+    @property
+    def avatar_src(self):
+        if self._avatar_src is not None:
+            return self._avatar_src
+        return self.sender.small_head_img_url if self.sender else ''
+
+    @avatar_src.setter
+    def avatar_src(self, value):
+        self._avatar_src = value
+
+    def expand(self) -> Message:
+        """
+        还原成原来的消息对象
+        """
+        return self.full_class(**{name: getattr(self, name) for name in self.field_names})
+
+    def is_chatroom(self) -> bool:
+        return self.talker_id.endswith('@chatroom')
+
+    def type_name(self):
+        return self.expand().type_name()
+
+    def to_text(self):
+        return self.expand().to_text()
+
+    def to_json(self) -> dict:
+        return self.expand().to_json()
+
+    def __lt__(self, other):
+        return self.sort_seq < other.sort_seq
+
+    def __getattr__(self, name):
+        # 只有在slots和类属性里都找不到时才会调用，用于各消息类型特有的方法，例如get_file_size、set_file_name
+        if name.startswith('__'):
+            raise AttributeError(name)
+        message = self.expand()
+        attr = getattr(message, name)
+        if not callable(attr):
+            return attr
+
+        def method(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            # 方法可能修改了字段（例如set_file_name），写回紧凑对象
+            for field_name in self.field_names:
+                value = getattr(message, field_name)
+                current = getattr(self, field_name)
+                if value is not current and value != current:
+                    setattr(self, field_name, value)
+            return result
+
+        return method
+
+    def __repr__(self):
+        return f'{type(self).__name__}(server_id={self.server_id}, type={self.type}, sort_seq={self.sort_seq})'
+
+
+class CompactTextMessage(CompactMessage):
+    __slots__ = _own_fields(TextMessage)
+    full_class = TextMessage
+    field_names = tuple(field.name for field in dataclasses.fields(TextMessage))
+
+
+class CompactQuoteMessage(CompactTextMessage):
+    __slots__ = _own_fields(QuoteMessage)
+    full_class = QuoteMessage
+    field_names = tuple(field.name for field in dataclasses.fields(QuoteMessage))
+
+
+class CompactFileMessage(CompactMessage):
+    __slots__ = _own_fields(FileMessage)
+    full_class = FileMessage
+    field_names = tuple(field.name for field in dataclasses.fields(FileMessage))
+
+
+class CompactImageMessage(CompactFileMessage):
+    __slots__ = _own_fields(ImageMessage)
+    full_class = ImageMessage
+    field_names = tuple(field.name for field in dataclasses.fields(ImageMessage))
+
+
+class CompactEmojiMessage(CompactImageMessage):
+    __slots__ = _own_fields(EmojiMessage)
+    full_class = EmojiMessage
+    field_names = tuple(field.name for field in dataclasses.fields(EmojiMessage))
+
+
+class CompactVideoMessage(CompactFileMessage):
+    __slots__ = _own_fields(VideoMessage)
+    full_class = VideoMessage
+    field_names = tuple(field.name for field in dataclasses.fields(VideoMessage))
+
+
+class CompactAudioMessage(CompactFileMessage):
+    __slots__ = _own_fields(AudioMessage)
+    full_class = AudioMessage
+    field_names = tuple(field.name for field in dataclasses.fields(AudioMessage))
+
+
+class CompactLinkMessage(CompactMessage):
+    __slots__ = _own_fields(LinkMessage)
+    full_class = LinkMessage
+    field_names = tuple(field.name for field in dataclasses.fields(LinkMessage))
+
+
+class CompactWeChatVideoMessage(CompactMessage):
+    __slots__ = _own_fields(WeChatVideoMessage)
+    full_class = WeChatVideoMessage
+    field_names = tuple(field.name for field in dataclasses.fields(WeChatVideoMessage))
+
+
+class CompactMergedMessage(CompactMessage):
+    __slots__ = _own_fields(MergedMessage)
+    full_class = MergedMessage
+    field_names = tuple(field.name for field in dataclasses.fields(MergedMessage))
+
+
+class CompactVoipMessage(CompactMessage):
+    __slots__ = _own_fields(VoipMessage)
+    full_class = VoipMessage
+    field_names = tuple(field.name for field in dataclasses.fields(VoipMessage))
+
+
+class CompactPositionMessage(CompactMessage):
+    __slots__ = _own_fields(PositionMessage)
+    full_class = PositionMessage
+    field_names = tuple(field.name for field in dataclasses.fields(PositionMessage))
+
+
+class CompactBusinessCardMessage(CompactMessage):
+    __slots__ = _own_fields(BusinessCardMessage)
+    full_class = BusinessCardMessage
+    field_names = tuple(field.name for field in dataclasses.fields(BusinessCardMessage))
+
+
+class CompactTransferMessage(CompactMessage):
+    __slots__ = _own_fields(TransferMessage)
+    full_class = TransferMessage
+    field_names = tuple(field.name for field in dataclasses.fields(TransferMessage))
+
+
+class CompactRedEnvelopeMessage(CompactMessage):
+    __slots__ = _own_fields(RedEnvelopeMessage)
+    full_class = RedEnvelopeMessage
+    field_names = tuple(field.name for field in dataclasses.fields(RedEnvelopeMessage))
+
+
+class CompactFavNoteMessage(CompactMessage):
+    __slots__ = _own_fields(FavNoteMessage)
+    full_class = FavNoteMessage
+    field_names = tuple(field.name for field in dataclasses.fields(FavNoteMessage))
+
+
+class CompactPatMessage(CompactMessage):
+    __slots__ = _own_fields(PatMessage)
+    full_class = PatMessage
+    field_names = tuple(field.name for field in dataclasses.fields(PatMessage))
+
+
+COMPACT_CLASSES = {
+    cls.full_class: cls for cls in (
+        CompactMessage, CompactTextMessage, CompactQuoteMessage, CompactFileMessage, CompactImageMessage,
+        CompactEmojiMessage, CompactVideoMessage, CompactAudioMessage, CompactLinkMessage, CompactWeChatVideoMessage,
+        CompactMergedMessage, CompactVoipMessage, CompactPositionMessage, CompactBusinessCardMessage,
+        CompactTransferMessage, CompactRedEnvelopeMessage, CompactFavNoteMessage, CompactPatMessage,
+    )
+}
+
+
+def format_time(timestamp) -> str:
+    return time.strftime(STR_TIME_FORMAT, time.localtime(timestamp))
+
+
+def _compact_value(value, contacts):
+    if isinstance(value, Message):
+        return compact_message(value, contacts)
+    if isinstance(value, list) and value and isinstance(value[0], Message):
+        # 合并转发的子消息
+        return [compact_message(message, contacts) for message in value]
+    return value
+
+
+def compact_message(message: Message, contacts: Dict[str, Person] = None):
+    """
+    把消息转换成紧凑消息
+    @param message: 消息
+    @param contacts: {wxid: 联系人}，例如get_chatroom_members的返回值，消息的发送人引用这里的联系人对象
+    @return: 紧凑消息，未知的消息类型原样返回
+    """
+    cls = COMPACT_CLASSES.get(type(message))
+    if cls is None:
+        return message
+    compact = cls.__new__(cls)
+    for name, value in message.__dict__.items():
+        if name in DERIVED_FIELDS:
+            continue
+        value_type = type(value)
+        if value_type is str:
+            if name in ('talker_id', 'sender_id'):
+                value = sys.intern(value)
+        elif value_type is not int and value_type is not bool:
+            value = _compact_value(value, contacts)
+        setattr(compact, name, value)
+    sender = contacts.get(message.sender_id) if contacts else None
+    compact.sender = sender
+    compact._display_name = None if sender and message.display_name == sender.remark else message.display_name
+    compact._avatar_src = None if sender and message.avatar_src == sender.small_head_img_url else message.avatar_src
+    str_time = format_time(message.timestamp) if isinstance(message.timestamp, (int, float)) else None
+    compact._str_time = None if message.str_time == str_time else message.str_time
+    return compact
+
+
+def compact_messages(messages: Iterable[Message], contacts: Dict[str, Person] = None):
+    """
+    逐条转换成紧凑消息，例如 list(compact_messages(database.iter_messages(wxid), contacts))
+    """
+    for message in messages:
+        yield compact_message(message, contacts)
+
+
+def benchmark(num=200000):
+    """
+    内存测试：同一批文本消息分别用Message和CompactMessage保存，比较每条消息占用的字节数
+    python -m wxManager.model.compact
+    """
+    import tracemalloc
+
+    from wxManager.model.wire import sample_contacts, sample_messages
+
+    contacts = sample_contacts()
+
+    def create_messages():
+        return sample_messages(num, contacts)
+
+    def measure(func):
+        tracemalloc.start()
+        base = tracemalloc.take_snapshot()
+        result = func()
+        size = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(base, 'filename'))
+        tracemalloc.stop()
+        return result, size
+
+    messages, full_bytes = measure(create_messages)
+    st = time.time()
+    compact = list(compact_messages(messages, contacts))
+    cost = time.time() - st
+    assert [message.to_text() for message in compact[:100]] == [message.to_text() for message in messages[:100]]
+    assert compact[-1].str_time == messages[-1].str_time and compact[-1].display_name == messages[-1].display_name
+    del messages, compact
+    compact, compact_bytes = measure(lambda: list(compact_messages(create_messages(), contacts)))
+    print(f'{num}条文本消息')
+    print(f'Message：{full_bytes / num:.0f} 字节/条')
+    print(f'CompactMessage：{compact_bytes / num:.0f} 字节/条，节省{(1 - compact_bytes / full_bytes) * 100:.0f}%')
+    print(f'转换耗时：{cost:.2f}s，{num / max(cost, 1e-6):.0f}条/s')
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -41,7 +41,7 @@ class ContactType:
     Unknown = 1 << 8  # 已解散或者退出的群聊
 
 
-@dataclass
+@dataclass(slots=True)
 class Person:
     wxid: str
     remark: str
@@ -56,6 +56,7 @@ class Person:
     signature: str = ''
     label_list: List[str] = None
     region: Tuple[str, str, str] = ('', '', '')  # 地区 (国家,省份,城市)
+    avatar_path: str = ''  # 导出时保存的头像文件路径
 
     def is_chatroom(self):
         return self.wxid.endswith('@chatroom')  # 是否是群聊
@@ -93,7 +94,7 @@ signature:{self.signature}
         }
 
 
-@dataclass
+@dataclass(slots=True)
 class Contact(Person):
     is_unknown: bool = False  # 是否是联系人表中没有的数据
     # def __init__(self, contact_info: Dict):
@@ -8,9 +8,11 @@
 @File        : MemoTrace-db_model.py 
 @Description : 
 """
+import heapq
 import os
 import sqlite3
 import traceback
+from itertools import islice
 
 
 class DataBaseBase:
@@ -82,6 +84,92 @@ class DataBaseBase:
             finally:
                 pass
 
+    def iter_rows(self, db, sql, params=(), batch_size=1000):
+        """
+        使用独立的游标分批读取查询结果，逐行返回
+        @param db: 数据库连接
+        @param sql:
+        @param params:
+        @param batch_size: 每次fetchmany的行数
+        @return:
+        """
+        cursor = db.cursor()
+        try:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cursor.close()
+
+    def merge_sorted(self, shard_results, key, reverse=False, limit=None):
+        """
+        多路归并各分库已经排好序的查询结果，不用把所有结果拼起来再整体排序
+        @param shard_results: 每个分库的查询结果（可以是None），每个都已经按key排好序
+        @param key: 排序字段，例如 lambda row: row[3]
+        @param reverse: 分库结果是降序时为True
+        @param limit: 最多取多少条，None表示全部
+        @return: 归并后的列表
+        """
+        shards = [rows for rows in shard_results if rows]
+        if not shards:
+            return []
+        if len(shards) == 1:
+            rows = shards[0]
+            return list(rows[:limit] if limit is not None else rows)
+        merged = heapq.merge(*shards, key=key, reverse=reverse)
+        return list(islice(merged, limit) if limit is not None else merged)
+
+    def _shard_values(self, sql, params=(), table_name=None):
+        """
+        在每个分库上执行返回单个值的查询（例如count、min），逐个返回结果
+        @param table_name: 只查询有这张表的分库，None表示不检查
+        """
+        dbs = self.DB if self.is_series else [self.DB]
+        for db in dbs:
+            cursor = db.cursor()
+            try:
+                if table_name:
+                    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (table_name,))
+                    if not cursor.fetchone():
+                        continue
+                cursor.execute(sql, params)
+                result = cursor.fetchone()
+                yield result[0] if result else None
+            finally:
+                cursor.close()
+
+    def count_rows(self, sql, params=(), table_name=None) -> int:
+        """
+        统计查询结果的行数，一系列数据库时把各分库的行数加起来
+        @param sql: 查询语句
+        @param params:
+        @param table_name: 只统计有这张表的分库，None表示不检查
+        @return: 行数
+        """
+        return sum(self._shard_values(f'select count(*) from ({sql})', params, table_name))
+
+    def page_clause(self, column, sort_seq=None, direction='before', inclusive=False):
+        """
+        键集分页的查询条件
+        @param column: 排序字段，例如sort_seq、CreateTime
+        @param sort_seq: 游标，None表示从最新（before）或最早（after）的消息开始
+        @param direction: before取游标之前更早的消息（降序），after取游标之后更晚的消息（升序）
+        @param inclusive: 是否包含等于游标的消息
+        @return: (以and开头的条件, 参数, 排序方向)
+        """
+        if direction not in ('before', 'after'):
+            raise ValueError(f'direction只能是before或after：{direction}')
+        order = 'desc' if direction == 'before' else 'asc'
+        if sort_seq is None:
+            return '', [], order
+        operator = '<' if direction == 'before' else '>'
+        if inclusive:
+            operator += '='
+        return f'and {column} {operator} ?', [sort_seq], order
+
     def merge(self, db_path):
         pass
 
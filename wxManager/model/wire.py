@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@File        : wxManager-wire.py
+@Description : 子进程解析好的消息传回主进程时使用的紧凑格式
+"""
+import dataclasses
+import pickle
+import time
+from array import array
+from itertools import chain
+from operator import itemgetter
+from typing import Iterable, List
+
+from wxManager.model import message as message_module
+from wxManager.model.message import Message
+
+STR_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+BASE_FIELDS = tuple(field.name for field in dataclasses.fields(Message))
+STRING_FIELDS = ('talker_id', 'sender_id', 'display_name', 'avatar_src')  # 重复很多的字段，放进字符串表
+INT_FIELDS = ('local_id', 'server_id', 'sort_seq', 'timestamp', 'type', 'status')
+
+
+def _format_time(timestamp):
+    return time.strftime(STR_TIME_FORMAT, time.localtime(timestamp))
+
+
+_EXTRA_GETTERS = {}
+
+
+def _extra_getter(message_class):
+    """
+    @return: 取出消息类型特有字段（Message之外的字段）的函数，按构造函数参数的顺序返回元组；没有特有字段时返回None
+    """
+    if message_class not in _EXTRA_GETTERS:
+        names = [field.name for field in dataclasses.fields(message_class) if field.name not in BASE_FIELDS]
+        if not names:
+            getter = None
+        elif len(names) == 1:
+            name = names[0]
+            getter = lambda values: (values[name],)
+        else:
+            getter = itemgetter(*names)
+        _EXTRA_GETTERS[message_class] = getter
+    return _EXTRA_GETTERS[message_class]
+
+
+def _int_column(values):
+    try:
+        return array('q', values)
+    except (OverflowError, TypeError):
+        # 超出int64或者不是整数的列用普通列表
+        return list(values)
+
+
+class MessageBatch:
+    """
+    按列存储的一批消息
+    整数列用array保存，发送人、聊天对象、昵称、头像放进共享的字符串表，各消息类型特有的字段按顺序存成元组
+    （引用消息、合并转发的聊天记录里嵌套的消息很少，仍然作为普通对象pickle）
+    pickle时只有十几个大对象，不用逐个pickle数据类；主进程迭代时逐条还原成原来的消息对象。
+    get_messages返回的是消息列表，主进程会立即还原整批消息（是一次性的，不是按需还原），省下的是pickle的开销
+    """
+
+    def __init__(self):
+        self.classes = []  # 消息类名
+        self.strings = []  # 字符串表
+        self.class_index = None  # 每条消息的类在classes中的下标
+        self.columns = {}  # 字段名 -> 列
+        self.extras = []  # 各消息类型特有的字段
+        self.objects = {}  # 下标 -> 无法打包的消息，原样保存
+        self._cache = None
+
+    @classmethod
+    def pack(cls, messages: Iterable[Message]) -> 'MessageBatch':
+        batch = cls()
+        class_ids = {}
+        extra_getters = []
+        class_index = []
+        rows = []
+        extras = []
+        get_base = itemgetter(*BASE_FIELDS)
+        placeholder = (0, 0, 0, 0, '', 0, '', False, '', '', '', 0, '')
+        for index, message in enumerate(messages):
+            message_class = type(message)
+            class_id = class_ids.get(message_class)
+            if class_id is None:
+                if not (isinstance(message, Message) and dataclasses.is_dataclass(message)
+                        and getattr(message_module, message_class.__name__, None) is message_class):
+                    # 不是wxManager.model.message里的消息类型，原样pickle
+                    batch.objects[index] = message
+                    class_index.append(0)
+                    rows.append(placeholder)
+                    extras.append(())
+                    continue
+                class_id = class_ids[message_class] = len(batch.classes)
+                batch.classes.append(message_class.__name__)
+                extra_getters.append(_extra_getter(message_class))
+            class_index.append(class_id)
+            values = message.__dict__
+            rows.append(get_base(values))
+            get_extra = extra_getters[class_id]
+            extras.append(get_extra(values) if get_extra else ())
+        batch.class_index = array('H', class_index)
+        batch.extras = extras
+        columns = dict(zip(BASE_FIELDS, zip(*rows)))
+        batch.strings = list(dict.fromkeys(chain.from_iterable(columns.get(name, ()) for name in STRING_FIELDS)))
+        string_ids = {value: index for index, value in enumerate(batch.strings)}
+        for name, column in columns.items():
+            if name in STRING_FIELDS:
+                batch.columns[name] = array('i', map(string_ids.__getitem__, column))
+            elif name in INT_FIELDS:
+                batch.columns[name] = _int_column(column)
+            elif name == 'is_sender':
+                batch.columns[name] = array('b', [1 if value else 0 for value in column])
+            else:
+                batch.columns[name] = list(column)
+        return batch
+
+    def __len__(self):
+        return len(self.class_index)
+
+    def _rows(self):
+        columns = self.columns
+        strings = self.strings
+        if not columns:
+            return iter(())
+        iterables = []
+        for name in BASE_FIELDS:
+            column = columns[name]
+            if name in STRING_FIELDS:
+                column = [strings[index] for index in column]
+            elif name == 'is_sender':
+                column = [value == 1 for value in column]
+            iterables.append(column)
+        return zip(*iterables)
+
+    def __iter__(self):
+        classes = self._classes()
+        objects = self.objects
+        for index, (class_id, row, extra) in enumerate(zip(self.class_index, self._rows(), self.extras)):
+            if objects and index in objects:
+                yield objects[index]
+            else:
+                yield classes[class_id](*row, *extra)
+
+    def _classes(self):
+        if self._cache is None:
+            self._cache = [getattr(message_module, name) for name in self.classes]
+        return self._cache
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache'] = None
+        return state
+
+
+def pack_messages(messages: Iterable[Message]) -> MessageBatch:
+    """
+    子进程中调用，把解析好的消息打包后作为返回值
+    """
+    return MessageBatch.pack(messages)
+
+
+def unpack_messages(batch) -> Iterable[Message]:
+    """
+    主进程中调用，逐条还原消息；兼容直接返回的消息列表
+    调用方用res.extend(...)收集时整批消息会立即还原成消息对象
+    """
+    if isinstance(batch, MessageBatch):
+        return iter(batch)
+    return batch
+
+
+def sample_contacts(num=100):
+    """
+    性能测试用的群成员
+    @return: {wxid: 联系人}
+    """
+    from wxManager.model.contact import Contact
+
+    return {
+        f'wxid_{i:08d}': Contact(wxid=f'wxid_{i:08d}', remark=f'群昵称{i}', nickname=f'昵称{i}',
+                                 small_head_img_url=f'https://wx.qlogo.cn/mmhead/{i:032d}/0')
+        for i in range(num)
+    }
+
+
+def sample_messages(num, contacts, quote_every=0) -> List[Message]:
+    """
+    性能测试用的群聊文本消息，模拟从数据库读出来的消息：每一行的字符串都是新创建的
+    wire和compact的benchmark共用
+    @param contacts: sample_contacts()的返回值，发送人从里面随机选（固定随机种子）
+    @param quote_every: 每隔多少条插入一条引用上一条消息的QuoteMessage，0表示不插入
+    """
+    import random
+
+    from wxManager.model.message import TextMessage, QuoteMessage
+
+    rand = random.Random(0)
+    wxids = list(contacts)
+    messages = []
+    for i in range(num):
+        timestamp = 1700000000 + i * 30
+        index = rand.randrange(len(wxids))
+        sender = contacts[wxids[index]]
+        kwargs = dict(
+            local_id=i,
+            server_id=7000000000000000000 + i,
+            sort_seq=timestamp * 1000,
+            timestamp=timestamp,
+            str_time=_format_time(timestamp),
+            type=1,
+            talker_id='12345678901@chatroom',
+            is_sender=i % 5 == 0,
+            sender_id=f'wxid_{index:08d}',
+            display_name=sender.remark,
+            avatar_src=sender.small_head_img_url,
+            status=3,
+            xml_content='',
+            content=f'消息内容{i}'
+        )
+        if quote_every and i % quote_every == 0 and messages:
+            messages.append(QuoteMessage(quote_message=messages[-1], **kwargs))
+        else:
+            messages.append(TextMessage(**kwargs))
+    return messages
+
+
+def benchmark(num=10000, rounds=5):
+    """
+    进程间传输的开销：10000条消息 pickle.dumps + pickle.loads 的耗时和字节数
+    python -m wxManager.model.wire
+    """
+    messages = sample_messages(num, sample_contacts(), quote_every=20)
+
+    def measure(func, *args):
+        st = time.perf_counter()
+        for _ in range(rounds):
+            result = func(*args)
+        return result, (time.perf_counter() - st) / rounds * 1000 * 10000 / num
+
+    # 子进程：打包并序列化；主进程：反序列化并还原成消息对象，主进程是串行的，这部分开销最关键
+    full_data, full_send = measure(pickle.dumps, messages, pickle.HIGHEST_PROTOCOL)
+    _, full_receive = measure(pickle.loads, full_data)
+    wire_data, wire_send = measure(lambda: pickle.dumps(pack_messages(messages), pickle.HIGHEST_PROTOCOL))
+    _, wire_receive = measure(lambda: list(unpack_messages(pickle.loads(wire_data))))
+    _, load_receive = measure(pickle.loads, wire_data)
+    assert list(unpack_messages(pickle.loads(wire_data))) == messages
+    print(f'{num}条消息，折算成每10000条：')
+    print(f'pickle数据类：子进程{full_send:.1f}ms，主进程{full_receive:.1f}ms，{len(full_data) * 10000 / num / 1024:.0f}KB')
+    print(f'MessageBatch：子进程{wire_send:.1f}ms，主进程{wire_receive:.1f}ms'
+          f'（只反序列化{load_receive:.1f}ms），{len(wire_data) * 10000 / num / 1024:.0f}KB')
+
+
+if __name__ == '__main__':
+    benchmark()
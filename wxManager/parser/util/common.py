@@ -10,22 +10,73 @@
 """
 
 import re
+from typing import Dict, Iterable, List
 
+# 默认的隐私信息规则，规则名 -> 正则表达式
+# 所有规则会被合并成一个正则，规则里不能再使用命名分组
+# 规则的顺序决定重叠时用哪条：同一位置先尝试前面的规则，匹配到的文本不会再被后面的规则替换
+# （以前逐条re.sub，后面的规则会改写前面的替换结果，例如'password: 13812345678'会变成'[password xxx] xxx]'）
+PRIVACY_RULES = {
+    'phone': r'\b(\+?86[-\s]?)?1[3-9]\d{9}\b',  # 手机号
+    'email': r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b',  # 邮箱
+    'id_card': r'\b\d{15}|\d{18}|\d{17}X\b',  # 身份证号
+    'password': r'\b(?:password|pwd|pass|psw)[\s=:]*\S+\b',  # 密码
+    'account': r'\b(?:account|username|user|acct)[\s=:]*\S+\b'  # 账号
+}
 
-def remove_privacy_info(text):
-    # 正则表达式模式
-    patterns = {
-        'phone': r'\b(\+?86[-\s]?)?1[3-9]\d{9}\b',  # 手机号
-        'email': r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b',  # 邮箱
-        'id_card': r'\b\d{15}|\d{18}|\d{17}X\b',  # 身份证号
-        'password': r'\b(?:password|pwd|pass|psw)[\s=:]*\S+\b',  # 密码
-        'account': r'\b(?:account|username|user|acct)[\s=:]*\S+\b'  # 账号
-    }
 
-    for key, pattern in patterns.items():
-        text = re.sub(pattern, f'[{key} xxx]', text)
+class Redactor:
+    """
+    隐私信息脱敏
+    初始化时把所有规则编译成一个带命名分组的正则，每段文本只扫描一遍，
+    同一位置有多条规则能匹配时，排在前面的规则优先
+    """
+
+    def __init__(self, rules: Dict[str, str] = None, replacement='[{name} xxx]', flags=0):
+        """
+        @param rules: 规则名 -> 正则表达式，默认使用PRIVACY_RULES
+        @param replacement: 替换文本的模板，{name}会被替换成规则名
+        @param flags: 正则表达式的flags，例如re.IGNORECASE
+        """
+        self.rules = dict(PRIVACY_RULES if rules is None else rules)
+        self.replacements = {name: replacement.format(name=name) for name in self.rules}
+        self.pattern = None
+        if self.rules:
+            self.pattern = re.compile(
+                '|'.join(f'(?P<{name}>{pattern})' for name, pattern in self.rules.items()),
+                flags
+            )
+
+    def _replace(self, match):
+        return self.replacements[match.lastgroup]
+
+    def redact(self, text: str) -> str:
+        if not text or self.pattern is None:
+            return text
+        return self.pattern.sub(self._replace, text)
+
+    def redact_batch(self, texts: Iterable[str]) -> List[str]:
+        """
+        批量脱敏，所有文本共用同一个编译好的正则
+        （实测把短消息拼成一段长文本再替换反而更慢，这里逐条替换）
+        @param texts: 文本列表
+        @return: 脱敏后的文本列表，顺序与输入一致
+        """
+        return list(map(self.redact, texts))
 
-    return text
+
+_default_redactor = None
+
+
+def get_default_redactor() -> Redactor:
+    global _default_redactor
+    if _default_redactor is None:
+        _default_redactor = Redactor()
+    return _default_redactor
+
+
+def remove_privacy_info(text):
+    return get_default_redactor().redact(text)
 
 
 def remove_illegal_characters(text):